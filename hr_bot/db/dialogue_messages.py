@@ -0,0 +1,168 @@
+# hr_bot/db/dialogue_messages.py
+"""
+Работа с сообщениями диалога (таблица dialogue_messages).
+
+Раньше история и очередь входящих хранились JSONB-массивами в Dialogue.history /
+Dialogue.pending_messages и на каждом ходу перезаписывались целиком. Теперь каждое
+сообщение - отдельная строка: новые входящие добавляются (is_processed = false),
+после ответа бота они помечаются обработанными, ответ бота - добавляется.
+Наружу сообщения отдаются в прежнем формате словарей
+({'message_id', 'role', 'content', 'timestamp_msk', ...}), чтобы LLM-код не менялся.
+
+Старые массивы переносятся в таблицу миграцией 0005.
+
+Функции не делают commit - он выполняется выше по стеку (единица работы).
+"""
+import datetime
+import logging
+
+from sqlalchemy import select, delete, exists, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import DialogueMessage, Dialogue
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних сообщений истории уходит в LLM (раньше - срез history[-150:])
+DIALOGUE_HISTORY_LIMIT = 150
+# История диалогов, не обновлявшихся дольше, удаляется ночной очисткой бота
+HISTORY_RETENTION_DAYS = 30
+
+
+def to_entry(message: DialogueMessage) -> dict:
+    """Строка таблицы -> словарь в формате старого JSONB-массива."""
+    entry = {
+        'message_id': message.hh_message_id,
+        'role': message.role,
+        'content': message.content,
+        'timestamp_msk': message.timestamp_msk,
+    }
+    if message.extracted_data is not None:
+        entry['extracted_data'] = message.extracted_data
+    if message.state is not None:
+        entry['state'] = message.state
+    return entry
+
+
+def _new_message(dialogue_id: int, entry: dict, is_processed: bool) -> DialogueMessage:
+    message_id = entry.get('message_id')
+    return DialogueMessage(
+        dialogue_id=dialogue_id,
+        hh_message_id=str(message_id) if message_id is not None else None,
+        role=entry.get('role', 'user'),
+        content=entry.get('content') or '',
+        timestamp_msk=entry.get('timestamp_msk'),
+        extracted_data=entry.get('extracted_data'),
+        state=entry.get('state'),
+        is_processed=is_processed,
+        processed_at=datetime.datetime.now(datetime.timezone.utc) if is_processed else None,
+    )
+
+
+async def get_history(db: AsyncSession, dialogue_id: int, limit: int = DIALOGUE_HISTORY_LIMIT) -> list:
+    """Последние limit сообщений истории (по возрастанию времени)."""
+    query = (
+        select(DialogueMessage)
+        .where(DialogueMessage.dialogue_id == dialogue_id, DialogueMessage.is_processed.is_(True))
+        .order_by(DialogueMessage.id.desc())
+    )
+    if limit:
+        query = query.limit(limit)
+    result = await db.execute(query)
+    return [to_entry(message) for message in reversed(result.scalars().all())]
+
+
+async def get_transcript(db: AsyncSession, dialogue_id: int) -> list:
+    """Вся история диалога (для транскрипций в Telegram)."""
+    return await get_history(db, dialogue_id, limit=None)
+
+
+async def get_transcripts(db: AsyncSession, dialogue_ids) -> dict:
+    """
+    Истории нескольких диалогов одним запросом: {dialogue_id: [строки (role, content, timestamp_msk)]}.
+    Только нужные для транскрипции колонки, без ORM-объектов.
+    """
+    transcripts = {dialogue_id: [] for dialogue_id in dialogue_ids}
+    if not transcripts:
+        return transcripts
+    result = await db.execute(
+        select(DialogueMessage.dialogue_id, DialogueMessage.role, DialogueMessage.content, DialogueMessage.timestamp_msk)
+        .where(DialogueMessage.dialogue_id.in_(transcripts), DialogueMessage.is_processed.is_(True))
+        .order_by(DialogueMessage.dialogue_id, DialogueMessage.id)
+    )
+    for row in result:
+        transcripts[row.dialogue_id].append(row)
+    return transcripts
+
+
+async def get_pending(db: AsyncSession, dialogue_id: int) -> list:
+    """Необработанные входящие сообщения (строки DialogueMessage) в порядке поступления."""
+    result = await db.execute(
+        select(DialogueMessage)
+        .where(DialogueMessage.dialogue_id == dialogue_id, DialogueMessage.is_processed.is_(False))
+        .order_by(DialogueMessage.id)
+    )
+    return list(result.scalars().all())
+
+
+async def get_known_message_ids(db: AsyncSession, dialogue_id: int) -> set:
+    """id всех сообщений диалога (история + очередь) - чтобы не добавить сообщение HH повторно."""
+    result = await db.execute(
+        select(DialogueMessage.hh_message_id)
+        .where(DialogueMessage.dialogue_id == dialogue_id, DialogueMessage.hh_message_id.is_not(None))
+    )
+    return set(result.scalars().all())
+
+
+def add_pending(db: AsyncSession, dialogue_id: int, entries: list):
+    """Ставит входящие сообщения (или системные команды) в очередь обработки."""
+    db.add_all([_new_message(dialogue_id, entry, is_processed=False) for entry in entries])
+
+
+def add_history(db: AsyncSession, dialogue_id: int, entries: list):
+    """Добавляет сообщения сразу в историю (ответы бота, напоминания)."""
+    db.add_all([_new_message(dialogue_id, entry, is_processed=True) for entry in entries])
+
+
+def mark_processed(db: AsyncSession, dialogue_id: int, pending_rows: list, history_entries: list):
+    """
+    Переносит обработанные входящие в историю.
+    pending_rows - строки, прочитанные в начале хода (пришедшие позже остаются в очереди).
+    history_entries - те же сообщения в том же порядке, в виде для истории (с замаскированными ПДн),
+    плюс в конце - системные команды этого хода, которых в таблице еще нет.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for row, entry in zip(pending_rows, history_entries):
+        row.content = entry.get('content') or ''
+        row.is_processed = True
+        row.processed_at = now
+
+    add_history(db, dialogue_id, history_entries[len(pending_rows):])
+
+
+async def drop_pending(db: AsyncSession, pending_rows: list):
+    """Удаляет сообщения из очереди, не добавляя их в историю (например, при 403 от HH)."""
+    for row in pending_rows:
+        await db.delete(row)
+
+
+def has_pending_clause():
+    """Условие "у диалога есть необработанные сообщения" для выборок по Dialogue."""
+    return exists().where(and_(
+        DialogueMessage.dialogue_id == Dialogue.id,
+        DialogueMessage.is_processed.is_(False),
+    ))
+
+
+async def delete_old_history(db: AsyncSession, cutoff_date: datetime.datetime):
+    """Удаляет историю диалогов, не обновлявшихся с cutoff_date (очередь не трогаем)."""
+    return await db.execute(
+        delete(DialogueMessage)
+        .where(
+            DialogueMessage.is_processed.is_(True),
+            DialogueMessage.dialogue_id.in_(
+                select(Dialogue.id).where(Dialogue.last_updated < cutoff_date)
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
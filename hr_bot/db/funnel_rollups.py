@@ -0,0 +1,311 @@
+# hr_bot/db/funnel_rollups.py
+"""
+Дневная воронка (таблица daily_funnel_rollups) для статистики и выгрузки в Telegram.
+
+Вместо подсчета по dialogues на каждый запрос (28 COUNT с cast(created_at, Date)
+для 7-дневной сводки, полная выгрузка диалогов для Excel) читаются готовые агрегаты.
+
+Поддержка агрегатов:
+  - после commit любой сессии, в которой у диалога изменился status / dialogue_state,
+    появилась запись в очереди молчунов или обработано сообщение кандидата,
+    id диалога попадает в буфер; фоновая задача воркера раз в
+    FUNNEL_REFRESH_INTERVAL_SECONDS пересчитывает ячейки (день, рекрутер, вакансия)
+    этих диалогов одним INSERT ... SELECT ... ON CONFLICT DO UPDATE;
+  - ночная сверка (reconcile) пересчитывает последние FUNNEL_RECONCILE_DAYS дней целиком.
+Дни старше FUNNEL_REFRESH_MAX_AGE_DAYS не пересчитываются вовсе, в том числе при
+изменении их диалогов: после очистки истории (HISTORY_RETENTION_DAYS) признак
+"начал диалог" по ним уже не восстановить, и пересчет ячейки занизил бы started_count.
+
+День - дата создания диалога по Москве.
+"""
+import asyncio
+import datetime
+import logging
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import event, select, delete, func, cast, and_, tuple_, exists, literal, Date
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, attributes
+
+from .dialogue_messages import HISTORY_RETENTION_DAYS
+from .models import (
+    SessionLocal, Dialogue, DialogueMessage, InactiveNotificationQueue,
+    DailyFunnelRollup, Vacancy, TrackedRecruiter
+)
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_TIMEZONE_NAME = "Europe/Moscow"
+ROLLUP_TIMEZONE = ZoneInfo(ROLLUP_TIMEZONE_NAME)
+FUNNEL_REFRESH_INTERVAL_SECONDS = 30
+FUNNEL_REFRESH_CHUNK_SIZE = 1000
+FUNNEL_RECONCILE_DAYS = 7
+# С запасом в день: у диалога, созданного раньше, история уже может быть удалена
+FUNNEL_REFRESH_MAX_AGE_DAYS = HISTORY_RETENTION_DAYS - 1
+
+FINISHED_STATUSES = ('qualified', 'rejected')
+COUNTER_COLUMNS = (
+    'responses_count', 'started_count', 'qualified_count', 'rejected_count',
+    'declined_by_candidate_count', 'declined_by_us_count', 'silent_count', 'silent_started_count',
+)
+
+# Ключ в session.info для диалогов, затронутых в незакоммиченной транзакции
+_SESSION_INFO_KEY = "funnel_dirty_dialogues"
+
+_dirty_dialogue_ids = set()
+_refresh_lock = asyncio.Lock()
+_stop_event = asyncio.Event()
+_refresher_task = None
+
+
+# === ОТСЛЕЖИВАНИЕ ИЗМЕНЕНИЙ ===
+
+def _changed(obj, *fields) -> bool:
+    return any(attributes.get_history(obj, field).has_changes() for field in fields)
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_touched_dialogues(session, flush_context):
+    # В after_flush списки new / dirty и история атрибутов еще "до flush", а id уже присвоены
+    touched = set()
+    for obj in session.new:
+        if isinstance(obj, Dialogue):
+            touched.add(obj.id)
+        elif isinstance(obj, InactiveNotificationQueue):
+            touched.add(obj.dialogue_id)
+        elif isinstance(obj, DialogueMessage) and obj.is_processed and obj.role == 'user':
+            touched.add(obj.dialogue_id)
+    for obj in session.dirty:
+        if isinstance(obj, Dialogue) and _changed(obj, 'status', 'dialogue_state'):
+            touched.add(obj.id)
+        elif isinstance(obj, DialogueMessage) and obj.role == 'user' and _changed(obj, 'is_processed'):
+            touched.add(obj.dialogue_id)
+    touched.discard(None)
+    if touched:
+        session.info.setdefault(_SESSION_INFO_KEY, set()).update(touched)
+
+
+@event.listens_for(Session, "after_commit")
+def _move_to_buffer_on_commit(session):
+    touched = session.info.pop(_SESSION_INFO_KEY, None)
+    if touched:
+        _dirty_dialogue_ids.update(touched)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
+
+
+# === ПЕРЕСЧЕТ ===
+
+def _day_expression():
+    return cast(func.timezone(ROLLUP_TIMEZONE_NAME, Dialogue.created_at), Date)
+
+
+def _day_start(day: datetime.date) -> datetime.datetime:
+    """Начало московского дня как aware datetime (граница для индекса по created_at)."""
+    return datetime.datetime.combine(day, datetime.time.min, tzinfo=ROLLUP_TIMEZONE)
+
+
+def _rollup_select(*conditions):
+    """Агрегаты воронки по диалогам, удовлетворяющим conditions."""
+    started = exists().where(
+        DialogueMessage.dialogue_id == Dialogue.id,
+        DialogueMessage.is_processed.is_(True),
+        DialogueMessage.role == 'user',
+        DialogueMessage.content != '',
+        ~DialogueMessage.content.startswith("[SYSTEM COMMAND]"),
+    )
+    silent = exists().where(InactiveNotificationQueue.dialogue_id == Dialogue.id)
+
+    facts = (
+        select(
+            _day_expression().label('date'),
+            func.coalesce(Dialogue.recruiter_id, 0).label('recruiter_id'),
+            func.coalesce(Dialogue.vacancy_id, 0).label('vacancy_id'),
+            Dialogue.status,
+            Dialogue.dialogue_state,
+            started.label('started'),
+            silent.label('silent'),
+        )
+        .where(*conditions)
+        .subquery()
+    )
+    unfinished_silent = and_(facts.c.silent, facts.c.status.notin_(FINISHED_STATUSES))
+    return (
+        select(
+            facts.c.date,
+            facts.c.recruiter_id,
+            facts.c.vacancy_id,
+            func.count().label('responses_count'),
+            func.count().filter(facts.c.started).label('started_count'),
+            func.count().filter(facts.c.status == 'qualified').label('qualified_count'),
+            func.count().filter(facts.c.status == 'rejected').label('rejected_count'),
+            func.count().filter(and_(
+                facts.c.status == 'rejected', facts.c.dialogue_state == 'declined_vacancy'
+            )).label('declined_by_candidate_count'),
+            func.count().filter(facts.c.dialogue_state == 'qualification_failed').label('declined_by_us_count'),
+            func.count().filter(unfinished_silent).label('silent_count'),
+            func.count().filter(and_(unfinished_silent, facts.c.started)).label('silent_started_count'),
+            func.now().label('updated_at'),
+        )
+        .group_by(facts.c.date, facts.c.recruiter_id, facts.c.vacancy_id)
+    )
+
+
+def _upsert(rollup_select):
+    columns = ['date', 'recruiter_id', 'vacancy_id', *COUNTER_COLUMNS, 'updated_at']
+    statement = insert(DailyFunnelRollup).from_select(columns, rollup_select)
+    return statement.on_conflict_do_update(
+        index_elements=[DailyFunnelRollup.date, DailyFunnelRollup.recruiter_id, DailyFunnelRollup.vacancy_id],
+        set_={column: getattr(statement.excluded, column) for column in (*COUNTER_COLUMNS, 'updated_at')},
+    )
+
+
+async def refresh_dialogues(db: AsyncSession, dialogue_ids: list):
+    """
+    Пересчитывает ячейки (день, рекрутер, вакансия), в которые входят указанные диалоги.
+    Ячейки старше FUNNEL_REFRESH_MAX_AGE_DAYS пропускаются.
+    """
+    cells_result = await db.execute(
+        select(
+            _day_expression(),
+            func.coalesce(Dialogue.recruiter_id, 0),
+            func.coalesce(Dialogue.vacancy_id, 0),
+        )
+        .where(Dialogue.id.in_(dialogue_ids))
+        .distinct()
+    )
+    first_day = datetime.datetime.now(ROLLUP_TIMEZONE).date() - datetime.timedelta(days=FUNNEL_REFRESH_MAX_AGE_DAYS - 1)
+    cells = [tuple(row) for row in cells_result.all() if row[0] >= first_day]
+    if not cells:
+        return
+
+    days = [day for day, _, _ in cells]
+    await db.execute(_upsert(_rollup_select(
+        # Диапазон по created_at - для индекса, точный отбор ячеек - по кортежу
+        Dialogue.created_at >= _day_start(min(days)),
+        Dialogue.created_at < _day_start(max(days) + datetime.timedelta(days=1)),
+        tuple_(
+            _day_expression(),
+            func.coalesce(Dialogue.recruiter_id, 0),
+            func.coalesce(Dialogue.vacancy_id, 0),
+        ).in_(cells),
+    )))
+
+
+async def refresh_dirty():
+    """Пересчитывает ячейки диалогов, измененных с прошлого вызова."""
+    async with _refresh_lock:
+        if not _dirty_dialogue_ids:
+            return
+        dialogue_ids = sorted(_dirty_dialogue_ids)
+        _dirty_dialogue_ids.clear()
+
+        try:
+            async with SessionLocal() as session:
+                for start in range(0, len(dialogue_ids), FUNNEL_REFRESH_CHUNK_SIZE):
+                    await refresh_dialogues(session, dialogue_ids[start:start + FUNNEL_REFRESH_CHUNK_SIZE])
+                await session.commit()
+            logger.debug(f"Воронка: пересчитаны ячейки для {len(dialogue_ids)} диалогов.")
+        except Exception as e:
+            logger.error(f"Ошибка пересчета воронки ({len(dialogue_ids)} диалогов), повторим позже: {e}", exc_info=True)
+            _dirty_dialogue_ids.update(dialogue_ids)
+
+
+def rebuild_query(first_day: datetime.date = None):
+    """INSERT ... SELECT всех ячеек начиная с first_day (None - за всю историю)."""
+    if first_day is None:
+        return _upsert(_rollup_select())
+    return _upsert(_rollup_select(Dialogue.created_at >= _day_start(first_day)))
+
+
+async def reconcile(db: AsyncSession, days: int = FUNNEL_RECONCILE_DAYS):
+    """Полный пересчет последних days дней (включая сегодня). commit - за вызывающим."""
+    first_day = datetime.datetime.now(ROLLUP_TIMEZONE).date() - datetime.timedelta(days=days - 1)
+    # Удаляем и вставляем заново: ячейки, в которых не осталось диалогов, тоже исчезнут
+    await db.execute(delete(DailyFunnelRollup).where(DailyFunnelRollup.date >= first_day))
+    await db.execute(rebuild_query(first_day))
+    logger.info(f"Воронка: сверка за {days} дн. (с {first_day}) выполнена.")
+
+
+async def _refresher_loop():
+    while not _stop_event.is_set():
+        try:
+            await asyncio.wait_for(_stop_event.wait(), timeout=FUNNEL_REFRESH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await refresh_dirty()
+
+
+def start_funnel_refresher():
+    """Запускает фоновый пересчет воронки (вызывать из работающего event loop)."""
+    global _refresher_task
+    _stop_event.clear()
+    if _refresher_task is None or _refresher_task.done():
+        _refresher_task = asyncio.create_task(_refresher_loop())
+    return _refresher_task
+
+
+async def stop_funnel_refresher():
+    """Останавливает фоновый пересчет и обрабатывает остаток буфера."""
+    global _refresher_task
+    _stop_event.set()
+    if _refresher_task is not None:
+        await _refresher_task
+        _refresher_task = None
+    await refresh_dirty()
+
+
+# === ЧТЕНИЕ (запросы выполняет вызывающий - синхронной или асинхронной сессией) ===
+
+def daily_totals_query(start_date: datetime.date, end_date: datetime.date):
+    """Суммы по дням за период: одна строка на день."""
+    return (
+        select(
+            DailyFunnelRollup.date,
+            *[func.sum(getattr(DailyFunnelRollup, column)).label(column) for column in COUNTER_COLUMNS],
+        )
+        .where(DailyFunnelRollup.date >= start_date, DailyFunnelRollup.date <= end_date)
+        .group_by(DailyFunnelRollup.date)
+        .order_by(DailyFunnelRollup.date.desc())
+    )
+
+
+def report_rows_query(start_date: datetime.date, end_date: datetime.date):
+    """Строки отчета: день, рекрутер, город, вакансия и счетчики."""
+    recruiter_name = func.coalesce(TrackedRecruiter.name, literal("Не указан"))
+    city = func.coalesce(Vacancy.city, literal("Не указан"))
+    title = func.coalesce(Vacancy.title, literal("Не указана"))
+    return (
+        select(
+            DailyFunnelRollup.date,
+            recruiter_name.label('recruiter'),
+            city.label('city'),
+            title.label('vacancy'),
+            *[func.sum(getattr(DailyFunnelRollup, column)).label(column) for column in COUNTER_COLUMNS],
+        )
+        .outerjoin(TrackedRecruiter, TrackedRecruiter.id == DailyFunnelRollup.recruiter_id)
+        .outerjoin(Vacancy, Vacancy.id == DailyFunnelRollup.vacancy_id)
+        .where(DailyFunnelRollup.date >= start_date, DailyFunnelRollup.date <= end_date)
+        .group_by(DailyFunnelRollup.date, recruiter_name, city, title)
+        .order_by(DailyFunnelRollup.date, recruiter_name)
+    )
+
+
+# === ПЕРВИЧНОЕ ЗАПОЛНЕНИЕ (ЗАПУСТИТСЯ ТОЛЬКО ПРИ ПРЯМОМ ВЫЗОВЕ) ===
+if __name__ == '__main__':
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    backfill_days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+
+    async def _run_backfill():
+        async with SessionLocal() as session:
+            await reconcile(session, days=backfill_days)
+            await session.commit()
+        print(f"✅ Воронка пересчитана за {backfill_days} дн.")
+
+    asyncio.run(_run_backfill())
@@ -2,7 +2,8 @@
 import datetime
 from zoneinfo import ZoneInfo
 from sqlalchemy import (
-    Column, Integer, String, Text, ForeignKey, DateTime, Date, func, Numeric, Boolean, BigInteger, text
+    Column, Integer, String, Text, ForeignKey, DateTime, Date, func, Numeric, Boolean, BigInteger, text, Index,
+    UniqueConstraint
 )
 from sqlalchemy.orm import relationship, declarative_base, sessionmaker
 from sqlalchemy.dialects.postgresql import JSONB
@@ -43,7 +44,7 @@ SessionLocal = async_sessionmaker(
 
 
 
-# --- СИНХРОННЫЙ ДВИЖОК И ФАБРИКА СЕССИЙ (ДЛЯ ТГ-БОТА) ---
+# --- СИНХРОННЫЙ ДВИЖОК И ФАБРИКА СЕССИЙ (ДЛЯ ФОНОВЫХ ПОТОКОВ: ВЫГРУЗКА EXCEL, МИГРАЦИИ) ---
 sync_engine = create_engine(
     SYNC_DATABASE_URL,
     pool_size=10,
@@ -73,6 +74,13 @@ class Vacancy(Base):
     # --- ДОБАВИТЬ ЭТО ПОЛЕ ---
     recruiter_id = Column(Integer, ForeignKey('tracked_recruiters.id'), nullable=True)
     # --- КОНЕЦ ---
+    # --- ДОБАВИТЬ: Привязка к описанию из библиотеки промптов ---
+    # Ключ найденного описания (NULL + заполненная версия = описание не найдено)
+    kb_description_key = Column(String(255), nullable=True)
+    # Версия библиотеки, для которой выполнен подбор. Другая версия - подбор повторяется
+    kb_library_version = Column(String(64), nullable=True)
+    kb_resolved_at = Column(DateTime(timezone=True), nullable=True)
+    # --- КОНЕЦ ---
     statistics = relationship("Statistic", back_populates="vacancy")
     dialogues = relationship("Dialogue", back_populates="vacancy")
     # --- ДОБАВИТЬ ЭТУ СВЯЗЬ ---
@@ -132,6 +140,8 @@ class Dialogue(Base):
     dialogue_state = Column(String(100))
     status = Column(String(50), nullable=False, default='new')
     reminder_level = Column(Integer, nullable=False, default=0, server_default='0')
+    # УСТАРЕЛО: сообщения хранятся в dialogue_messages (DialogueMessage).
+    # Колонки оставлены только для переноса старых данных (миграция 0005).
     history = Column(JSONB)
     pending_messages = Column(JSONB)
     last_updated = Column(
@@ -165,6 +175,21 @@ class Dialogue(Base):
     # --- ДОБАВИТЬ НОВУЮ СВЯЗЬ С ЛОГАМИ ---
     llm_usage_logs = relationship("LlmUsageLog", back_populates="dialogue", cascade="all, delete-orphan")
     # --- КОНЕЦ ДОБАВЛЕНИЯ ---
+    messages = relationship("DialogueMessage", back_populates="dialogue", cascade="all, delete-orphan", passive_deletes=True)
+
+    # Индексы под горячие запросы воркера и бота (миграция 0002_hot_query_indexes)
+    __table_args__ = (
+        # process_reminders: диалоги рекрутера в работе, еще не получившие все напоминания
+        Index(
+            'ix_dialogues_reminder_scan', 'recruiter_id', 'reminder_level',
+            postgresql_where=text("status = 'in_progress'"),
+            postgresql_include=['dialogue_state'],
+        ),
+        # process_pending_dialogues: диалоги рекрутера, не обновлявшиеся дольше debounce
+        Index('ix_dialogues_recruiter_id_last_updated', 'recruiter_id', 'last_updated'),
+        # Статистика и выгрузка в Telegram по диапазону дат создания
+        Index('ix_dialogues_created_at', 'created_at'),
+    )
     
 
 class Statistic(Base):
@@ -177,6 +202,35 @@ class Statistic(Base):
     vacancy_id = Column(Integer, ForeignKey('vacancies.id'))
     vacancy = relationship("Vacancy", back_populates="statistics")
 
+    __table_args__ = (
+        # Одна строка на вакансию в день - цель UPSERT в statistics_manager.flush_stats
+        UniqueConstraint('vacancy_id', 'date', name='uq_statistics_vacancy_id_date'),
+    )
+
+# --- НОВАЯ МОДЕЛЬ: ДНЕВНАЯ ВОРОНКА (агрегаты для статистики и выгрузки в Telegram) ---
+class DailyFunnelRollup(Base):
+    """
+    Счетчики воронки по дням создания диалога (по Москве), рекрутеру и вакансии
+    (город - из вакансии). Пересчитывается funnel_rollups: по затронутым диалогам
+    и ночной сверкой. 0 в recruiter_id / vacancy_id - "не указан".
+    """
+    __tablename__ = 'daily_funnel_rollups'
+    date = Column(Date, primary_key=True)
+    recruiter_id = Column(Integer, primary_key=True)
+    vacancy_id = Column(Integer, primary_key=True)
+
+    responses_count = Column(Integer, nullable=False, default=0, server_default='0')
+    started_count = Column(Integer, nullable=False, default=0, server_default='0')        # Кандидат написал сам
+    qualified_count = Column(Integer, nullable=False, default=0, server_default='0')
+    rejected_count = Column(Integer, nullable=False, default=0, server_default='0')       # status = 'rejected'
+    declined_by_candidate_count = Column(Integer, nullable=False, default=0, server_default='0')  # Отказался КД
+    declined_by_us_count = Column(Integer, nullable=False, default=0, server_default='0')         # Отказали мы
+    silent_count = Column(Integer, nullable=False, default=0, server_default='0')         # В очереди молчунов, не завершен
+    silent_started_count = Column(Integer, nullable=False, default=0, server_default='0') # То же, но начал диалог
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))
+# --- КОНЕЦ НОВОЙ МОДЕЛИ ---
+
 class TelegramUser(Base):
     __tablename__ = 'telegram_users'
     id = Column(Integer, primary_key=True, index=True)
@@ -194,6 +248,11 @@ class NotificationQueue(Base):
     processed_at = Column(DateTime(timezone=True))
     candidate = relationship("Candidate")
 
+    __table_args__ = (
+        # Очередь читается только по status = 'pending' - индексируем лишь ожидающие записи
+        Index('ix_notification_queue_pending', 'id', postgresql_where=text("status = 'pending'")),
+    )
+
 class TrackedVacancy(Base):
     __tablename__ = 'tracked_vacancies'
     id = Column(Integer, primary_key=True, index=True)
@@ -226,6 +285,10 @@ class InactiveNotificationQueue(Base):
     processed_at = Column(DateTime(timezone=True))
     
     dialogue = relationship("Dialogue", back_populates="inactive_alerts")
+
+    __table_args__ = (
+        Index('ix_inactive_notification_queue_pending', 'id', postgresql_where=text("status = 'pending'")),
+    )
 # --- КОНЕЦ НОВОЙ МОДЕЛИ ---
 
 # --- НОВАЯ МОДЕЛЬ ДЛЯ УВЕДОМЛЕНИЙ ОБ ОТКЛОНЕННЫХ КАНДИДАТАХ ---
@@ -239,6 +302,10 @@ class RejectedNotificationQueue(Base):
     processed_at = Column(DateTime(timezone=True))
     
     dialogue = relationship("Dialogue", back_populates="rejected_alerts")
+
+    __table_args__ = (
+        Index('ix_rejected_notification_queue_pending', 'id', postgresql_where=text("status = 'pending'")),
+    )
 # --- КОНЕЦ НОВОЙ МОДЕЛИ ---
 
 # --- НОВАЯ МОДЕЛЬ ДЛЯ УВЕДОМЛЕНИЙ О СОБЕСЕДОВАНИЯХ ---
@@ -258,6 +325,14 @@ class InterviewReminder(Base):
     
     dialogue = relationship("Dialogue", back_populates="reminders")
     recruiter = relationship("TrackedRecruiter") # Добавим связь для удобного доступа к рекрутеру
+
+    __table_args__ = (
+        # Выборка напоминаний, которые пора отправить (status = 'pending' AND время <= now)
+        Index(
+            'ix_interview_reminders_pending_send_time', 'scheduled_send_time_utc',
+            postgresql_where=text("status = 'pending'")
+        ),
+    )
 # --- КОНЕЦ НОВОЙ МОДЕЛИ ---
 
 # --- НОВАЯ МОДЕЛЬ ДЛЯ ЛОГИРОВАНИЯ ИСПОЛЬЗОВАНИЯ ТОКЕНОВ ---
@@ -281,8 +356,51 @@ class LlmUsageLog(Base):
     # Используем Numeric для точности финансовых данных. 
     # Precision=10, scale=6 означает до 10 знаков всего, из них 6 после запятой.
     cost = Column(Numeric(10, 6), nullable=False, default=0.0)
+
+    # --- ДОБАВИТЬ: Был ли запрос хеджирован (запускался второй параллельный запрос) ---
+    hedged = Column(Boolean, nullable=False, default=False, server_default='false')
     
     created_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))
 
     dialogue = relationship("Dialogue", back_populates="llm_usage_logs")
-# --- КОНЕЦ НОВОЙ МОДЕЛИ ---
\ No newline at end of file
+# --- КОНЕЦ НОВОЙ МОДЕЛИ ---
+
+
+# --- НОВАЯ МОДЕЛЬ: СООБЩЕНИЯ ДИАЛОГА (вместо JSONB-массивов history / pending_messages) ---
+class DialogueMessage(Base):
+    __tablename__ = 'dialogue_messages'
+    id = Column(BigInteger, primary_key=True)
+    dialogue_id = Column(Integer, ForeignKey('dialogues.id', ondelete='CASCADE'), nullable=False)
+
+    # id сообщения в HH (или служебный: bot_..., sys_cmd_..., no_msg_...)
+    hh_message_id = Column(String(100), nullable=True)
+    role = Column(String(20), nullable=False)  # 'user' / 'assistant'
+    content = Column(Text, nullable=False)
+    timestamp_msk = Column(String(50), nullable=True)  # Время сообщения строкой, как его видит LLM
+
+    # Только для ответов бота
+    extracted_data = Column(JSONB, nullable=True)
+    state = Column(String(100), nullable=True)
+
+    # False - входящее сообщение ждет обработки (бывший pending_messages), True - часть истории
+    is_processed = Column(Boolean, nullable=False, default=False, server_default='false')
+    created_at = Column(DateTime(timezone=True), server_default=func.timezone('UTC', func.now()))
+    processed_at = Column(DateTime(timezone=True), nullable=True)
+
+    dialogue = relationship("Dialogue", back_populates="messages")
+
+    __table_args__ = (
+        # Последние N сообщений истории диалога
+        Index('ix_dialogue_messages_dialogue_id_id', 'dialogue_id', 'id'),
+        # Необработанные входящие сообщения (маленький частичный индекс)
+        Index(
+            'ix_dialogue_messages_unprocessed', 'dialogue_id',
+            postgresql_where=text('is_processed = false')
+        ),
+        # Защита от повторной записи одного и того же сообщения HH
+        Index(
+            'uq_dialogue_messages_hh_message_id', 'dialogue_id', 'hh_message_id',
+            unique=True, postgresql_where=text('hh_message_id IS NOT NULL')
+        ),
+    )
+# --- КОНЕЦ НОВОЙ МОДЕЛИ ---
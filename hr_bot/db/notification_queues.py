@@ -0,0 +1,253 @@
+# hr_bot/db/notification_queues.py
+"""
+Очереди уведомлений для Telegram-бота: notification_queue (прошли квалификацию),
+inactive_notification_queue (молчуны), rejected_notification_queue (отказы).
+
+Раньше бот опрашивал каждую таблицу раз в 10-15 секунд. Теперь:
+  - воркер при постановке записи в очередь (новая запись или возврат в 'pending')
+    выполняет в той же транзакции pg_notify(QUEUE_CHANNEL, <имя таблицы>) -
+    Postgres доставит уведомление только после commit;
+  - бот слушает канал (start_queue_listener) и сразу забирает пачку;
+  - пачка забирается одним UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED)
+    со статусом 'processing', итоги отправки записываются одним UPDATE на статус;
+  - опрос остается как резервный проход раз в QUEUE_FALLBACK_SWEEP_SECONDS,
+    он же возвращает в 'pending' записи, зависшие в 'processing' (например, после падения бота).
+
+Для записей в 'processing' processed_at - время захвата или последнего продления:
+записи, которые бот еще доставляет (они могут ждать в очередях чатов дольше
+QUEUE_CLAIM_STALE_AFTER), продлеваются на каждом резервном проходе и в очередь не возвращаются.
+
+Контекст уведомлений (диалог, кандидат, вакансия, рекрутер) грузится на всю пачку
+сразу - load_task_contexts, одним запросом-проекцией без ORM-графов.
+"""
+import asyncio
+import datetime
+import logging
+
+import asyncpg
+from sqlalchemy import event, select, update, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, attributes
+
+from .models import (
+    NotificationQueue, InactiveNotificationQueue, RejectedNotificationQueue,
+    Dialogue, Candidate, Vacancy, TrackedRecruiter,
+    DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME
+)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_CHANNEL = "hr_bot_notification_queues"
+QUEUE_MODELS = (NotificationQueue, InactiveNotificationQueue, RejectedNotificationQueue)
+QUEUE_CLAIM_BATCH_SIZE = 20
+QUEUE_FALLBACK_SWEEP_SECONDS = 60
+# Сколько захваченных пачек одной очереди может ждать доставки одновременно
+QUEUE_MAX_PENDING_BATCHES = 5
+# Запись в 'processing' дольше этого времени считается брошенной
+QUEUE_CLAIM_STALE_AFTER = datetime.timedelta(minutes=15)
+QUEUE_LISTEN_RETRY_SECONDS = 30
+
+_queue_events = {model.__tablename__: asyncio.Event() for model in QUEUE_MODELS}
+_listener_task = None
+
+
+# === NOTIFY ПРИ ПОСТАНОВКЕ В ОЧЕРЕДЬ ===
+
+def _enqueued(obj, is_new: bool) -> bool:
+    if obj.status not in (None, 'pending'):
+        return False
+    return is_new or attributes.get_history(obj, 'status').has_changes()
+
+
+@event.listens_for(Session, "after_flush")
+def _notify_enqueued(session, flush_context):
+    # В after_flush списки new / dirty и история атрибутов еще "до flush"
+    tables = set()
+    for obj in session.new:
+        if isinstance(obj, QUEUE_MODELS) and _enqueued(obj, is_new=True):
+            tables.add(obj.__tablename__)
+    for obj in session.dirty:
+        if isinstance(obj, QUEUE_MODELS) and _enqueued(obj, is_new=False):
+            tables.add(obj.__tablename__)
+    connection = session.connection() if tables else None
+    for table in sorted(tables):
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": QUEUE_CHANNEL, "payload": table})
+
+
+# === ЗАХВАТ И ЗАВЕРШЕНИЕ ПАЧКИ ===
+
+async def claim_batch(db: AsyncSession, model, limit: int = QUEUE_CLAIM_BATCH_SIZE) -> list:
+    """
+    Переводит до limit ожидающих записей в 'processing' и возвращает их строки
+    (id, candidate_id / dialogue_id, ...). Записи, захваченные параллельным
+    обработчиком, пропускаются (SKIP LOCKED). Коммит - за вызывающим.
+    """
+    pending_ids = (
+        select(model.id)
+        .where(model.status == 'pending')
+        .order_by(model.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await db.execute(
+        update(model)
+        .where(model.id.in_(pending_ids))
+        .values(status='processing', processed_at=datetime.datetime.now(datetime.timezone.utc))
+        .returning(*model.__table__.c)
+    )
+    return sorted(result.all(), key=lambda row: row.id)
+
+
+async def complete_batch(db: AsyncSession, model, results: dict):
+    """Записывает итоги пачки {id записи: статус} - по одному UPDATE на статус."""
+    by_status = {}
+    for task_id, status in results.items():
+        by_status.setdefault(status, []).append(task_id)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for status, task_ids in by_status.items():
+        await db.execute(
+            update(model)
+            .where(model.id.in_(task_ids), model.status == 'processing')
+            .values(status=status, processed_at=now)
+        )
+
+
+async def requeue_stale(db: AsyncSession, model, in_flight_ids=()) -> int:
+    """
+    Возвращает в 'pending' записи, захваченные давно и так и не завершенные.
+    in_flight_ids - записи, которые вызывающий еще доставляет: им processed_at
+    продлевается, чтобы их не вернул в очередь ни этот, ни другой экземпляр бота.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if in_flight_ids:
+        await db.execute(
+            update(model)
+            .where(model.id.in_(list(in_flight_ids)), model.status == 'processing')
+            .values(processed_at=now)
+        )
+    result = await db.execute(
+        update(model)
+        .where(model.status == 'processing', model.processed_at < now - QUEUE_CLAIM_STALE_AFTER)
+        .values(status='pending', processed_at=None)
+    )
+    if result.rowcount:
+        logger.warning(f"{model.__tablename__}: {result.rowcount} зависших записей возвращено в очередь.")
+    return result.rowcount
+
+
+# === КОНТЕКСТ ПАЧКИ ===
+
+def _context_query():
+    """Поля диалога, кандидата, вакансии и рекрутера, нужные для текста уведомления."""
+    return (
+        select(
+            Dialogue.id.label('dialogue_id'),
+            Dialogue.candidate_id,
+            Dialogue.hh_response_id,
+            Dialogue.response_created_at,
+            Candidate.hh_resume_id,
+            Candidate.full_name,
+            Candidate.age,
+            Candidate.citizenship,
+            Candidate.phone_number,
+            Vacancy.title.label('vacancy_title'),
+            Vacancy.city.label('vacancy_city'),
+            TrackedRecruiter.id.label('tracked_recruiter_id'),
+            TrackedRecruiter.name.label('recruiter_name'),
+            TrackedRecruiter.telegram_chat_id,
+            TrackedRecruiter.topic_qualified_id,
+            TrackedRecruiter.topic_rejected_id,
+            TrackedRecruiter.topic_timeout_id,
+        )
+        .join(Candidate, Candidate.id == Dialogue.candidate_id)
+        .outerjoin(Vacancy, Vacancy.id == Dialogue.vacancy_id)
+        .outerjoin(TrackedRecruiter, TrackedRecruiter.id == Dialogue.recruiter_id)
+    )
+
+
+async def load_task_contexts(db: AsyncSession, model, tasks: list) -> dict:
+    """
+    {id записи очереди: строка контекста или None}. Для notification_queue берется
+    самый свежий по last_updated диалог кандидата (DISTINCT ON), для очередей
+    молчунов и отказов - диалог записи.
+    """
+    if model is NotificationQueue:
+        candidate_ids = {task.candidate_id for task in tasks}
+        result = await db.execute(
+            _context_query()
+            .where(Dialogue.candidate_id.in_(candidate_ids))
+            .distinct(Dialogue.candidate_id)
+            .order_by(Dialogue.candidate_id, Dialogue.last_updated.desc().nulls_last(), Dialogue.id.desc())
+        )
+        by_candidate = {row.candidate_id: row for row in result}
+        return {task.id: by_candidate.get(task.candidate_id) for task in tasks}
+
+    dialogue_ids = {task.dialogue_id for task in tasks}
+    result = await db.execute(_context_query().where(Dialogue.id.in_(dialogue_ids)))
+    by_dialogue = {row.dialogue_id: row for row in result}
+    return {task.id: by_dialogue.get(task.dialogue_id) for task in tasks}
+
+
+# === ОЖИДАНИЕ НОВЫХ ЗАПИСЕЙ (LISTEN) ===
+
+async def wait_for_enqueue(model, timeout: float = QUEUE_FALLBACK_SWEEP_SECONDS) -> bool:
+    """Ждет уведомления о новой записи в очереди model. False - вышел таймаут (пора делать резервный проход)."""
+    queue_event = _queue_events[model.__tablename__]
+    try:
+        await asyncio.wait_for(queue_event.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        queue_event.clear()
+
+
+def _on_notify(connection, pid, channel, payload):
+    queue_event = _queue_events.get(payload)
+    if queue_event is not None:
+        queue_event.set()
+
+
+async def _listen_loop():
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(
+                user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT, database=DB_NAME
+            )
+            await connection.add_listener(QUEUE_CHANNEL, _on_notify)
+            # Пока не слушали, могли пропустить уведомления - будим все очереди
+            for queue_event in _queue_events.values():
+                queue_event.set()
+            logger.info(f"Очереди уведомлений: подписка на канал {QUEUE_CHANNEL} активна.")
+            while not connection.is_closed():
+                await asyncio.sleep(QUEUE_LISTEN_RETRY_SECONDS)
+            logger.warning("Очереди уведомлений: соединение LISTEN закрыто, переподключаюсь...")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Очереди уведомлений: ошибка подписки на {QUEUE_CHANNEL}: {e}")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        # Без подписки очереди обслуживаются резервным опросом
+        await asyncio.sleep(QUEUE_LISTEN_RETRY_SECONDS)
+
+
+def start_queue_listener():
+    global _listener_task
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.create_task(_listen_loop())
+    return _listener_task
+
+
+async def stop_queue_listener():
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
@@ -1,44 +1,127 @@
-import datetime # ИЗМЕНЕНИЕ: Уточнен импорт datetime, чтобы не полагаться на from datetime import date
-# ИЗМЕНЕНИЕ: Замена Session на AsyncSession
+# hr_bot/db/statistics_manager.py
+"""
+Дневная статистика вакансий (таблица statistics) с буферизацией в памяти.
+
+Раньше каждое увеличение счетчика делало SELECT + INSERT/flush внутри транзакции
+диалога, а два параллельных диалога одной вакансии могли создать две строки
+за один день. Теперь:
+  - на (vacancy_id, date) есть уникальное ограничение (миграция 0003);
+  - record_stats только запоминает приращение; после commit сессии оно
+    переходит в общий буфер (при rollback - отбрасывается, как и раньше);
+  - буфер сбрасывается раз в несколько секунд и при остановке воркера одним
+    INSERT ... ON CONFLICT (vacancy_id, date) DO UPDATE SET count = count + excluded.count.
+"""
+import asyncio
+import datetime
+import logging
+
+from sqlalchemy import event, func
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-# ИЗМЕНЕНИЕ: Добавлен импорт select для асинхронных запросов
-from sqlalchemy import select 
-from .models import Statistic
+from sqlalchemy.orm import Session
+
+from .models import SessionLocal, Statistic
+
+logger = logging.getLogger(__name__)
+
+STATS_FLUSH_INTERVAL_SECONDS = 5
+# Ключ в session.info для приращений, ожидающих commit
+_SESSION_INFO_KEY = "pending_stats"
+COUNTER_FIELDS = ("responses_count", "started_dialogs_count", "qualified_count")
+
+# (vacancy_id, date) -> [responses, started_dialogs, qualified]
+_stats_buffer = {}
+_flush_lock = asyncio.Lock()
+_stop_event = asyncio.Event()
+_flusher_task = None
 
-# ИЗМЕНЕНИЕ: Функция стала асинхронной и принимает AsyncSession
-async def update_stats(db: AsyncSession, vacancy_id: int, responses: int = 0, started_dialogs: int = 0, qualified: int = 0):
+
+def _merge(target: dict, key: tuple, deltas):
+    row = target.setdefault(key, [0, 0, 0])
+    for i, delta in enumerate(deltas):
+        row[i] += delta
+
+
+def record_stats(db: AsyncSession, vacancy_id: int, responses: int = 0, started_dialogs: int = 0, qualified: int = 0):
     """
-    Находит или создает запись о статистике за сегодняшний день для вакансии
-    и инкрементирует нужные счетчики.
+    Увеличивает счетчики вакансии за сегодня. Без обращения к БД: приращение
+    попадет в буфер после commit сессии db и будет записано фоновым сбросом.
     """
-    today = datetime.date.today() # ИЗМЕНЕНИЕ: Использование datetime.date
-
-    # Ищем запись статистики для этой вакансии за сегодня
-    # ИЗМЕНЕНИЕ: Асинхронный запрос к БД (изменен синтаксис)
-    result = await db.execute(
-        select(Statistic).filter(
-            Statistic.vacancy_id == vacancy_id,
-            Statistic.date == today
-        )
-    )
-    stats_record = result.scalar_one_or_none() # ИЗМЕНЕНИЕ: Получение скалярного результата
-
-    # Если записи нет, создаем ее
-    if not stats_record:
-        stats_record = Statistic(
-            vacancy_id=vacancy_id,
-            date=today
-        )
-        db.add(stats_record) # add сам по себе не awaitable
-        # ИЗМЕНЕНИЕ: Асинхронный flush
-        await db.flush() 
-
-    # Инкрементируем счетчики
-    stats_record.responses_count += responses
-    stats_record.started_dialogs_count += started_dialogs
-    stats_record.qualified_count += qualified
-
-    # В этой функции нет commit(), предполагается, что он будет выполнен выше по стеку вызовов
-    # (например, в _process_single_dialogue), что является хорошей практикой для "единицы работы".
-    
-    print(f"  > Статистика для вакансии {vacancy_id} обновлена: +{responses} откликов, +{started_dialogs} диалогов, +{qualified} квалифицировано.")
\ No newline at end of file
+    if not vacancy_id or not (responses or started_dialogs or qualified):
+        return
+    pending = db.info.setdefault(_SESSION_INFO_KEY, {})
+    _merge(pending, (vacancy_id, datetime.date.today()), (responses, started_dialogs, qualified))
+
+
+@event.listens_for(Session, "after_commit")
+def _move_to_buffer_on_commit(session):
+    pending = session.info.pop(_SESSION_INFO_KEY, None)
+    if pending:
+        for key, deltas in pending.items():
+            _merge(_stats_buffer, key, deltas)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
+
+
+async def flush_stats():
+    """Записывает накопленные приращения одним UPSERT."""
+    async with _flush_lock:
+        if not _stats_buffer:
+            return
+        # Сортировка по ключу - строки блокируются в одном порядке
+        rows = [
+            {"vacancy_id": vacancy_id, "date": day, **dict(zip(COUNTER_FIELDS, deltas))}
+            for (vacancy_id, day), deltas in sorted(_stats_buffer.items())
+        ]
+        snapshot = dict(_stats_buffer)
+        _stats_buffer.clear()
+
+        try:
+            statement = insert(Statistic).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[Statistic.vacancy_id, Statistic.date],
+                set_={
+                    field: func.coalesce(getattr(Statistic, field), 0) + getattr(statement.excluded, field)
+                    for field in COUNTER_FIELDS
+                },
+            )
+            async with SessionLocal() as session:
+                await session.execute(statement)
+                await session.commit()
+            logger.debug(f"Статистика: записано {len(rows)} строк (вакансия, день).")
+        except Exception as e:
+            logger.error(f"Ошибка записи статистики ({len(rows)} строк), вернем в буфер: {e}", exc_info=True)
+            for key, deltas in snapshot.items():
+                _merge(_stats_buffer, key, deltas)
+
+
+async def _flusher_loop():
+    while not _stop_event.is_set():
+        try:
+            await asyncio.wait_for(_stop_event.wait(), timeout=STATS_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        await flush_stats()
+
+
+def start_stats_flusher():
+    """Запускает фоновый сброс статистики (вызывать из работающего event loop)."""
+    global _flusher_task
+    _stop_event.clear()
+    if _flusher_task is None or _flusher_task.done():
+        _flusher_task = asyncio.create_task(_flusher_loop())
+    return _flusher_task
+
+
+async def stop_stats_flusher():
+    """Останавливает фоновый сброс и записывает остаток буфера."""
+    global _flusher_task
+    # Не отменяем задачу, чтобы не оборвать запись посередине - просим ее завершиться
+    _stop_event.set()
+    if _flusher_task is not None:
+        await _flusher_task
+        _flusher_task = None
+    await flush_stats()
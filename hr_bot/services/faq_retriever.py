@@ -0,0 +1,121 @@
+# hr_bot/services/faq_retriever.py
+"""
+Лексический поиск по FAQ вместо вставки всего блока #FAQ# в промпт.
+
+Записи FAQ (prompt_library['faq_entries'], см. knowledge_base._parse_faq_entries)
+индексируются BM25 один раз на версию библиотеки. Слова приводятся к "псевдоосновам"
+(первые FAQ_STEM_LENGTH букв), чтобы "график", "графику", "графиком" совпадали.
+В промпт попадают top-k записей, релевантных входящим сообщениям кандидата.
+Если уверенности нет (нет вопроса, слабое совпадение, FAQ маленький) -
+возвращается весь блок, как раньше.
+"""
+import os
+import re
+import math
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+FAQ_RETRIEVAL_ENABLED = os.getenv("FAQ_RETRIEVAL_ENABLED", "true").lower() in ("1", "true", "yes")
+FAQ_TOP_K = 4
+# Минимальный BM25-score лучшей записи, ниже - отдаем весь FAQ
+FAQ_MIN_SCORE = 2.0
+# FAQ меньше стольких записей нет смысла резать
+FAQ_MIN_ENTRIES_FOR_RETRIEVAL = 8
+FAQ_STEM_LENGTH = 5
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+WORD_PATTERN = re.compile(r"[a-zа-я0-9]+")
+STOP_WORDS = frozenset({
+    'и', 'в', 'во', 'на', 'не', 'что', 'как', 'а', 'но', 'или', 'по', 'к', 'ко', 'у', 'о', 'об',
+    'за', 'из', 'с', 'со', 'от', 'до', 'для', 'же', 'ли', 'бы', 'то', 'это', 'так', 'там', 'тут',
+    'я', 'мы', 'вы', 'вам', 'вас', 'мне', 'меня', 'он', 'она', 'они', 'его', 'ее', 'их',
+    'есть', 'быть', 'будет', 'был', 'была', 'да', 'нет', 'ну', 'уже', 'еще', 'ещё', 'можно',
+    'здравствуйте', 'добрый', 'день', 'спасибо', 'пожалуйста', 'хорошо', 'подскажите',
+})
+
+# Индекс текущей версии библиотеки
+_index = None
+
+
+def _tokenize(text: str) -> list:
+    words = WORD_PATTERN.findall((text or "").lower().replace("ё", "е"))
+    return [word[:FAQ_STEM_LENGTH] for word in words if len(word) > 1 and word not in STOP_WORDS]
+
+
+class _FaqIndex:
+    """BM25-индекс записей FAQ одной версии библиотеки."""
+
+    def __init__(self, version, entries: list):
+        self.version = version
+        self.entries = entries
+        self.term_frequencies = [Counter(_tokenize(entry)) for entry in entries]
+        self.lengths = [sum(tf.values()) for tf in self.term_frequencies]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+
+        document_frequency = Counter()
+        for tf in self.term_frequencies:
+            document_frequency.update(tf.keys())
+        total = len(entries)
+        self.idf = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def score(self, query_terms: set) -> list:
+        """Список (score, номер записи) по убыванию score."""
+        scores = []
+        for entry_index, tf in enumerate(self.term_frequencies):
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[entry_index] / (self.average_length or 1))
+            score = 0.0
+            for term in query_terms:
+                frequency = tf.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+            if score > 0:
+                scores.append((score, entry_index))
+        scores.sort(key=lambda item: (-item[0], item[1]))
+        return scores
+
+
+def _get_index(prompt_library: dict):
+    global _index
+    entries = prompt_library.get("faq_entries")
+    if not entries:
+        return None
+    version = prompt_library.get("version") or id(entries)
+    if _index is None or _index.version != version:
+        _index = _FaqIndex(version, entries)
+        logger.debug(f"Индекс FAQ перестроен: версия {version}, записей {len(entries)}")
+    return _index
+
+
+def select_faq(prompt_library: dict, user_message: str) -> str:
+    """
+    Текст FAQ для промпта: top-k релевантных записей (в порядке документа)
+    или весь блок #FAQ#, если поиск не уверен.
+    """
+    full_faq = prompt_library.get('#FAQ#', '')
+    if not FAQ_RETRIEVAL_ENABLED:
+        return full_faq
+
+    index = _get_index(prompt_library)
+    if index is None or len(index.entries) < FAQ_MIN_ENTRIES_FOR_RETRIEVAL:
+        return full_faq
+
+    query_terms = set(_tokenize(user_message))
+    if not query_terms:
+        return full_faq
+
+    ranked = index.score(query_terms)
+    if not ranked or ranked[0][0] < FAQ_MIN_SCORE:
+        return full_faq
+
+    top_entries = sorted(entry_index for _, entry_index in ranked[:FAQ_TOP_K])
+    logger.debug(
+        f"FAQ: выбрано {len(top_entries)} из {len(index.entries)} записей (лучший score {ranked[0][0]:.2f})."
+    )
+    return "\n\n".join(index.entries[entry_index] for entry_index in top_entries)
@@ -0,0 +1,153 @@
+# hr_bot/services/funnel_report.py
+"""
+Excel-отчет по воронке за период (кнопка "Выгрузка" в Telegram).
+
+Данные - из дневной воронки (daily_funnel_rollups): SQL уже агрегирует счетчики
+по Дата | Рекрутер | Город | Вакансия. Строки читаются серверным курсором
+порциями и сразу пишутся в xlsxwriter в режиме constant_memory (строка за строкой
+во временный файл), сводные листы копят только суммы по ключам. Память не зависит
+от длины периода. build_report синхронный - из бота вызывается build_report_async,
+который выполняет его в отдельном небольшом пуле потоков (не в event loop).
+"""
+import os
+import asyncio
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import xlsxwriter
+
+from hr_bot.db.models import SyncSessionLocal
+from hr_bot.db import funnel_rollups
+
+logger = logging.getLogger(__name__)
+
+REPORT_FETCH_BATCH_SIZE = 500
+# Одновременно строится не больше REPORT_MAX_WORKERS отчетов (каждый держит соединение синхронного пула)
+REPORT_MAX_WORKERS = 2
+
+_report_executor = ThreadPoolExecutor(max_workers=REPORT_MAX_WORKERS, thread_name_prefix="excel_report")
+
+COUNTER_HEADERS = [
+    "Отклики", "Не вступили", "Начали диалог", "Собес",
+    "Отказался КД", "Отказали мы", "Молчуны", "Отказы всего",
+]
+CONVERSION_HEADERS = ["Собес/отклик %", "Молчуны/Диалог %", "Отказы/Диалог %"]
+
+# (название листа, заголовок колонки, номер поля ключа строки: 0 - дата, 1 - рекрутер, 2 - город, 3 - вакансия)
+SUMMARY_SHEETS = [
+    ("Свод по датам", "Дата", 0),
+    ("Свод по рекрутерам", "Рекрутер", 1),
+    ("Свод по городам", "Город", 2),
+    ("Свод по вакансиям", "Вакансия", 3),
+]
+BASE_SHEET = ("Общий отчет", ["Дата", "Рекрутер", "Город", "Вакансия"])
+
+
+def _counters(row) -> list:
+    """Счетчики строки воронки в порядке COUNTER_HEADERS (математика отчета)."""
+    responses = row.responses_count or 0
+    started = row.started_count or 0
+    declined_by_candidate = row.declined_by_candidate_count or 0
+    declined_by_us = row.declined_by_us_count or 0
+    return [
+        responses,
+        responses - started,             # Не вступили
+        started,
+        row.qualified_count or 0,        # Собес
+        declined_by_candidate,           # Отказался КД
+        declined_by_us,                  # Отказали мы
+        row.silent_started_count or 0,   # Молчуны: начали диалог, не завершили и замолчали
+        declined_by_candidate + declined_by_us,
+    ]
+
+
+def _conversions(counters: list, is_total: bool) -> list:
+    responses, _, started, qualified, _, _, silent, declined_total = counters
+    if is_total:
+        # Для строки ИТОГО нулевой знаменатель заменяется единицей
+        responses, started = responses or 1, started or 1
+    return [
+        qualified / responses if responses else 0,
+        silent / started if started else 0,
+        declined_total / started if started else 0,
+    ]
+
+
+def _format_key(value) -> str:
+    return value.strftime("%d.%m.%Y") if isinstance(value, datetime.date) else value
+
+
+def build_report(start_date: datetime.date, end_date: datetime.date, file_path: str) -> bool:
+    """
+    Пишет отчет в file_path. Возвращает False, если за период нет данных (файл удаляется).
+    """
+    workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True})
+    header_fmt = workbook.add_format({'bold': True, 'bg_color': '#D9EAD3', 'border': 1})
+    num_fmt = workbook.add_format({'border': 1})
+    perc_fmt = workbook.add_format({'num_format': '0%', 'border': 1})
+    total_fmt = workbook.add_format({'bold': True, 'bg_color': '#F4CCCC', 'border': 1})
+    total_perc_fmt = workbook.add_format({'bold': True, 'bg_color': '#F4CCCC', 'border': 1, 'num_format': '0%'})
+
+    # Листы создаются в порядке отображения; в constant_memory каждый лист пишется
+    # независимо, поэтому сводные заполняются после потоковой записи "Общего отчета"
+    summary_worksheets = []
+    for sheet_name, group_header, _ in SUMMARY_SHEETS:
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.set_column(0, len(COUNTER_HEADERS), 15, num_fmt)
+        worksheet.set_column(len(COUNTER_HEADERS) + 1, len(COUNTER_HEADERS) + len(CONVERSION_HEADERS), 18, perc_fmt)
+        worksheet.write_row(0, 0, [group_header, *COUNTER_HEADERS, *CONVERSION_HEADERS], header_fmt)
+        summary_worksheets.append(worksheet)
+
+    base_name, base_key_headers = BASE_SHEET
+    base_worksheet = workbook.add_worksheet(base_name)
+    base_worksheet.set_column(0, len(base_key_headers) + len(COUNTER_HEADERS) - 1, 15, num_fmt)
+    base_worksheet.write_row(0, 0, [*base_key_headers, *COUNTER_HEADERS], header_fmt)
+
+    # Ключ сводного листа -> суммы счетчиков
+    summaries = [{} for _ in SUMMARY_SHEETS]
+    row_count = 0
+
+    with SyncSessionLocal() as db:
+        result = db.execute(
+            funnel_rollups.report_rows_query(start_date, end_date)
+            .execution_options(stream_results=True, yield_per=REPORT_FETCH_BATCH_SIZE)
+        )
+        for row in result:
+            key = (row.date, row.recruiter, row.city, row.vacancy)
+            counters = _counters(row)
+            row_count += 1
+            base_worksheet.write_row(row_count, 0, [_format_key(row.date), *key[1:], *counters])
+
+            for summary, (_, _, key_index) in zip(summaries, SUMMARY_SHEETS):
+                totals = summary.setdefault(key[key_index], [0] * len(COUNTER_HEADERS))
+                for i, value in enumerate(counters):
+                    totals[i] += value
+
+    if row_count == 0:
+        workbook.close()
+        os.remove(file_path)
+        return False
+
+    for worksheet, summary in zip(summary_worksheets, summaries):
+        grand_total = [0] * len(COUNTER_HEADERS)
+        row_index = 0
+        for key in sorted(summary):
+            counters = summary[key]
+            row_index += 1
+            worksheet.write_row(row_index, 0, [_format_key(key), *counters, *_conversions(counters, is_total=False)])
+            for i, value in enumerate(counters):
+                grand_total[i] += value
+        row_index += 1
+        worksheet.write_row(row_index, 0, ['ИТОГО', *grand_total], total_fmt)
+        worksheet.write_row(row_index, len(grand_total) + 1, _conversions(grand_total, is_total=True), total_perc_fmt)
+
+    workbook.close()
+    logger.info(f"Excel-отчет {start_date} - {end_date}: {row_count} строк.")
+    return True
+
+
+async def build_report_async(start_date: datetime.date, end_date: datetime.date, file_path: str) -> bool:
+    """build_report в отдельном пуле потоков - event loop бота не блокируется."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_report_executor, build_report, start_date, end_date, file_path)
@@ -1,9 +1,12 @@
 import time
+import json
+import asyncio
+import hashlib
 import logging
 import re
 import os
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+
+from hr_bot.services.prompt_sources import GoogleDocPromptSource, LocalPromptSource
 
 # Настройка простого логгера для запуска этого файла отдельно
 if __name__ == '__main__':
@@ -15,9 +18,17 @@ DOCUMENT_ID = '1rVenA2akaMaoMYLj7GAxZxlqwZS0X3j0NlZtsBSNp_8'
 SCOPES = ['https://www.googleapis.com/auth/documents.readonly']
 SERVICE_ACCOUNT_FILE = 'credentials.json' # Убедись, что файл лежит в корне проекта, откуда запускаешь скрипт
 CACHE_TTL_SECONDS = 120
+# Источник библиотеки: 'google' (по умолчанию) или 'local' (файл/каталог PROMPT_SOURCE_PATH)
+PROMPT_SOURCE = os.getenv('PROMPT_SOURCE', 'google').lower()
+PROMPT_SOURCE_PATH = os.getenv('PROMPT_SOURCE_PATH', 'prompts')
+# Последняя удачная версия библиотеки на диске - на случай холодного старта при недоступном источнике
+SNAPSHOT_FILE = os.getenv('PROMPT_LIBRARY_SNAPSHOT', 'prompt_library_snapshot.json')
+
+EMERGENCY_PROMPT_LIBRARY = {"#ROLE_AND_STYLE#": "Ты - Hr компании ВкусВилл.", "vacancies": [], "version": "emergency"}
 
 _cached_prompt_library = None
 _cache_timestamp = 0
+_refresher_task = None
 
 def _parse_vacancies(vacancies_raw_text: str) -> list:
     """
@@ -70,77 +81,222 @@ def _parse_vacancies(vacancies_raw_text: str) -> list:
         })
     return vacancies_list
 
-def get_prompt_library():
+def _parse_faq_entries(faq_raw_text: str) -> list:
     """
-    Читает Google Doc, парсит его в библиотеку блоков {marker: text}
-    и кэширует результат.
+    Делит блок #FAQ# на отдельные записи "вопрос + ответ" (по пустым строкам).
+    Короткая строка-вопрос, отделенная от ответа пустой строкой, склеивается с ответом.
+    """
+    paragraphs = [p.strip() for p in re.split(r'\n\s*\n', faq_raw_text or '') if p.strip()]
+
+    entries = []
+    pending_question = None
+    for paragraph in paragraphs:
+        if pending_question:
+            paragraph = pending_question + '\n' + paragraph
+            pending_question = None
+        if '\n' not in paragraph and paragraph.endswith('?'):
+            pending_question = paragraph
+            continue
+        entries.append(paragraph)
+    if pending_question:
+        entries.append(pending_question)
+    return entries
+
+def _parse_prompt_library(full_text: str) -> dict:
+    """Парсит текст документа в библиотеку блоков {marker: text} + список вакансий."""
+    prompt_library = {}
+    # Находим все маркеры вида #WORD#
+    markers = re.findall(r"(#\w+#)", full_text)
+    # Разделяем текст по этим маркерам
+    parts = re.split(r"(#\w+#)", full_text)
+
+    current_marker = None
+    for part in parts:
+        if not part.strip():
+            continue
+        if part in markers:
+            current_marker = part
+        elif current_marker:
+            prompt_library[current_marker] = part.strip()
+            current_marker = None
+    
+    # Отдельно обрабатываем вакансии
+    if '#START_VACANCIES#' in prompt_library:
+        vacancies_raw = prompt_library.pop('#START_VACANCIES#')
+        vacancies_raw = vacancies_raw.replace('#END_VACANCIES#', '')
+        prompt_library['vacancies'] = _parse_vacancies(vacancies_raw)
+    else:
+        prompt_library['vacancies'] = []
+
+    # FAQ разбиваем на записи сразу при загрузке - по ним строится поисковый индекс (faq_retriever)
+    prompt_library['faq_entries'] = _parse_faq_entries(prompt_library.get('#FAQ#', ''))
+
+    # Версия = хэш содержимого документа: по ней кэши (индексы вакансий, промпты) понимают, что библиотека сменилась
+    prompt_library['version'] = _content_version(full_text)
+    return prompt_library
+
+
+def _content_version(full_text: str) -> str:
+    return hashlib.sha256(full_text.encode('utf-8')).hexdigest()[:16]
+
+
+def _create_prompt_source():
+    if PROMPT_SOURCE == 'local':
+        logger.info(f"Библиотека промптов читается из локального источника: {PROMPT_SOURCE_PATH}")
+        return LocalPromptSource(PROMPT_SOURCE_PATH)
+    return GoogleDocPromptSource(DOCUMENT_ID, SERVICE_ACCOUNT_FILE, SCOPES)
+
+
+_prompt_source = _create_prompt_source()
+
+
+def _save_snapshot(prompt_library: dict):
+    """Атомарно сохраняет последнюю удачную версию библиотеки на диск (tmp + os.replace)."""
+    tmp_path = f"{SNAPSHOT_FILE}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(prompt_library, f, ensure_ascii=False)
+        os.replace(tmp_path, SNAPSHOT_FILE)
+    except OSError as e:
+        logger.error(f"Не удалось сохранить снимок библиотеки промптов в {SNAPSHOT_FILE}: {e}")
+
+
+def _load_snapshot():
+    """Читает снимок библиотеки с диска. None, если снимка нет или он поврежден."""
+    if not os.path.exists(SNAPSHOT_FILE):
+        return None
+    try:
+        with open(SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            prompt_library = json.load(f)
+        logger.warning(f"Библиотека промптов загружена из локального снимка {SNAPSHOT_FILE} (версия {prompt_library.get('version')}).")
+        return prompt_library
+    except (OSError, ValueError) as e:
+        logger.error(f"Снимок библиотеки промптов {SNAPSHOT_FILE} не прочитан: {e}")
+        return None
+
+
+def _load_from_source():
+    """
+    Синхронная загрузка + парсинг + снимок на диск. Бросает исключение при ошибке.
+    Возвращает None, если содержимое не изменилось (повторный парсинг не нужен).
     """
+    if _cached_prompt_library and not _prompt_source.has_changed():
+        return None
+
+    full_text = _prompt_source.load_text()
+    if _cached_prompt_library and _cached_prompt_library.get('version') == _content_version(full_text):
+        return None
+
+    prompt_library = _parse_prompt_library(full_text)
+    _save_snapshot(prompt_library)
+    return prompt_library
+
+
+def _set_current_library(prompt_library: dict):
     global _cached_prompt_library, _cache_timestamp
+    previous_version = (_cached_prompt_library or {}).get('version')
+    # Подмена ссылки атомарна: читатели видят либо старую, либо новую версию целиком
+    _cached_prompt_library = prompt_library
+    _cache_timestamp = time.time()
+    if previous_version != prompt_library.get('version'):
+        logger.info(f"Библиотека промптов обновлена: версия {prompt_library.get('version')}, блоков: {len(prompt_library)}")
 
-    if _cached_prompt_library and (time.time() - _cache_timestamp < CACHE_TTL_SECONDS):
+
+def get_current_prompt_library() -> dict:
+    """
+    Мгновенно возвращает текущую версию библиотеки, не обращаясь к Google.
+    Если фоновая загрузка еще не прошла - берет снимок с диска, в крайнем случае - аварийный фолбэк.
+    """
+    if _cached_prompt_library:
         return _cached_prompt_library
 
-    logger.debug("Кэш библиотеки промптов устарел, обновляю и парсю из Google Docs...")
-    try:
-        # Проверка наличия файла с ключами
-        if not os.path.exists(SERVICE_ACCOUNT_FILE):
-             logger.error(f"Файл ключей {SERVICE_ACCOUNT_FILE} не найден! Убедитесь, что запускаете скрипт из корня проекта.")
-             return {}
+    snapshot = _load_snapshot()
+    if snapshot:
+        _set_current_library(snapshot)
+        return snapshot
 
-        creds = Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-        service = build('docs', 'v1', credentials=creds)
+    # Аварийный фолбэк
+    return EMERGENCY_PROMPT_LIBRARY
 
-        document = service.documents().get(documentId=DOCUMENT_ID).execute()
-        content = document.get('body').get('content')
-        
-        full_text = ''
-        for value in content:
-            if 'paragraph' in value:
-                elements = value.get('paragraph').get('elements')
-                for elem in elements:
-                    full_text += elem.get('textRun', {}).get('content', '')
-
-        # Парсинг блоков
-        prompt_library = {}
-        # Находим все маркеры вида #WORD#
-        markers = re.findall(r"(#\w+#)", full_text)
-        # Разделяем текст по этим маркерам
-        parts = re.split(r"(#\w+#)", full_text)
-
-        current_marker = None
-        for part in parts:
-            if not part.strip():
-                continue
-            if part in markers:
-                current_marker = part
-            elif current_marker:
-                prompt_library[current_marker] = part.strip()
-                current_marker = None
-        
-        # Отдельно обрабатываем вакансии
-        if '#START_VACANCIES#' in prompt_library:
-            vacancies_raw = prompt_library.pop('#START_VACANCIES#')
-            vacancies_raw = vacancies_raw.replace('#END_VACANCIES#', '')
-            prompt_library['vacancies'] = _parse_vacancies(vacancies_raw)
-        else:
-            prompt_library['vacancies'] = []
-
-        logger.info(f"Библиотека промптов успешно загружена. Найдено блоков: {len(prompt_library)}")
-        
-        _cached_prompt_library = prompt_library
+
+async def refresh_prompt_library() -> bool:
+    """Загружает библиотеку в отдельном потоке и подменяет текущую версию. Старая версия остается при ошибке."""
+    global _cache_timestamp
+    try:
+        prompt_library = await asyncio.to_thread(_load_from_source)
+    except Exception as e:
+        logger.error(f"ОШИБКА при чтении и парсинге библиотеки ({_prompt_source.name}): {e}", exc_info=True)
+        if _cached_prompt_library:
+            logger.warning("Продолжаю работать со старой версией библиотеки.")
+        return False
+    if prompt_library is None:
+        # Содержимое не изменилось - текущая версия остается
         _cache_timestamp = time.time()
-        
+        return True
+    _set_current_library(prompt_library)
+    return True
+
+
+async def _refresher_loop(interval_seconds: int):
+    while True:
+        await asyncio.sleep(interval_seconds)
+        await refresh_prompt_library()
+
+
+async def start_prompt_library_refresher(interval_seconds: int = None):
+    """
+    Первая загрузка + запуск фонового обновления (вызывать из работающего event loop).
+    Если источник недоступен при старте, сразу поднимается снимок с диска.
+    Интервал по умолчанию зависит от источника (локальные файлы проверяются часто - это дешево).
+    """
+    global _refresher_task
+    interval_seconds = interval_seconds or _prompt_source.refresh_interval_seconds
+    if not await refresh_prompt_library():
+        get_current_prompt_library()
+    if _refresher_task is None or _refresher_task.done():
+        _refresher_task = asyncio.create_task(_refresher_loop(interval_seconds))
+        logger.info(f"Фоновое обновление библиотеки промптов запущено (интервал {interval_seconds} сек.).")
+    return _refresher_task
+
+
+async def stop_prompt_library_refresher():
+    """Останавливает фоновое обновление библиотеки."""
+    global _refresher_task
+    if _refresher_task is not None:
+        _refresher_task.cancel()
+        try:
+            await _refresher_task
+        except asyncio.CancelledError:
+            pass
+        _refresher_task = None
+
+
+def get_prompt_library():
+    """
+    Читает источник (Google Doc или локальные файлы), парсит его в библиотеку блоков {marker: text}
+    и кэширует результат.
+    Синхронная версия (блокирует вызывающий поток) - для скриптов и отладки.
+    В асинхронном коде используйте get_current_prompt_library() + start_prompt_library_refresher().
+    """
+    global _cache_timestamp
+    if _cached_prompt_library and (time.time() - _cache_timestamp < CACHE_TTL_SECONDS):
+        return _cached_prompt_library
+
+    logger.debug(f"Кэш библиотеки промптов устарел, обновляю из источника ({_prompt_source.name})...")
+    try:
+        prompt_library = _load_from_source()
+        if prompt_library is None:
+            _cache_timestamp = time.time()
+            return _cached_prompt_library
+        _set_current_library(prompt_library)
         return prompt_library
 
     except Exception as e:
-        logger.error(f"ОШИБКА при чтении и парсинге Google Doc: {e}", exc_info=True)
+        logger.error(f"ОШИБКА при чтении и парсинге библиотеки ({_prompt_source.name}): {e}", exc_info=True)
         if _cached_prompt_library:
             logger.warning("Возвращаю старую версию библиотеки из кэша.")
             return _cached_prompt_library
-        
-        # Аварийный фолбэк
-        return {"#ROLE_AND_STYLE#": "Ты - Hr компании ВкусВилл.", "vacancies": []}
+        return get_current_prompt_library()
 
 # === БЛОК ОТЛАДКИ (ЗАПУСТИТСЯ ТОЛЬКО ПРИ ПРЯМОМ ВЫЗОВЕ) ===
 if __name__ == '__main__':
@@ -1,25 +1,203 @@
 # hr_bot/services/llm_handler.py
 
 import os
-import json
+import re
+import time
 import logging
 import asyncio # <--- ДОБАВЛЕНО
+from collections import deque
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import httpx
-from openai import AsyncOpenAI, APITimeoutError # <--- ДОБАВЛЕНО APITimeoutError
-from tenacity import retry, stop_after_attempt, wait_exponential
+from openai import (
+    AsyncOpenAI,
+    APITimeoutError,
+    APIConnectionError,
+    APIStatusError,
+    RateLimitError,
+    InternalServerError,
+)
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception
 import datetime
+from hr_bot.services import llm_profiles
+from hr_bot.services import llm_response_validator
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-# --- ДОБАВЛЕНО: Глобальный семафор для LLM запросов ---
-# Определяет максимальное количество ОДНОВРЕМЕННЫХ запросов к OpenAI.
-# Начните с небольшого значения, например, 5-10, и постепенно увеличивайте,
-# если производительность позволяет и нет ошибок.
-MAX_CONCURRENT_LLM_REQUESTS = 40 # Например, 5 одновременных запросов
-LLM_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_LLM_REQUESTS)
+# --- АДАПТИВНОЕ ОГРАНИЧЕНИЕ ПАРАЛЛЕЛЬНОСТИ (AIMD) ---
+# Вместо фиксированного семафора лимит одновременных запросов подстраивается
+# под реальную пропускную способность OpenAI: растет на +1 после серии успешных
+# ответов и уменьшается вдвое при 429/таймаутах.
+MAX_CONCURRENT_LLM_REQUESTS = 40 # Верхняя граница лимита
+MIN_CONCURRENT_LLM_REQUESTS = 2
+INITIAL_CONCURRENT_LLM_REQUESTS = 20
+LLM_LIMIT_INCREASE_AFTER_SUCCESSES = 5 # Сколько успешных ответов подряд нужно для +1 к лимиту
+LLM_LIMIT_DECREASE_FACTOR = 0.5
+
+# Дедлайн одного запроса к LLM (включая ожидание ответа за прокси) задается в профиле;
+# это значение - максимальный дедлайн, под него настроен таймаут HTTP клиента
+LLM_CALL_TIMEOUT_SECONDS = 90
+# Если retry-after больше этого значения, ждать бессмысленно - отдаем ошибку наверх
+MAX_RETRY_AFTER_SECONDS = 60
+# Порог "почти исчерпанных" лимитов по заголовкам x-ratelimit-remaining-*
+RATE_LIMIT_REMAINING_REQUESTS_THRESHOLD = 2
+RATE_LIMIT_REMAINING_TOKENS_THRESHOLD = 5000
+
+
+def _parse_reset_duration(value) -> float:
+    """
+    Парсит длительность из заголовков OpenAI ('1s', '250ms', '6m0s', '1h2m3.5s') в секунды.
+    """
+    if not value:
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+
+    total = 0.0
+    for amount, unit in re.findall(r'([\d.]+)(ms|h|m|s)', str(value)):
+        amount = float(amount)
+        if unit == 'ms':
+            total += amount / 1000
+        elif unit == 'h':
+            total += amount * 3600
+        elif unit == 'm':
+            total += amount * 60
+        else:
+            total += amount
+    return total
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD-ограничитель параллельных запросов к LLM.
+    Дополнительно умеет "ставить на паузу" все новые запросы до указанного момента
+    (по retry-after или когда заголовки говорят, что лимиты почти исчерпаны).
+    """
+
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self._successes_in_row = 0
+        self._paused_until = 0.0
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self._acquire()
+        try:
+            yield
+        finally:
+            await self._release()
+
+    async def _acquire(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            async with self._condition:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                await self._condition.wait()
+
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self, headers=None):
+        """Аддитивное увеличение лимита + учет заголовков x-ratelimit-remaining-*."""
+        self._successes_in_row += 1
+        if self._successes_in_row >= LLM_LIMIT_INCREASE_AFTER_SUCCESSES and self.limit < self.max_limit:
+            self.limit += 1
+            self._successes_in_row = 0
+            logger.debug(f"LLM лимит параллельности увеличен до {self.limit}")
+        if headers is not None:
+            self._apply_rate_limit_headers(headers)
+
+    def on_overload(self, retry_after: float = 0.0):
+        """Мультипликативное уменьшение лимита при 429/таймаутах."""
+        self._successes_in_row = 0
+        new_limit = max(self.min_limit, int(self.limit * LLM_LIMIT_DECREASE_FACTOR))
+        if new_limit != self.limit:
+            logger.warning(f"LLM лимит параллельности уменьшен: {self.limit} -> {new_limit}")
+            self.limit = new_limit
+        if retry_after > 0:
+            self.pause_for(retry_after)
+
+    def pause_for(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _apply_rate_limit_headers(self, headers):
+        remaining_requests = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+        try:
+            if remaining_requests is not None and int(remaining_requests) <= RATE_LIMIT_REMAINING_REQUESTS_THRESHOLD:
+                reset = _parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+                logger.warning(f"OpenAI: осталось {remaining_requests} запросов, пауза {reset:.1f} сек.")
+                self.pause_for(reset)
+            if remaining_tokens is not None and int(remaining_tokens) <= RATE_LIMIT_REMAINING_TOKENS_THRESHOLD:
+                reset = _parse_reset_duration(headers.get('x-ratelimit-reset-tokens'))
+                logger.warning(f"OpenAI: осталось {remaining_tokens} токенов, пауза {reset:.1f} сек.")
+                self.pause_for(reset)
+        except (TypeError, ValueError):
+            pass
+
+
+LLM_LIMITER = AdaptiveConcurrencyLimiter(
+    initial_limit=INITIAL_CONCURRENT_LLM_REQUESTS,
+    min_limit=MIN_CONCURRENT_LLM_REQUESTS,
+    max_limit=MAX_CONCURRENT_LLM_REQUESTS,
+)
 # ---------------------------------------------------
 
+
+def _retry_after_from_exception(exc: BaseException) -> float:
+    """Достает retry-after (в секундах) из ответа OpenAI, если он есть."""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return 0.0
+    headers = response.headers
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    return _parse_reset_duration(headers.get('retry-after'))
+
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    """
+    Классификация ошибок: повторяем только то, что может исправить ожидание
+    (429, таймауты, обрыв соединения, 5xx). Битый JSON, 400, 401 и т.п. - не повторяем.
+    """
+    if isinstance(exc, RateLimitError):
+        return _retry_after_from_exception(exc) <= MAX_RETRY_AFTER_SECONDS
+    if isinstance(exc, (APITimeoutError, APIConnectionError, InternalServerError, asyncio.TimeoutError)):
+        return True
+    if isinstance(exc, APIStatusError):
+        return exc.status_code >= 500
+    return False
+
+
+_default_llm_wait = wait_exponential(multiplier=1, min=4, max=10)
+
+
+def _wait_for_llm_retry(retry_state) -> float:
+    """Ждем столько, сколько попросил сервер (retry-after), иначе - экспоненциально."""
+    exc = retry_state.outcome.exception() if retry_state.outcome else None
+    retry_after = _retry_after_from_exception(exc) if exc else 0.0
+    if retry_after > 0:
+        return retry_after
+    return _default_llm_wait(retry_state)
+
+
 # Загружаем настройки прокси из .env
 SQUID_PROXY_HOST = os.getenv("SQUID_PROXY_HOST")
 SQUID_PROXY_PORT = os.getenv("SQUID_PROXY_PORT")
@@ -33,31 +211,175 @@ proxy_url = (
 )
 
 # Создаем асинхронный HTTP клиент с настройками прокси
+# Таймаут клиента - страховка; основной дедлайн задается LLM_CALL_TIMEOUT_SECONDS
 async_http_client = httpx.AsyncClient(
     proxy=proxy_url,
-    timeout=600.0
+    timeout=httpx.Timeout(LLM_CALL_TIMEOUT_SECONDS + 30, connect=15.0)
 )
 
 # Создаем АСИНХРОННЫЙ OpenAI клиент и передаем ему наш HTTP клиент
 client = AsyncOpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
-    http_client=async_http_client
+    http_client=async_http_client,
+    max_retries=0 # Повторы делает tenacity по нашей политике, а не SDK
 )
 
 logger.info(f"Клиент OpenAI настроен на работу через прокси: {SQUID_PROXY_HOST}:{SQUID_PROXY_PORT}")
 
 
+# --- ХЕДЖИРОВАНИЕ ЗАПРОСОВ ---
+# Если ответ не пришел за время, превышающее перцентиль недавних задержек
+# (по модели и состоянию диалога), запускаем второй такой же запрос.
+# Побеждает первый ответ, второй запрос отменяется.
+LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "true").lower() == "true"
+HEDGE_LATENCY_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20 # Пока статистики мало - не хеджируем
+HEDGE_LATENCY_WINDOW = 200 # Сколько последних задержек хранить на ключ
+HEDGE_MIN_DELAY_SECONDS = 3.0
+HEDGE_BUDGET_RATIO = 0.05 # Не более 5% запросов могут быть хеджированы
+HEDGE_BUDGET_WINDOW = 500
+
+_latency_samples = {} # (model, state) -> deque задержек в секундах
+_recent_hedge_flags = deque(maxlen=HEDGE_BUDGET_WINDOW)
+
+
+def _record_latency(latency_key: tuple, seconds: float):
+    samples = _latency_samples.get(latency_key)
+    if samples is None:
+        samples = _latency_samples[latency_key] = deque(maxlen=HEDGE_LATENCY_WINDOW)
+    samples.append(seconds)
+
+
+def _hedge_delay(latency_key: tuple):
+    """Возвращает задержку перед хедж-запросом или None, если хеджировать нельзя."""
+    if not LLM_HEDGING_ENABLED:
+        return None
+    samples = _latency_samples.get(latency_key)
+    if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * HEDGE_LATENCY_PERCENTILE))
+    return max(HEDGE_MIN_DELAY_SECONDS, ordered[index])
+
+
+def _hedge_budget_allows() -> bool:
+    if not _recent_hedge_flags:
+        return True
+    return sum(_recent_hedge_flags) / len(_recent_hedge_flags) < HEDGE_BUDGET_RATIO
+
+
+async def _request_completion(messages: list, profile: dict):
+    """Один запрос к OpenAI под адаптивным лимитом и с дедлайном из профиля."""
+    async with LLM_LIMITER.slot():
+        try:
+            async with asyncio.timeout(min(profile["timeout"], LLM_CALL_TIMEOUT_SECONDS)):
+                raw_response = await client.chat.completions.with_raw_response.create(
+                    model=profile["model"],
+                    messages=messages,
+                    temperature=profile["temperature"],
+                    max_tokens=profile["max_tokens"],
+                    response_format={"type": "json_object"},
+                    frequency_penalty=profile["frequency_penalty"]
+                )
+        except RateLimitError as e:
+            LLM_LIMITER.on_overload(retry_after=_retry_after_from_exception(e))
+            raise
+        except (APITimeoutError, asyncio.TimeoutError):
+            LLM_LIMITER.on_overload()
+            raise
+        response = raw_response.parse()
+        LLM_LIMITER.on_success(raw_response.headers)
+        return response
+
+
+async def _timed_completion(messages: list, profile: dict, latency_key: tuple):
+    started = time.monotonic()
+    response = await _request_completion(messages, profile)
+    _record_latency(latency_key, time.monotonic() - started)
+    return response
+
+
+async def _hedged_completion(messages: list, profile: dict, latency_key: tuple):
+    """
+    Выполняет запрос с возможным хеджированием.
+    Возвращает (response, hedged) - hedged=True, если запускался второй запрос.
+    """
+    primary = asyncio.create_task(_timed_completion(messages, profile, latency_key))
+    tasks = {primary}
+    hedged = False
+    try:
+        delay = _hedge_delay(latency_key)
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Хеджируем, только если бюджет не исчерпан и лимит параллельности не забит
+            if not done and _hedge_budget_allows() and LLM_LIMITER.in_flight < LLM_LIMITER.limit:
+                logger.warning(f"LLM запрос ({latency_key[1]}) длится дольше {delay:.1f} сек. Запускаю хедж-запрос.")
+                tasks.add(asyncio.create_task(_timed_completion(messages, profile, latency_key)))
+                hedged = True
+        _recent_hedge_flags.append(hedged)
+
+        # Ждем первый УСПЕШНЫЙ ответ; если все запросы упали - пробрасываем последнюю ошибку
+        last_error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result(), hedged
+                last_error = task.exception()
+        raise last_error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _usage_from_response(response) -> dict:
+    usage = response.usage
+    cached_tokens = 0
+    if getattr(usage, "prompt_tokens_details", None) is not None:
+        cached_tokens = getattr(usage.prompt_tokens_details, "cached_tokens", 0) or 0
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+        "cached_tokens": cached_tokens
+    }
+
+
+async def _repair_response(content: str, purpose: str, errors: list, profile: dict) -> tuple:
+    """
+    Короткий запрос на исправление битого ответа вместо повтора всего промпта.
+    Возвращает (parsed_response, usage_stats запроса-исправления).
+    Если исправить не удалось - LlmResponseFormatError (ретрай не поможет).
+    """
+    repair_profile = dict(profile, temperature=0.0, frequency_penalty=0.0)
+    response = await _request_completion(
+        llm_response_validator.build_repair_messages(content, purpose, errors), repair_profile
+    )
+    repair_usage = _usage_from_response(response)
+    parsed_response, repair_errors = llm_response_validator.parse_and_validate(
+        response.choices[0].message.content, purpose, response.choices[0].finish_reason
+    )
+    if repair_errors:
+        raise llm_response_validator.LlmResponseFormatError(
+            f"Ответ LLM ({purpose}) не удалось исправить: {'; '.join(repair_errors)}"
+        )
+    logger.info(f"Ответ LLM ({purpose}) исправлен коротким запросом.")
+    return parsed_response, repair_usage
+
 
 @retry(
     stop=stop_after_attempt(3),  # Попытаться 3 раза (1 оригинальная + 2 повтора)
-    wait=wait_exponential(multiplier=1, min=4, max=10), # Экспоненциальная задержка: 4с, 8с (максимум 10с)
-    # По умолчанию tenacity повторяет попытки для любого исключения, наследующегося от Exception.
-    # Поэтому retry_if_exception_type явно указывать не нужно для "любых ошибок".
+    wait=_wait_for_llm_retry, # retry-after от сервера или экспоненциально 4с, 8с (максимум 10с)
+    retry=retry_if_exception(is_retryable_llm_error), # Битый JSON и ошибки 4xx не повторяем
+    reraise=True,
 )
-async def get_bot_response(system_prompt: str, dialogue_history: list, user_message: str, current_datetime_utc: datetime.datetime, attempt_tracker: list = None, skip_instructions: bool = False) -> dict:
+async def get_bot_response(system_prompt: str, dialogue_history: list, user_message: str, current_datetime_utc: datetime.datetime, attempt_tracker: list = None, skip_instructions: bool = False, dialogue_state: str = None, purpose: str = llm_profiles.PURPOSE_DIALOGUE) -> dict:
     """
     Асинхронно отправляет запрос в OpenAI через прокси и получает ответ.
+    Модель и параметры генерации берутся из llm_profiles по purpose и dialogue_state;
+    dialogue_state также используется для статистики задержек (хеджирование запросов).
     """
+    profile = llm_profiles.get_profile(purpose, dialogue_state)
 
     # --- ДОБАВЛЕНО: СЧЕТЧИК ПОПЫТОК ---
     # При каждом запуске (включая ретраи) добавляем метку в список
@@ -74,64 +396,44 @@ async def get_bot_response(system_prompt: str, dialogue_history: list, user_mess
     try:
         logger.info(f"Отправка запроса к LLM через прокси...")
 
-        # --- ДОБАВЛЕНО: Использование семафора ---
-        async with LLM_SEMAPHORE:
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                temperature=0.1,
-                max_tokens=2500,
-                response_format={"type": "json_object"},
-                frequency_penalty=1.0 # <--- ИЗМЕНЕНИЕ 2: Штраф за повторы. Это убьет бесконечные циклы пробелов.
-            )
-        # ------------------------------------------
+        response, hedged = await _hedged_completion(messages, profile, latency_key=(profile["model"], dialogue_state or purpose))
 
         response_content = response.choices[0].message.content
         finish_reason = response.choices[0].finish_reason  # ### <--- НОВОЕ: Причина остановки
 
 
-        # Извлекаем информацию о токенах
-        usage = response.usage
-
-        # Безопасно получаем кешированные токены
-        cached_tokens = 0
-        if hasattr(usage, "prompt_tokens_details") and usage.prompt_tokens_details is not None:
-            cached_tokens = getattr(usage.prompt_tokens_details, "cached_tokens", 0)
-
-        # Выводим информацию о токенах и кеше
-        print("\n=== ТОКЕНЫ И КЕШ ===")
-        print(f"📊 Всего токенов: {usage.total_tokens}")
-        print(f"💬 Input токены: {usage.prompt_tokens}")
-        print(f"📤 Output токены: {usage.completion_tokens}")
-        print(f"⚡ Кешированные токены: {cached_tokens}")
-
-        if usage.prompt_tokens > 0:
-            cache_percent = (cached_tokens / usage.prompt_tokens) * 100
-            print(f"📈 Процент кеша: {cache_percent:.1f}%")
-        print()
+        # Извлекаем информацию о токенах (тот же расчет, что и для запросов-исправлений)
+        usage_stats = _usage_from_response(response)
+        cached_tokens = usage_stats["cached_tokens"]
 
         logger.info("Успешный ответ от LLM получен.")
-        logger.info(f"Использовано токенов - Total: {usage.total_tokens}, Input: {usage.prompt_tokens}, Output: {usage.completion_tokens}, Cached: {cached_tokens}")
+        logger.info(f"Использовано токенов - Total: {usage_stats['total_tokens']}, Input: {usage_stats['prompt_tokens']}, Output: {usage_stats['completion_tokens']}, Cached: {cached_tokens}")
 
         #print(response_content)
-        parsed_response = json.loads(response_content)
+        # Разбор с локальным ремонтом JSON и проверкой схемы вместо голого json.loads
+        parsed_response, validation_errors = llm_response_validator.parse_and_validate(response_content, purpose, finish_reason)
+        if validation_errors:
+            logger.warning(f"Ответ LLM ({purpose}, finish_reason={finish_reason}) не прошел проверку: {validation_errors}. Запрашиваю исправление.")
+            parsed_response, repair_usage = await _repair_response(response_content, purpose, validation_errors, profile)
+            for key in usage_stats:
+                usage_stats[key] += repair_usage.get(key, 0)
 
         # --- ИЗМЕНИТЬ ЭТУ ЧАСТЬ (чтобы вернуть статистику наружу) ---
         return {
             "parsed_response": parsed_response,
-            "usage_stats": {
-                "prompt_tokens": usage.prompt_tokens,
-                "completion_tokens": usage.completion_tokens,
-                "total_tokens": usage.total_tokens,
-                "cached_tokens": cached_tokens
-            }
+            "usage_stats": usage_stats,
+            "hedged": hedged,
+            "model": profile["model"]
         }
         # ------------------------------------------------------------
 
     except Exception as e:
         # Логируем, что произошла ошибка и будет предпринята повторная попытка.
         # Tenacity сам логирует попытки на уровне INFO, но здесь можно добавить WARN.
-        logger.warning(f"Ошибка при запросе к OpenAI: {type(e).__name__}: {e}. Будет предпринята повторная попытка (если не исчерпаны).", exc_info=True)
+        if is_retryable_llm_error(e):
+            logger.warning(f"Ошибка при запросе к OpenAI: {type(e).__name__}: {e}. Будет предпринята повторная попытка (если не исчерпаны).", exc_info=True)
+        else:
+            logger.error(f"Неустранимая ошибка при запросе к OpenAI: {type(e).__name__}: {e}. Повтор не выполняется.", exc_info=True)
         # КРИТИЧЕСКИ ВАЖНО: Перевыбрасываем исключение, чтобы декоратор @retry мог его поймать
         # и решить, нужно ли повторять попытку.
         raise
@@ -0,0 +1,109 @@
+# hr_bot/services/llm_profiles.py
+"""
+Таблица профилей генерации для запросов к LLM.
+
+Профиль выбирается по назначению запроса (purpose) и состоянию диалога:
+сначала ищется точное совпадение (purpose, dialogue_state), затем (purpose, None),
+недостающие поля берутся из DEFAULT_PROFILE.
+
+Короткие JSON-классификации (гражданство, проверка отказа) получают маленький
+лимит токенов и короткий дедлайн, чтобы не "разгоняться" и не висеть.
+Профили можно менять на лету через update_profile() или переменную окружения
+LLM_PROFILE_OVERRIDES (JSON: {"purpose" | "purpose:state": {поля профиля}}).
+"""
+import os
+import json
+import logging
+from decimal import Decimal
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+PURPOSE_DIALOGUE = "dialogue"
+PURPOSE_CITIZENSHIP = "citizenship"
+PURPOSE_DECLINE_CLARIFICATION = "decline_clarification"
+
+PROFILE_FIELDS = ("model", "max_tokens", "temperature", "timeout", "frequency_penalty")
+
+DEFAULT_PROFILE = {
+    "model": "gpt-4o-mini",
+    "max_tokens": 2500,
+    "temperature": 0.1,
+    "timeout": 90, # Дедлайн одного запроса, сек.
+    "frequency_penalty": 1.0, # Штраф за повторы - убивает бесконечные циклы пробелов
+}
+
+# Цены в $ за 1M токенов (cached_input - входные токены, попавшие в кеш OpenAI).
+MODEL_PRICES = {
+    "gpt-4o-mini": {"input": 0.150, "cached_input": 0.075, "output": 0.600},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+    "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60},
+    "gpt-4.1-nano": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+}
+
+# (purpose, dialogue_state или None) -> поля профиля, отличающиеся от DEFAULT_PROFILE
+_profiles = {
+    (PURPOSE_DIALOGUE, None): {},
+    (PURPOSE_CITIZENSHIP, None): {
+        "max_tokens": 80,
+        "temperature": 0.0,
+        "timeout": 20,
+        "frequency_penalty": 0.0,
+    },
+    (PURPOSE_DECLINE_CLARIFICATION, None): {
+        "max_tokens": 30,
+        "temperature": 0.0,
+        "timeout": 20,
+        "frequency_penalty": 0.0,
+    },
+}
+
+
+def get_profile(purpose: str, dialogue_state: str = None) -> dict:
+    """Возвращает полный профиль генерации для запроса."""
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(_profiles.get((purpose, None), {}))
+    if dialogue_state is not None:
+        profile.update(_profiles.get((purpose, dialogue_state), {}))
+    return profile
+
+
+def update_profile(purpose: str, dialogue_state: str = None, **overrides):
+    """Меняет профиль на лету (например, переключить модель для одного состояния)."""
+    unknown = set(overrides) - set(PROFILE_FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные поля профиля LLM: {', '.join(sorted(unknown))}")
+    model = overrides.get("model")
+    if model and model not in MODEL_PRICES:
+        logger.warning(f"Для модели '{model}' нет цены в MODEL_PRICES - стоимость будет считаться по {DEFAULT_PROFILE['model']}.")
+
+    _profiles.setdefault((purpose, dialogue_state), {}).update(overrides)
+    logger.info(f"Профиль LLM ({purpose}, {dialogue_state}) обновлен: {overrides}")
+
+
+def calculate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int) -> Decimal:
+    """Стоимость вызова в $ по ценам модели."""
+    prices = MODEL_PRICES.get(model) or MODEL_PRICES[DEFAULT_PROFILE["model"]]
+    non_cached_input = max(0, prompt_tokens - cached_tokens)
+    cost = (
+        (non_cached_input / 1_000_000) * prices["input"] +
+        (cached_tokens / 1_000_000) * prices["cached_input"] +
+        (completion_tokens / 1_000_000) * prices["output"]
+    )
+    return Decimal(str(cost))
+
+
+def _load_overrides_from_env():
+    raw = os.getenv("LLM_PROFILE_OVERRIDES")
+    if not raw:
+        return
+    try:
+        for key, overrides in json.loads(raw).items():
+            purpose, _, state = key.partition(":")
+            update_profile(purpose, state or None, **overrides)
+    except (ValueError, TypeError, AttributeError) as e:
+        logger.error(f"Некорректный LLM_PROFILE_OVERRIDES, используются профили по умолчанию: {e}")
+
+
+_load_overrides_from_env()
@@ -0,0 +1,86 @@
+# hr_bot/services/llm_reply_cache.py
+"""
+Мемоизация ответов LLM на время повторных попыток.
+
+Если ответ сгенерирован, но отправить его в HH не удалось (send_message вернул
+не 200/403), транзакция откатывается и диалог будет обработан заново в следующем
+цикле. Чтобы не платить за тот же ответ повторно (и не получить другой ответ),
+сгенерированный результат сохраняется здесь по ключу
+(id диалога, назначение запроса, состояние диалога, набор id pending-сообщений).
+
+Запись живет, пока не изменится набор входящих сообщений или не истечет TTL.
+Кэш хранится в памяти процесса воркера.
+"""
+import copy
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REPLY_CACHE_TTL_SECONDS = 15 * 60
+REPLY_CACHE_MAX_ENTRIES = 2000
+
+# key -> (время сохранения, llm_data)
+_reply_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+def _pending_message_ids(pending_messages: list) -> frozenset:
+    """Набор идентификаторов pending-сообщений (для legacy-строк - хэш содержимого)."""
+    ids = set()
+    for pm in pending_messages or []:
+        if isinstance(pm, dict) and pm.get('message_id'):
+            ids.add(str(pm['message_id']))
+        else:
+            content = pm.get('content', '') if isinstance(pm, dict) else str(pm)
+            ids.add('content_' + hashlib.md5(content.encode('utf-8')).hexdigest())
+    return frozenset(ids)
+
+
+def _make_key(dialogue_id: int, purpose: str, pending_messages: list, dialogue_state: Optional[str]) -> tuple:
+    return (dialogue_id, purpose, dialogue_state, _pending_message_ids(pending_messages))
+
+
+def get_reply(dialogue_id: int, purpose: str, pending_messages: list, dialogue_state: Optional[str] = None) -> Optional[dict]:
+    """
+    Возвращает сохраненный ответ LLM или None.
+    У возвращаемого ответа usage_stats = None, чтобы токены не были учтены повторно.
+    """
+    key = _make_key(dialogue_id, purpose, pending_messages, dialogue_state)
+    entry = _reply_cache.get(key)
+    if entry is None:
+        return None
+
+    stored_at, llm_data = entry
+    if time.monotonic() - stored_at > REPLY_CACHE_TTL_SECONDS:
+        _reply_cache.pop(key, None)
+        return None
+
+    _reply_cache.move_to_end(key)
+    cached = copy.deepcopy(llm_data)
+    cached["usage_stats"] = None
+    cached["from_cache"] = True
+    return cached
+
+
+def store_reply(dialogue_id: int, purpose: str, pending_messages: list, llm_data: dict, dialogue_state: Optional[str] = None):
+    """Сохраняет ответ LLM для повторного использования при ретрае."""
+    if not llm_data or not llm_data.get("parsed_response"):
+        return
+
+    key = _make_key(dialogue_id, purpose, pending_messages, dialogue_state)
+    _reply_cache[key] = (time.monotonic(), copy.deepcopy(llm_data))
+    _reply_cache.move_to_end(key)
+
+    while len(_reply_cache) > REPLY_CACHE_MAX_ENTRIES:
+        _reply_cache.popitem(last=False)
+
+    logger.debug(f"[Dialogue {dialogue_id}] Ответ LLM ({purpose}) сохранен для повторного использования.")
+
+
+def invalidate_dialogue(dialogue_id: int):
+    """Удаляет все сохраненные ответы диалога (после успешной отправки или сброса очереди)."""
+    for key in [k for k in _reply_cache if k[0] == dialogue_id]:
+        _reply_cache.pop(key, None)
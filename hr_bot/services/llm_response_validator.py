@@ -0,0 +1,167 @@
+# hr_bot/services/llm_response_validator.py
+"""
+Разбор и проверка JSON-ответов LLM.
+
+Типичные дефекты ответа (обертка ```json, висячие запятые, обрыв по лимиту
+токенов) чинятся локально, без повторного платного запроса. Затем ответ
+сверяется со схемой своего назначения (purpose). Если починить не удалось,
+llm_handler делает один короткий запрос на исправление, а не повторяет весь промпт.
+"""
+import json
+import re
+import logging
+from typing import Optional, Tuple
+
+from hr_bot.services import llm_profiles
+
+logger = logging.getLogger(__name__)
+
+
+class LlmResponseFormatError(ValueError):
+    """Ответ LLM не удалось привести к корректному JSON по схеме. Повтор запроса не поможет."""
+
+
+# Схема: поле -> (допустимые типы, обязательно ли, допустимые значения или None)
+RESPONSE_SCHEMAS = {
+    llm_profiles.PURPOSE_DIALOGUE: {
+        "response_text": ((str, type(None)), True, None),
+        "new_state": ((str,), True, None),
+        "extracted_data": ((dict, type(None)), False, None),
+    },
+    llm_profiles.PURPOSE_CITIZENSHIP: {
+        "is": ((str,), True, ("yes", "no")),
+        "citizenship": ((str, type(None)), False, None),
+    },
+    llm_profiles.PURPOSE_DECLINE_CLARIFICATION: {
+        "answer": ((str,), True, ("yes", "no")),
+    },
+}
+
+CODE_FENCE_PATTERN = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$', re.IGNORECASE)
+TRAILING_COMMA_PATTERN = re.compile(r',\s*([}\]])')
+
+
+def _close_truncated_json(text: str) -> str:
+    """
+    Дописывает закрывающие скобки для оборванного JSON.
+    Оборванная пара "ключ": значение отбрасывается целиком - недописанной строке
+    или числу доверять нельзя (если это было обязательное поле, сработает схема).
+    """
+    stack = []
+    in_string = False
+    escaped = False
+    string_start = 0
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+            string_start = position
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+
+    if in_string:
+        text = text[:string_start]
+
+    stripped = text.rstrip()
+    # Обрыв после ключа или внутри числа/литерала: {"a": "b", "c": 2  -> {"a": "b"
+    stripped = re.sub(r',?\s*"[^"\\]*"\s*:\s*[^"{}\[\],]*$', '', stripped)
+    stripped = stripped.rstrip().rstrip(',')
+    return stripped + ''.join(reversed(stack))
+
+
+def repair_json_text(text: str, truncated: bool = False) -> str:
+    """Чинит типичные дефекты: обертку в ```, мусор вокруг объекта, висячие запятые, обрыв."""
+    cleaned = CODE_FENCE_PATTERN.sub('', (text or '').strip())
+
+    start = cleaned.find('{')
+    if start > 0:
+        cleaned = cleaned[start:]
+    if not truncated:
+        end = cleaned.rfind('}')
+        if end != -1:
+            cleaned = cleaned[:end + 1]
+    else:
+        cleaned = _close_truncated_json(cleaned)
+
+    return TRAILING_COMMA_PATTERN.sub(r'\1', cleaned)
+
+
+def validate_schema(purpose: str, data) -> list:
+    """Возвращает список нарушений схемы (пустой - ответ корректен)."""
+    if not isinstance(data, dict):
+        return ["ответ должен быть JSON-объектом"]
+
+    errors = []
+    for field, (types, required, allowed) in RESPONSE_SCHEMAS.get(purpose, {}).items():
+        if field not in data:
+            if required:
+                errors.append(f"нет обязательного поля '{field}'")
+            continue
+        value = data[field]
+        if not isinstance(value, types):
+            errors.append(f"поле '{field}' имеет неверный тип ({type(value).__name__})")
+        elif allowed and str(value).lower() not in allowed:
+            errors.append(f"поле '{field}' должно быть одним из: {', '.join(allowed)}")
+        elif field == "new_state" and not value.strip():
+            errors.append("поле 'new_state' пустое")
+    return errors
+
+
+def _normalize_enum_fields(purpose: str, data: dict):
+    """Приводит поля с фиксированным набором значений к нижнему регистру ("YES" -> "yes")."""
+    for field, (_, _, allowed) in RESPONSE_SCHEMAS.get(purpose, {}).items():
+        if allowed and isinstance(data.get(field), str):
+            data[field] = data[field].strip().lower()
+
+
+def parse_and_validate(content: str, purpose: str, finish_reason: Optional[str] = None) -> Tuple[Optional[dict], list]:
+    """
+    Пытается разобрать ответ: сначала как есть, затем после локального ремонта.
+    Возвращает (данные или None, список ошибок).
+    """
+    truncated = finish_reason == 'length'
+    candidates = [content] if not truncated else []
+    candidates.append(repair_json_text(content, truncated=truncated))
+
+    errors = []
+    for index, candidate in enumerate(candidates):
+        try:
+            data = json.loads(candidate)
+        except (json.JSONDecodeError, TypeError) as e:
+            errors = [f"невалидный JSON: {e}"]
+            continue
+        errors = validate_schema(purpose, data)
+        if not errors:
+            _normalize_enum_fields(purpose, data)
+            if index > 0 or truncated:
+                logger.info(f"Ответ LLM ({purpose}) исправлен локально без повторного запроса.")
+            return data, []
+    return None, errors
+
+
+def build_repair_messages(content: str, purpose: str, errors: list) -> list:
+    """Короткий запрос на исправление ответа (без исходного промпта и истории)."""
+    fields = ", ".join(RESPONSE_SCHEMAS.get(purpose, {}).keys())
+    return [
+        {
+            "role": "system",
+            "content": (
+                "Ты исправляешь JSON. Верни только исправленный JSON-объект без пояснений. "
+                f"Объект должен содержать поля: {fields}. Содержание ответа не меняй, "
+                "оборванный текст аккуратно заверши."
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"Ошибки: {'; '.join(errors)}\n\nОтвет для исправления:\n{content}",
+        },
+    ]
@@ -0,0 +1,264 @@
+# hr_bot/services/prompt_compiler.py
+"""
+Сборка системного промпта основного запроса с кэшированием.
+
+Статическая часть промпта (блоки библиотеки для состояния + описание вакансии)
+не меняется, пока не изменились состояние диалога, вакансия или версия библиотеки,
+поэтому собирается один раз и хранится в ограниченном LRU по ключу
+(dialogue_state, ключ описания вакансии, версия библиотеки).
+Динамические части подставляются при выдаче: календарь кэшируется на текущую
+минуту (МСК), FAQ подбирается под входящие сообщения кандидата (faq_retriever).
+"""
+import datetime
+import logging
+from collections import OrderedDict
+from zoneinfo import ZoneInfo
+
+from hr_bot.services import faq_retriever
+
+logger = logging.getLogger(__name__)
+
+COMPILED_PROMPT_CACHE_MAX_ENTRIES = 2048
+MOSCOW_TZ = ZoneInfo("Europe/Moscow")
+
+STATE_SPECIFIC_BLOCKS = {
+    'initial_processing': ['#QUALIFICATION_RULES#'],
+    'awaiting_questions': ['#QUALIFICATION_RULES#'],
+    'awaiting_phone': ['#QUALIFICATION_RULES#'],
+    'awaiting_city': ['#QUALIFICATION_RULES#'],
+    'awaiting_readiness': ['#QUALIFICATION_RULES#'],
+    'awaiting_citizenship': ['#QUALIFICATION_RULES#'],
+    'clarifying_citizenship': ['#QUALIFICATION_RULES#','#CLARI#'],
+    'awaiting_age': ['#QUALIFICATION_RULES#'],
+    'clarifying_anything': ['#QUALIFICATION_RULES#'],
+    'clarifying_declined_vacancy': ['#QUALIFICATION_RULES#'],
+
+    'qualification_complete': ['#QUALIFICATION_RULES#'],
+    'call_later': ['#QUALIFICATION_RULES#'],
+
+    'init_scheduling_spb': ['#SCHEDULING_ALGORITHM#'],
+    'post_qualification_chat': ['#SCHEDULING_ALGORITHM#'],
+    'scheduling_spb_day': ['#SCHEDULING_ALGORITHM#'],
+    'scheduling_spb_time': ['#SCHEDULING_ALGORITHM#'],
+    'interview_scheduled_spb': ['#SCHEDULING_ALGORITHM#']
+}
+FAQ_STATES = ['forwarded_to_researcher','interview_scheduled_spb', 'post_qualification_chat', 'awaiting_questions', 'initial_processing', 'call_later']
+# Состояния, для которых нужен календарь
+SCHEDULING_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'post_qualification_chat', 'interview_scheduled_spb']
+POST_QUALIFICATION_STATES = ['forwarded_to_researcher', 'interview_scheduled_spb', 'post_qualification_chat']
+
+# Динамический слот в скомпилированном шаблоне
+SLOT_CALENDAR = "calendar"
+SLOT_FAQ = "faq"
+
+# (dialogue_state, ключ описания вакансии, версия библиотеки) -> кортеж сегментов (строка или ("slot", имя))
+_compiled_cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+_cache_hits = 0
+_cache_misses = 0
+
+# (минута МСК, текст календаря)
+_calendar_cache = (None, None)
+
+
+def _build_calendar_context(current_datetime_utc: datetime.datetime) -> str:
+    """
+    Генерирует текстовый блок с календарем и правилами работы с датами.
+    Текст зависит только от даты и минуты current_datetime_utc (МСК).
+    """
+    weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
+    
+    # Словарь для склонения в "следующий/следующая/следующее"
+    weekday_next_form = {
+        "понедельник": "Следующий понедельник",
+        "вторник": "Следующий вторник",
+        "среда": "Следующая среда",
+        "четверг": "Следующий четверг",
+        "пятница": "Следующая пятница",
+        "суббота": "Следующая суббота",
+        "воскресенье": "Следующее воскресенье"
+    }
+
+    current_weekday = weekdays_ru[current_datetime_utc.weekday()]
+    current_date_str = current_datetime_utc.strftime("%Y-%m-%d")
+    current_time_str = current_datetime_utc.strftime("%H:%M")
+
+    # Собираем информацию о днях недели для отслеживания повторений
+    weekday_occurrences = {}
+    
+    calendar_context_lines = []
+    for i in range(14):
+        date_cursor = current_datetime_utc + datetime.timedelta(days=i)
+        wd_name = weekdays_ru[date_cursor.weekday()]
+        date_str = date_cursor.strftime("%Y-%m-%d")
+        
+        # Отслеживаем, сколько раз встречался этот день недели
+        if wd_name not in weekday_occurrences:
+            weekday_occurrences[wd_name] = 0
+        weekday_occurrences[wd_name] += 1
+        
+        # Формируем префикс и суффикс
+        prefix = ""
+        suffix = ""
+        
+        if i == 0:
+            prefix = "(СЕГОДНЯ) "
+            suffix = " ← ТЫ ЗДЕСЬ"
+            day_label = wd_name.capitalize()
+        elif i == 1:
+            prefix = "(ЗАВТРА) "
+            day_label = wd_name.capitalize()
+        elif i == 2:
+            prefix = "(ПОСЛЕЗАВТРА) "
+            day_label = wd_name.capitalize()
+        else:
+            # Для остальных дней
+            if weekday_occurrences[wd_name] == 2:
+                # Второе упоминание дня недели - добавляем "Следующий"
+                day_label = weekday_next_form[wd_name]
+            else:
+                # Первое упоминание или третье+ - просто название с заглавной
+                day_label = wd_name.capitalize()
+        
+        calendar_context_lines.append(f"{prefix}{date_str} {day_label}{suffix}")
+
+    calendar_string = "\n".join(calendar_context_lines)
+
+    calendar_context = (
+        f"\n\n[CRITICAL CALENDAR CONTEXT]\n"
+        f"ТЕКУЩАЯ ДАТА И ВРЕМЯ (МСК): {current_datetime_utc.strftime('%Y-%m-%d %H:%M')}\n"
+        f"СЕГОДНЯ: {current_weekday}, {current_date_str}\n\n"
+        f"СЕЙЧАС: {current_time_str} (МСК)\n"
+        f"⚠️ ВАЖНО: Ты ОЧЕНЬ ПЛОХО считаешь даты в уме. НИКОГДА НЕ ВЫЧИСЛЯЙ ДАТЫ САМОСТОЯТЕЛЬНО!\n"
+        f"Используй ТОЛЬКО эту таблицу (таблица начинается с СЕГОДНЯ и идет на 14 дней вперед):\n\n"
+        f"{calendar_string}\n\n"
+        f"ПРАВИЛА РАБОТЫ С ДАТАМИ:\n"
+        f"1. Кандидат говорит просто день недели ('понедельник', 'вторник'):\n"
+        f"   → Найди ПЕРВУЮ строку с этим днем (без слова 'Следующий')\n"
+        f"   → Скопируй дату из этой строки\n\n"
+        f"2. Если кандидат говорит 'СЛЕДУЮЩИЙ [день недели]' (например, 'следующий понедельник'):\n"
+        f"   → Бери такой день из списка выше, где написано 'СЛЕДУЮЩИЙ [день недели]' (например, 'следующий понедельник')\n\n"
+        f"   → Скопируй дату из этой строки\n\n"
+        f"3. Если кандидат называет день недели, который совпадает с СЕГОДНЯ:\n"
+        f"   → ОБЯЗАТЕЛЬНО уточни: 'Вы имеете в виду сегодня или через неделю?'\n\n"
+        f"4. Если кандидат говорит 'сегодня', 'завтра', 'послезавтра':\n"
+        f"   → Ищи в списке пометку 'СЕГОДНЯ', 'ЗАВТРА' или 'ПОСЛЕЗАВТРА'\n\n"
+        f"5. ВСЕГДА копируй дату ТОЧНО из таблицы в формате YYYY-MM-DD\n"
+        f"6. НИКОГДА не изобретай даты сам - только из этой таблицы!\n"
+        f"═══════════════════════════════════════════════════════════\n"
+        f"ПРИМЕРЫ:\n"
+        f"═══════════════════════════════════════════════════════════\n"
+        f"Кандидат: 'понедельник' → Ты ищешь 'Понедельник'\n"
+        f"Кандидат: 'следующий понедельник' → Ты ищешь строчку 'Следующий понедельник'\n"
+        f"Кандидат: 'завтра' → Ты ищешь строчку с пометкой '(ЗАВТРА)'\n"
+    )
+    return calendar_context
+
+
+def get_calendar_context() -> str:
+    """Блок календаря на текущую минуту (МСК), пересобирается не чаще раза в минуту."""
+    global _calendar_cache
+    current_datetime = datetime.datetime.now(MOSCOW_TZ)
+    minute_key = current_datetime.strftime("%Y-%m-%d %H:%M")
+    cached_minute, cached_text = _calendar_cache
+    if cached_minute != minute_key:
+        cached_text = _build_calendar_context(current_datetime)
+        _calendar_cache = (minute_key, cached_text)
+    return cached_text
+
+
+def _compile_template(prompt_library: dict, dialogue_state: str, vacancy_description: str) -> tuple:
+    """Собирает статическую часть промпта (упрощенная версия с единым FAQ), оставляя слоты для динамики."""
+    required_blocks = ['#ROLE_AND_STYLE#']
+    required_blocks.extend(STATE_SPECIFIC_BLOCKS.get(dialogue_state, []))
+
+    if dialogue_state in FAQ_STATES:
+        required_blocks.append('#FAQ#')
+
+    final_block_keys = list(dict.fromkeys(required_blocks))
+
+    # FAQ - динамический слот: в промпт идут только записи, относящиеся к сообщениям кандидата
+    prompt_pieces = [(SLOT_FAQ,) if key == '#FAQ#' else prompt_library.get(key, '') for key in final_block_keys]
+
+    # Если текущее состояние требует календаря - оставляем под него слот
+    if dialogue_state in SCHEDULING_STATES:
+        prompt_pieces.append((SLOT_CALENDAR,))
+
+    if dialogue_state in POST_QUALIFICATION_STATES:
+        post_qual_block = prompt_library.get('#POSTCVAL#', '')
+        if post_qual_block:
+            prompt_pieces.append(post_qual_block)
+
+    vacancy_context = (
+        "[CRITICAL CONTEXT] Ниже представлено описание ТОЛЬКО ТОЙ вакансии, на которую откликнулся кандидат. "
+        "Используй ИСКЛЮЧИТЕЛЬНО эту информацию при ответах на вопросы о вакансии.\n" +
+        vacancy_description
+    )
+    prompt_pieces.insert(1, vacancy_context)
+
+    # Склеиваем соседние статические куски заранее: при выдаче остается соединить 1-3 сегмента
+    segments = []
+    static_run = []
+    for piece in prompt_pieces:
+        if isinstance(piece, tuple):
+            if static_run:
+                segments.append("\n\n".join(static_run))
+                static_run = []
+            segments.append(piece)
+        else:
+            static_run.append(piece)
+    if static_run:
+        segments.append("\n\n".join(static_run))
+    return tuple(segments)
+
+
+def _render_slot(slot: tuple, prompt_library: dict, user_message: str) -> str:
+    if slot[0] == SLOT_CALENDAR:
+        return get_calendar_context()
+    if slot[0] == SLOT_FAQ:
+        return faq_retriever.select_faq(prompt_library, user_message)
+    return ""
+
+
+def build_system_prompt(prompt_library: dict, dialogue_state: str, vacancy_description_key, vacancy_description: str, user_message: str = "") -> str:
+    """
+    Системный промпт для состояния и вакансии.
+    vacancy_description_key - стабильный ключ описания (None, если описание не найдено).
+    user_message - входящие сообщения кандидата (для подбора записей FAQ).
+    """
+    global _cache_hits, _cache_misses
+    key = (dialogue_state, vacancy_description_key, prompt_library.get("version"))
+
+    segments = _compiled_cache.get(key)
+    if segments is None:
+        _cache_misses += 1
+        segments = _compile_template(prompt_library, dialogue_state, vacancy_description)
+        # Без версии библиотеки (например, в отладке) не кэшируем - нечем инвалидировать
+        if key[2] is not None:
+            _compiled_cache[key] = segments
+            while len(_compiled_cache) > COMPILED_PROMPT_CACHE_MAX_ENTRIES:
+                _compiled_cache.popitem(last=False)
+    else:
+        _cache_hits += 1
+        _compiled_cache.move_to_end(key)
+
+    return "\n\n".join(
+        _render_slot(segment, prompt_library, user_message) if isinstance(segment, tuple) else segment
+        for segment in segments
+    )
+
+
+def get_cache_stats() -> dict:
+    """Метрики кэша: размер, попадания, промахи, доля попаданий."""
+    total = _cache_hits + _cache_misses
+    return {
+        "entries": len(_compiled_cache),
+        "hits": _cache_hits,
+        "misses": _cache_misses,
+        "hit_rate": (_cache_hits / total) if total else 0.0,
+    }
+
+
+def clear_cache():
+    global _calendar_cache
+    _compiled_cache.clear()
+    _calendar_cache = (None, None)
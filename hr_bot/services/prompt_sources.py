@@ -0,0 +1,109 @@
+# hr_bot/services/prompt_sources.py
+"""
+Источники текста библиотеки промптов для knowledge_base.
+
+Источник отдает сплошной текст с маркерами #MARKER# и вакансиями между
+#START_VACANCIES# / #END_VACANCIES# (разделитель &&&) - парсинг общий для всех.
+  - GoogleDocPromptSource - Google Doc через сервисный аккаунт (как раньше);
+  - LocalPromptSource - локальный файл или каталог (.md / .txt / .yaml / .yml,
+    файлы склеиваются по имени). Изменения отслеживаются по mtime/размеру файлов,
+    так что неизмененный каталог даже не перечитывается (горячая перезагрузка
+    без обращения к сети, удобно для офлайн-запуска и воспроизводимых замеров).
+"""
+import os
+import logging
+
+from google.oauth2.service_account import Credentials
+from googleapiclient.discovery import build
+
+logger = logging.getLogger(__name__)
+
+LOCAL_SOURCE_EXTENSIONS = ('.md', '.txt', '.yaml', '.yml')
+
+
+class PromptSource:
+    """Базовый источник. load_text() синхронный - вызывать в отдельном потоке."""
+
+    name = "base"
+    # Как часто фоновая задача проверяет источник, сек.
+    refresh_interval_seconds = 120
+
+    def has_changed(self) -> bool:
+        """False - источник точно не менялся с прошлой загрузки. True - изменился или это неизвестно."""
+        return True
+
+    def load_text(self) -> str:
+        raise NotImplementedError
+
+
+class GoogleDocPromptSource(PromptSource):
+    name = "Google Doc"
+    refresh_interval_seconds = 120
+
+    def __init__(self, document_id: str, service_account_file: str, scopes: list):
+        self.document_id = document_id
+        self.service_account_file = service_account_file
+        self.scopes = scopes
+
+    def load_text(self) -> str:
+        # Проверка наличия файла с ключами
+        if not os.path.exists(self.service_account_file):
+            raise FileNotFoundError(f"Файл ключей {self.service_account_file} не найден! Убедитесь, что запускаете скрипт из корня проекта.")
+
+        creds = Credentials.from_service_account_file(
+            self.service_account_file, scopes=self.scopes)
+        service = build('docs', 'v1', credentials=creds)
+
+        document = service.documents().get(documentId=self.document_id).execute()
+        content = document.get('body').get('content')
+
+        full_text = ''
+        for value in content:
+            if 'paragraph' in value:
+                elements = value.get('paragraph').get('elements')
+                for elem in elements:
+                    full_text += elem.get('textRun', {}).get('content', '')
+        return full_text
+
+
+class LocalPromptSource(PromptSource):
+    name = "локальные файлы"
+    refresh_interval_seconds = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self._last_signature = None
+
+    def _files(self) -> list:
+        if os.path.isdir(self.path):
+            return sorted(
+                os.path.join(self.path, file_name)
+                for file_name in os.listdir(self.path)
+                if file_name.lower().endswith(LOCAL_SOURCE_EXTENSIONS)
+            )
+        return [self.path]
+
+    def _signature(self) -> tuple:
+        signature = []
+        for file_path in self._files():
+            stat = os.stat(file_path)
+            signature.append((file_path, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def has_changed(self) -> bool:
+        try:
+            return self._signature() != self._last_signature
+        except OSError:
+            return True
+
+    def load_text(self) -> str:
+        signature = self._signature()
+        if not signature:
+            raise FileNotFoundError(f"В {self.path} нет файлов библиотеки промптов ({', '.join(LOCAL_SOURCE_EXTENSIONS)}).")
+
+        parts = []
+        for file_path, _, _ in signature:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                parts.append(f.read())
+        self._last_signature = signature
+        return "\n\n".join(parts)
@@ -0,0 +1,143 @@
+# hr_bot/services/turn_executor.py
+"""
+Параллельное выполнение LLM-запросов одного хода диалога.
+
+Побочные анализы (гражданство, проверка отказа) не зависят от ответа основной
+модели, поэтому запускаются одновременно с основным запросом, а не до/после него.
+Каждый запрос оборачивается в TrackedLlmCall: он сам учитывает токены, ретраи и
+провалы в usage_accounting, а ненужный (спекулятивный) запрос можно отменить.
+"""
+import asyncio
+import datetime
+import logging
+
+from hr_bot.services import llm_handler
+from hr_bot.services import llm_profiles
+from hr_bot.services import usage_accounting
+
+logger = logging.getLogger(__name__)
+
+CITIZENSHIP_ANALYSIS_PROMPT = (
+    '''Проанализируй сообщения кандидата и верни ответ\n
+    [CRITICAL RULE] Твой ответ ВСЕГДА должен быть в формате JSON.
+    Структура JSON должна быть следующей:
+    {
+    "is": "yes" или "no",
+    "citizenship": "ЕАЭС" или "внж рф" или "рвп рф" или название страны или Null,
+    }\n
+
+    Если в сообщениях содержится гражданство или название страны то в поле `is` верни `yes`\n
+    Если в сообщениях нет инфы о гражданстве (стране) то в поле `is` верни `no`\n
+    Если в сообщениях содержится информация, что человек гражданин (или просто указана страна) Россия (РФ) или Беларусь или Армения или Киргизия или Казахстан то `ЕАЭС`.\n"
+    Если в сообщениях содержится информация, что человек имеет ВНЖ России (РФ) или РВП России (РФ), то верни в "citizenship" строго значение "внж рф" или "рвп рф"
+    Если другое то верни в `citizenship` название страны.\n'''
+)
+
+DECLINE_CLARIFICATION_PROMPT = (
+    'Проанализируй диалог и определи: действительно ли кандидат чётко отказался от вакансии? '
+    'Верни ответ строго в формате JSON: {"answer": "yes" или "no"} '
+    'Ответ "yes" — только если кандидат прямо сказал, что вакансия его не интересует. '
+    'Если есть хоть малейшее сомнение — верни "no".'
+)
+
+
+class TrackedLlmCall:
+    """
+    LLM-запрос, запущенный фоновой задачей.
+    Результат забирается через wait(), отмена - через cancel().
+    Расход токенов, ретраи и провалы пишутся в usage_accounting под меткой usage_label.
+    """
+
+    def __init__(self, dialogue_id: int, usage_label: str, log_prefix: str = "", **request_kwargs):
+        self.dialogue_id = dialogue_id
+        self.usage_label = usage_label
+        self.log_prefix = log_prefix
+        self.attempts = []
+        self._accounted = False
+        request_kwargs.setdefault("current_datetime_utc", datetime.datetime.now(datetime.timezone.utc))
+        request_kwargs.setdefault("dialogue_state", usage_label)
+        self.task = asyncio.create_task(
+            llm_handler.get_bot_response(attempt_tracker=self.attempts, **request_kwargs)
+        )
+
+    async def wait(self) -> dict:
+        """Дожидается ответа. При полном провале учитывает все попытки и пробрасывает ошибку."""
+        try:
+            llm_data = await self.task
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            if not self._accounted:
+                self._accounted = True
+                logger.error(f"{self.log_prefix} LLM запрос '{self.usage_label}' ПРОВАЛЕН после {len(self.attempts)} попыток: {error}")
+                usage_accounting.record_empty_attempts(
+                    self.dialogue_id, usage_accounting.failure_labels(self.usage_label, len(self.attempts), error)
+                )
+            raise
+
+        if not self._accounted:
+            self._accounted = True
+            failed_attempts = len(self.attempts) - 1
+            if failed_attempts > 0:
+                logger.warning(f"{self.log_prefix} '{self.usage_label}': было {failed_attempts} скрытых ретраев tenacity.")
+                usage_accounting.record_empty_attempts(
+                    self.dialogue_id, usage_accounting.retry_labels(self.usage_label, failed_attempts)
+                )
+            usage_accounting.record_usage(self.dialogue_id, self.usage_label, llm_data)
+        return llm_data
+
+    def cancel(self):
+        """Отменяет ненужный спекулятивный запрос (если он еще выполняется)."""
+        if self.task.done():
+            # Запрос успел завершиться - его расход все равно нужно учесть
+            if not self._accounted and not self.task.cancelled():
+                self._accounted = True
+                error = self.task.exception()
+                if error is None:
+                    usage_accounting.record_usage(self.dialogue_id, f"{self.usage_label} (UNUSED)", self.task.result())
+                else:
+                    usage_accounting.record_empty_attempts(
+                        self.dialogue_id, usage_accounting.failure_labels(self.usage_label, len(self.attempts), error)
+                    )
+            return
+        self.task.cancel()
+        if not self._accounted and self.attempts:
+            self._accounted = True
+            usage_accounting.record_empty_attempts(self.dialogue_id, [f"{self.usage_label} (CANCELLED)"])
+
+
+def build_decline_context(history: list, pending_messages: list) -> str:
+    """Вся история диалога + входящие сообщения для проверки отказа."""
+    full_dialogue_text = "\n".join(
+        [entry.get('content', '') for entry in (history or [])]
+    )
+    pending_text = "\n".join(
+        [pm.get('content', '') for pm in (pending_messages or []) if isinstance(pm, dict)]
+    )
+    return (full_dialogue_text + "\n" + pending_text).strip()
+
+
+def start_citizenship_analysis(dialogue_id: int, pending_content: str, log_prefix: str = "") -> TrackedLlmCall:
+    return TrackedLlmCall(
+        dialogue_id,
+        "Citizenship_Analysis",
+        log_prefix=log_prefix,
+        system_prompt=CITIZENSHIP_ANALYSIS_PROMPT,
+        dialogue_history=[],
+        user_message=pending_content,
+        skip_instructions=True,
+        purpose=llm_profiles.PURPOSE_CITIZENSHIP,
+    )
+
+
+def start_decline_clarification(dialogue_id: int, history: list, pending_messages: list, log_prefix: str = "") -> TrackedLlmCall:
+    return TrackedLlmCall(
+        dialogue_id,
+        "DeclineClarification",
+        log_prefix=log_prefix,
+        system_prompt=DECLINE_CLARIFICATION_PROMPT,
+        dialogue_history=[],
+        user_message=build_decline_context(history, pending_messages),
+        skip_instructions=True,
+        purpose=llm_profiles.PURPOSE_DECLINE_CLARIFICATION,
+    )
@@ -0,0 +1,181 @@
+# hr_bot/services/usage_accounting.py
+"""
+Буферизованный учет расхода токенов LLM.
+
+Вместо отдельной записи LlmUsageLog и обновления счетчиков Dialogue на каждый
+вызов (с flush/commit/refresh в горячем пути) события копятся в памяти и
+сбрасываются пачкой:
+  - один многострочный INSERT в llm_usage_logs;
+  - один UPDATE dialogues ... FROM (VALUES ...) для счетчиков всех затронутых диалогов.
+
+Сброс происходит по интервалу или при накоплении USAGE_FLUSH_BATCH_SIZE событий,
+а также при остановке воркера (stop_usage_flusher).
+"""
+import asyncio
+import logging
+from decimal import Decimal
+
+from sqlalchemy import insert, update, values, column, Integer, Numeric
+
+from hr_bot.db.models import SessionLocal, Dialogue, LlmUsageLog
+from hr_bot.services import llm_profiles
+
+logger = logging.getLogger(__name__)
+
+USAGE_FLUSH_INTERVAL_SECONDS = 5
+USAGE_FLUSH_BATCH_SIZE = 200
+# Если БД недоступна, не копим события бесконечно
+USAGE_BUFFER_MAX_SIZE = 20000
+
+_usage_buffer = []
+_flush_requested = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_flusher_task = None
+_stop_requested = False
+
+
+def _enqueue(event: dict):
+    _usage_buffer.append(event)
+    if len(_usage_buffer) > USAGE_BUFFER_MAX_SIZE:
+        dropped = len(_usage_buffer) - USAGE_BUFFER_MAX_SIZE
+        del _usage_buffer[:dropped]
+        logger.error(f"Буфер учета токенов переполнен, отброшено {dropped} самых старых событий.")
+    if len(_usage_buffer) >= USAGE_FLUSH_BATCH_SIZE:
+        _flush_requested.set()
+
+
+def record_usage(dialogue_id: int, dialogue_state_at_call: str, llm_data: dict):
+    """
+    Ставит в очередь учет успешного вызова LLM (ответ get_bot_response).
+    Ответы без usage_stats (например, взятые из кэша) не учитываются.
+    """
+    usage_stats = (llm_data or {}).get("usage_stats")
+    if not usage_stats:
+        return
+
+    p_tokens = usage_stats.get('prompt_tokens', 0) or 0
+    c_tokens = usage_stats.get('completion_tokens', 0) or 0
+    cached_tokens = usage_stats.get('cached_tokens', 0) or 0
+    total_tokens = usage_stats.get('total_tokens') or (p_tokens + c_tokens)
+
+    _enqueue({
+        "dialogue_id": dialogue_id,
+        "dialogue_state_at_call": dialogue_state_at_call,
+        "prompt_tokens": p_tokens,
+        "completion_tokens": c_tokens,
+        "cached_tokens": cached_tokens,
+        "total_tokens": total_tokens,
+        "cost": llm_profiles.calculate_cost(llm_data.get("model"), p_tokens, c_tokens, cached_tokens),
+        "hedged": bool(llm_data.get("hedged", False)),
+    })
+
+
+def record_empty_attempts(dialogue_id: int, labels: list):
+    """Ставит в очередь "пустышки" (0 токенов) для ретраев и проваленных попыток."""
+    for label in labels:
+        _enqueue({
+            "dialogue_id": dialogue_id,
+            "dialogue_state_at_call": label,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "total_tokens": 0,
+            "cost": Decimal("0"),
+            "hedged": False,
+        })
+
+
+def retry_labels(base_label: str, count: int) -> list:
+    return [f"{base_label} (RETRY #{i + 1})" for i in range(count)]
+
+
+def failure_labels(base_label: str, count: int, error: BaseException) -> list:
+    return [f"{base_label} (FAILED #{i + 1}: {type(error).__name__})" for i in range(count)]
+
+
+def _aggregate_dialogue_totals(events: list) -> list:
+    totals = {}
+    for event in events:
+        row = totals.setdefault(event["dialogue_id"], [0, 0, 0, Decimal("0")])
+        row[0] += event["prompt_tokens"]
+        row[1] += event["completion_tokens"]
+        row[2] += event["cached_tokens"]
+        row[3] += event["cost"]
+    # Сортируем по id, чтобы строки диалогов блокировались в одном порядке
+    return [
+        (dialogue_id, p, c, cached, cost)
+        for dialogue_id, (p, c, cached, cost) in sorted(totals.items())
+        if p or c or cached or cost
+    ]
+
+
+async def flush_usage():
+    """Сбрасывает накопленные события в БД одной транзакцией."""
+    async with _flush_lock:
+        if not _usage_buffer:
+            return
+        events = _usage_buffer[:]
+        del _usage_buffer[:len(events)]
+
+        try:
+            async with SessionLocal() as session:
+                await session.execute(insert(LlmUsageLog), events)
+
+                dialogue_totals = _aggregate_dialogue_totals(events)
+                if dialogue_totals:
+                    deltas = values(
+                        column("dialogue_id", Integer),
+                        column("prompt_tokens", Integer),
+                        column("completion_tokens", Integer),
+                        column("cached_tokens", Integer),
+                        column("cost", Numeric(12, 6)),
+                        name="usage_deltas",
+                    ).data(dialogue_totals)
+
+                    await session.execute(
+                        update(Dialogue)
+                        .where(Dialogue.id == deltas.c.dialogue_id)
+                        .values(
+                            total_prompt_tokens=Dialogue.total_prompt_tokens + deltas.c.prompt_tokens,
+                            total_completion_tokens=Dialogue.total_completion_tokens + deltas.c.completion_tokens,
+                            total_cached_tokens=Dialogue.total_cached_tokens + deltas.c.cached_tokens,
+                            total_cost=Dialogue.total_cost + deltas.c.cost,
+                        )
+                        .execution_options(synchronize_session=False)
+                    )
+                await session.commit()
+            logger.debug(f"Учет токенов: записано {len(events)} событий.")
+        except Exception as e:
+            logger.error(f"Ошибка записи учета токенов ({len(events)} событий), вернем в буфер: {e}", exc_info=True)
+            _usage_buffer[:0] = events
+
+
+async def _flusher_loop():
+    while not _stop_requested:
+        try:
+            await asyncio.wait_for(_flush_requested.wait(), timeout=USAGE_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _flush_requested.clear()
+        await flush_usage()
+
+
+def start_usage_flusher():
+    """Запускает фоновый сброс буфера (вызывать из работающего event loop)."""
+    global _flusher_task, _stop_requested
+    _stop_requested = False
+    if _flusher_task is None or _flusher_task.done():
+        _flusher_task = asyncio.create_task(_flusher_loop())
+    return _flusher_task
+
+
+async def stop_usage_flusher():
+    """Останавливает фоновый сброс и записывает остаток буфера."""
+    global _flusher_task, _stop_requested
+    # Не отменяем задачу, чтобы не оборвать запись посередине - просим ее завершиться
+    _stop_requested = True
+    _flush_requested.set()
+    if _flusher_task is not None:
+        await _flusher_task
+        _flusher_task = None
+    await flush_usage()
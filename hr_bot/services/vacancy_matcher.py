@@ -0,0 +1,186 @@
+# hr_bot/services/vacancy_matcher.py
+"""
+Подбор описания вакансии из библиотеки промптов по названию и городу вакансии HH.
+
+Индекс строится один раз на версию библиотеки (prompt_library['version']):
+  - нормализованные города -> вакансии, в которых они встречаются;
+  - заранее посчитанные множества слов для каждого названия.
+Результаты подбора запоминаются в LRU по ключу (название HH, город HH).
+Найденное описание идентифицируется стабильным ключом (vacancy_key), который
+сохраняется в Vacancy.kb_description_key, чтобы не подбирать его заново на каждый ход.
+Логика оценки та же, что была в _find_relevant_vacancy: BEST MATCH по словам
+названия с исключением по критическим словам, порог 0.4.
+"""
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TITLE_MATCH_THRESHOLD = 0.4
+MATCH_MEMO_MAX_ENTRIES = 5000
+
+# Слова, различающие должности: если слово есть только с одной стороны - это другая вакансия
+CRITICAL_WORDS = frozenset({
+    'старший', 'младший', 'ночной', 'неполный', 'мобильный',
+    'администратор', 'директор', 'товаровед', 'универсал',
+    'пекарь', 'повар', 'кафе', 'бариста', 'кухни', 'сборщик', 'кассир'
+})
+
+CITY_SYNONYMS = {
+    "спб": "санкт петербург",
+    "питер": "санкт петербург",
+    "ленобласть": "ленинградская область"
+}
+
+# Индекс текущей версии библиотеки
+_index = None
+# (название HH, город HH) -> (номер вакансии или None, город из библиотеки, score)
+_match_memo: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+
+@lru_cache(maxsize=4096)
+def normalize_text(text: str) -> str:
+    if not text:
+        return ""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def normalize_city(city: str) -> str:
+    norm_city = normalize_text(city)
+    for short, full in CITY_SYNONYMS.items():
+        if short in norm_city:
+            norm_city = norm_city.replace(short, full)
+    return norm_city
+
+
+def vacancy_key(vacancy: dict) -> str:
+    """Стабильный ключ вакансии библиотеки: первое название + хэш названий и городов."""
+    titles = vacancy.get("titles", [])
+    raw = "|".join(titles) + "#" + "|".join(vacancy.get("cities", []))
+    digest = hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+    return f"{normalize_text(titles[0] if titles else '')[:200]}:{digest}"
+
+
+def title_similarity(input_words: frozenset, db_words: frozenset) -> float:
+    intersection = input_words & db_words
+    if not intersection:
+        return 0.0
+
+    # Критическое слово только с одной стороны - это другая должность
+    if (db_words ^ input_words) & CRITICAL_WORDS:
+        return 0.0
+
+    recall = len(intersection) / len(db_words)
+    precision = len(intersection) / len(input_words)
+
+    return (recall * 0.4) + (precision * 0.6)
+
+
+class _VacancyIndex:
+    """Предрасчитанные данные одной версии библиотеки."""
+
+    def __init__(self, version, vacancies: list):
+        self.version = version
+        self.vacancies = vacancies
+        # Множества слов всех названий каждой вакансии
+        self.title_words = [
+            [frozenset(normalize_text(title).split()) for title in vacancy.get("titles", [])]
+            for vacancy in vacancies
+        ]
+        self.by_key = {vacancy_key(vacancy): vacancy for vacancy in vacancies}
+        # нормализованный город -> [(номер вакансии, позиция города в вакансии, исходное название)]
+        self.cities = {}
+        for vacancy_index, vacancy in enumerate(vacancies):
+            for city_position, raw_city in enumerate(vacancy.get("cities", [])):
+                self.cities.setdefault(normalize_text(raw_city), []).append(
+                    (vacancy_index, city_position, raw_city)
+                )
+
+    def candidates_for_city(self, norm_input_city: str) -> list:
+        """
+        Вакансии, где есть подходящий город, в порядке библиотеки.
+        Для каждой - первый подходящий город в порядке ее списка городов (как раньше).
+        """
+        matched = {}
+        for db_city_norm, entries in self.cities.items():
+            if norm_input_city in db_city_norm or db_city_norm in norm_input_city:
+                for vacancy_index, city_position, raw_city in entries:
+                    current = matched.get(vacancy_index)
+                    if current is None or city_position < current[0]:
+                        matched[vacancy_index] = (city_position, raw_city)
+        return [(vacancy_index, matched[vacancy_index][1]) for vacancy_index in sorted(matched)]
+
+
+def library_version(prompt_library: dict):
+    return prompt_library.get("version") or id(prompt_library.get("vacancies"))
+
+
+def _get_index(prompt_library: dict) -> _VacancyIndex:
+    global _index
+    version = library_version(prompt_library)
+    if _index is None or _index.version != version:
+        _index = _VacancyIndex(version, prompt_library.get("vacancies", []))
+        _match_memo.clear()
+        logger.debug(f"Индекс вакансий перестроен: версия {version}, вакансий {len(_index.vacancies)}, городов {len(_index.cities)}")
+    return _index
+
+
+def _compute_match(index: _VacancyIndex, vacancy_title: str, vacancy_city: str) -> tuple:
+    input_words = frozenset(normalize_text(vacancy_title).split())
+    norm_input_city = normalize_city(vacancy_city)
+
+    best_match_index = None
+    best_match_score = 0.0
+    matched_city_name = "не определен"
+
+    for vacancy_index, db_city in index.candidates_for_city(norm_input_city):
+        max_title_score = 0.0
+        for db_words in index.title_words[vacancy_index]:
+            score = title_similarity(input_words, db_words)
+            if score > max_title_score:
+                max_title_score = score
+
+        if max_title_score < TITLE_MATCH_THRESHOLD:
+            continue
+
+        if max_title_score > best_match_score:
+            best_match_score = max_title_score
+            best_match_index = vacancy_index
+            matched_city_name = db_city
+
+    return best_match_index, matched_city_name, best_match_score
+
+
+def find_vacancy(prompt_library: dict, vacancy_title: str, vacancy_city: str) -> Tuple[Optional[dict], str, float]:
+    """
+    Возвращает (вакансия из библиотеки или None, город из библиотеки, score).
+    """
+    index = _get_index(prompt_library)
+    key = (vacancy_title, vacancy_city)
+
+    result = _match_memo.get(key)
+    if result is None:
+        result = _compute_match(index, vacancy_title, vacancy_city)
+        _match_memo[key] = result
+        while len(_match_memo) > MATCH_MEMO_MAX_ENTRIES:
+            _match_memo.popitem(last=False)
+    else:
+        _match_memo.move_to_end(key)
+
+    vacancy_index, matched_city_name, score = result
+    if vacancy_index is None:
+        return None, matched_city_name, score
+    return index.vacancies[vacancy_index], matched_city_name, score
+
+
+def get_vacancy_by_key(prompt_library: dict, key: str) -> Optional[dict]:
+    """Вакансия библиотеки по ключу, сохраненному в Vacancy.kb_description_key."""
+    if not key:
+        return None
+    return _get_index(prompt_library).by_key.get(key)
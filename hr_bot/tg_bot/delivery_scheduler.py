@@ -0,0 +1,141 @@
+# hr_bot/tg_bot/delivery_scheduler.py
+"""
+Планировщик доставки уведомлений в чаты рекрутеров.
+
+Раньше обработчики очередей отправляли сообщения по одному и спали 5 секунд
+после части отправок - пачка кандидатов по десяткам чатов расходилась минутами.
+Теперь у каждого telegram_chat_id своя очередь и своя задача-отправщик:
+  - разные чаты отправляются параллельно, общий темп ограничен DELIVERY_GLOBAL_RATE
+    (лимит Telegram на бота - около 30 сообщений в секунду);
+  - в один чат - не чаще раза в DELIVERY_CHAT_INTERVAL_SECONDS (около 20 в минуту
+    для групп, топики одного чата делят этот лимит);
+  - TelegramRetryAfter приостанавливает только свой чат на указанное время,
+    после чего то же сообщение отправляется повторно.
+Очередь чата по возможности не ограничена - обработчики очередей сами ограничивают
+число незавершенных пачек. Размер очередей по чатам - backlog(), раз в
+DELIVERY_BACKLOG_LOG_INTERVAL_SECONDS он пишется в лог.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiolimiter import AsyncLimiter
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_CHAT_INTERVAL_SECONDS = 3.0
+DELIVERY_GLOBAL_RATE = AsyncLimiter(25, 1)
+DELIVERY_SEND_TIMEOUT_SECONDS = 120.0
+# Сколько раз повторять отправку после TelegramRetryAfter
+DELIVERY_MAX_RETRIES = 3
+DELIVERY_BACKLOG_LOG_INTERVAL_SECONDS = 60
+
+# chat_id -> deque[(send, label, future)]
+_chat_queues = {}
+# chat_id -> задача-отправщик чата
+_chat_workers = {}
+# chat_id -> до какого момента (time.monotonic) чат на паузе после RetryAfter
+_paused_until = {}
+_reporter_task = None
+
+
+def submit(chat_id, send, label: str) -> asyncio.Future:
+    """
+    Ставит отправку в очередь чата chat_id. send - корутинная функция без аргументов,
+    которая делает сам запрос к Telegram. Возвращает future со статусом 'sent' / 'error'.
+    """
+    future = asyncio.get_running_loop().create_future()
+    _chat_queues.setdefault(chat_id, collections.deque()).append((send, label, future))
+    worker = _chat_workers.get(chat_id)
+    if worker is None or worker.done():
+        _chat_workers[chat_id] = asyncio.create_task(_chat_worker(chat_id))
+    return future
+
+
+def backlog() -> dict:
+    """Сколько отправок ждет в каждом чате (включая текущую)."""
+    return {chat_id: len(queue) for chat_id, queue in _chat_queues.items() if queue}
+
+
+async def _deliver(chat_id, send, label: str) -> str:
+    for attempt in range(DELIVERY_MAX_RETRIES + 1):
+        try:
+            async with DELIVERY_GLOBAL_RATE:
+                async with asyncio.timeout(DELIVERY_SEND_TIMEOUT_SECONDS):
+                    await send()
+            return 'sent'
+        except TelegramRetryAfter as e:
+            if attempt == DELIVERY_MAX_RETRIES:
+                logger.error(f"Чат {chat_id}: {label} не доставлено после {DELIVERY_MAX_RETRIES} повторов (RetryAfter).")
+                return 'error'
+            _paused_until[chat_id] = time.monotonic() + e.retry_after
+            logger.warning(f"Чат {chat_id}: Telegram просит подождать {e.retry_after} сек. (в очереди {len(_chat_queues.get(chat_id, ()))}).")
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.error(f"Чат {chat_id}: не удалось доставить {label}: {e}", exc_info=True)
+            return 'error'
+    return 'error'
+
+
+async def _chat_worker(chat_id):
+    queue = _chat_queues[chat_id]
+    last_sent_at = 0.0
+    try:
+        while queue:
+            send, label, future = queue[0]
+            ready_at = max(last_sent_at + DELIVERY_CHAT_INTERVAL_SECONDS, _paused_until.get(chat_id, 0.0))
+            delay = ready_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            status = await _deliver(chat_id, send, label)
+            last_sent_at = time.monotonic()
+            queue.popleft()
+            if not future.done():
+                future.set_result(status)
+    finally:
+        # Между проверкой пустой очереди и этим местом await нет - submit не может вклиниться
+        _chat_workers.pop(chat_id, None)
+        _paused_until.pop(chat_id, None)
+        if not queue:
+            _chat_queues.pop(chat_id, None)
+
+
+async def _backlog_reporter():
+    while True:
+        await asyncio.sleep(DELIVERY_BACKLOG_LOG_INTERVAL_SECONDS)
+        pending = backlog()
+        if pending:
+            busiest = sorted(pending.items(), key=lambda item: item[1], reverse=True)[:10]
+            logger.info(
+                f"Очередь доставки: {sum(pending.values())} сообщений в {len(pending)} чатах. "
+                f"Больше всего: {', '.join(f'{chat_id}: {count}' for chat_id, count in busiest)}"
+            )
+
+
+def start_delivery_scheduler():
+    global _reporter_task
+    if _reporter_task is None or _reporter_task.done():
+        _reporter_task = asyncio.create_task(_backlog_reporter())
+    return _reporter_task
+
+
+async def stop_delivery_scheduler():
+    """
+    Останавливает отправщики. Недоставленные уведомления остаются в очередях БД
+    в статусе 'processing' и будут возвращены резервным проходом.
+    """
+    global _reporter_task
+    tasks = list(_chat_workers.values())
+    if _reporter_task is not None:
+        tasks.append(_reporter_task)
+        _reporter_task = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for queue in _chat_queues.values():
+        for _, _, future in queue:
+            future.cancel()
+    _chat_queues.clear()
@@ -1,11 +1,9 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message
-from sqlalchemy.orm import Session
-from hr_bot.db.models import TelegramUser
+from sqlalchemy.ext.asyncio import AsyncSession
+from hr_bot.tg_bot import role_cache
 
 class AdminFilter(BaseFilter):
-    async def __call__(self, message: Message, db_session: Session) -> bool:
-        user = db_session.query(TelegramUser).filter(
-            TelegramUser.telegram_id == str(message.from_user.id)
-        ).first()
-        return user is not None and user.role == 'admin'
\ No newline at end of file
+    async def __call__(self, message: Message, db_session: AsyncSession) -> bool:
+        # Роль берется из кэша, в БД - только при промахе/истечении TTL
+        return await role_cache.get_role(db_session, message.from_user.id) == 'admin'
@@ -5,12 +5,14 @@ from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, func
 from aiogram.utils.formatting import Text, Bold, Italic, Code
 
-from hr_bot.db.models import TelegramUser, TrackedRecruiter, AppSettings
+from hr_bot.db.models import TelegramUser, TrackedRecruiter, AppSettings, Vacancy, Dialogue
 # Убрали импорт TrackedVacancy, так как он больше не используется
 from hr_bot.tg_bot.filters import AdminFilter
+from hr_bot.tg_bot import role_cache
 from hr_bot.tg_bot.keyboards import (
     create_management_keyboard,
     role_choice_keyboard,
@@ -77,8 +79,8 @@ async def cancel_callback_handler(callback: CallbackQuery, state: FSMContext):
 
 # --- УПРАВЛЕНИЕ ЛИМИТАМИ И ТАРИФАМИ ---
 @router.message(F.text == "⚙️ Баланс и Тариф")
-async def limits_menu(message: Message, db_session: Session):
-    settings = db_session.query(AppSettings).filter_by(id=1).first()
+async def limits_menu(message: Message, db_session: AsyncSession):
+    settings = await db_session.get(AppSettings, 1)
     if not settings:
         await message.answer("❌ Не удалось загрузить настройки.")
         return
@@ -106,7 +108,7 @@ async def start_set_balance(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(SettingsManagement.set_balance)
-async def process_set_balance(message: Message, state: FSMContext, db_session: Session):
+async def process_set_balance(message: Message, state: FSMContext, db_session: AsyncSession):
     try:
         new_balance = float(message.text.replace(',', '.'))
         if new_balance < 0: raise ValueError
@@ -114,14 +116,14 @@ async def process_set_balance(message: Message, state: FSMContext, db_session: S
         await message.answer("❌ Сумма должна быть числом. Попробуйте еще раз.")
         return
 
-    settings = db_session.query(AppSettings).filter_by(id=1).first()
+    settings = await db_session.get(AppSettings, 1)
     settings.balance = new_balance
     
     # Сбрасываем флаг уведомления, если баланс теперь выше порога
     if new_balance >= settings.low_balance_threshold:
         settings.low_limit_notified = False
 
-    db_session.commit()
+    await db_session.commit()
     await state.clear()
     await message.answer(f"✅ Баланс обновлен: {new_balance:.2f} руб.", reply_markup=admin_keyboard)
 @router.callback_query(F.data == "set_tariff")
@@ -131,12 +133,12 @@ async def start_set_cost_dialogue(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(SettingsManagement.set_cost_dialogue)
-async def process_set_cost_dialogue(message: Message, state: FSMContext, db_session: Session):
+async def process_set_cost_dialogue(message: Message, state: FSMContext, db_session: AsyncSession):
     try:
         val = float(message.text.replace(',', '.'))
-        settings = db_session.query(AppSettings).filter_by(id=1).first()
+        settings = await db_session.get(AppSettings, 1)
         settings.cost_per_dialogue = val
-        db_session.commit()
+        await db_session.commit()
         
         # Переходим к следующему шагу - стоимость напоминалки
         await state.set_state(SettingsManagement.set_cost_long_reminder)
@@ -145,12 +147,12 @@ async def process_set_cost_dialogue(message: Message, state: FSMContext, db_sess
         await message.answer("❌ Ошибка в числе. Попробуйте еще раз.")
 
 @router.message(SettingsManagement.set_cost_long_reminder)
-async def process_set_cost_reminder(message: Message, state: FSMContext, db_session: Session):
+async def process_set_cost_reminder(message: Message, state: FSMContext, db_session: AsyncSession):
     try:
         val = float(message.text.replace(',', '.'))
-        settings = db_session.query(AppSettings).filter_by(id=1).first()
+        settings = await db_session.get(AppSettings, 1)
         settings.cost_per_long_reminder = val
-        db_session.commit()
+        await db_session.commit()
         
         await state.clear()
         await message.answer("✅ Все тарифы успешно обновлены.", reply_markup=admin_keyboard)
@@ -159,8 +161,8 @@ async def process_set_cost_reminder(message: Message, state: FSMContext, db_sess
 
 # --- 1. УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ---
 @router.message(F.text == "👤 Управление пользователями")
-async def user_management_menu(message: Message, db_session: Session):
-    users = db_session.query(TelegramUser).all()
+async def user_management_menu(message: Message, db_session: AsyncSession):
+    users = (await db_session.scalars(select(TelegramUser))).all()
     content_parts = [Bold("👥 Список пользователей:"), "\n\n"]
     if not users:
         content_parts.append(Italic("В системе пока нет пользователей."))
@@ -182,13 +184,13 @@ async def start_add_user(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(UserManagement.add_id)
-async def process_add_user_id(message: Message, state: FSMContext, db_session: Session):
+async def process_add_user_id(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         content = Text("❌ ID должен быть числом. Попробуйте еще раз.")
         await message.answer(**content.as_kwargs(), reply_markup=cancel_fsm_keyboard)
         return
     user_id = message.text
-    if db_session.query(TelegramUser).filter_by(telegram_id=user_id).first():
+    if await db_session.scalar(select(TelegramUser).filter_by(telegram_id=user_id)):
         content = Text("⚠️ Пользователь с ID ", Code(user_id), " уже существует. Действие отменено.")
         await message.answer(**content.as_kwargs())
         await state.clear()
@@ -209,12 +211,14 @@ async def process_add_user_name(message: Message, state: FSMContext):
     await message.answer("Имя принято. Теперь выберите роль:", reply_markup=role_choice_keyboard)
 
 @router.callback_query(UserManagement.add_role)
-async def process_add_user_role(callback: CallbackQuery, state: FSMContext, db_session: Session):
+async def process_add_user_role(callback: CallbackQuery, state: FSMContext, db_session: AsyncSession):
     role = "admin" if callback.data == "set_role_admin" else "user"
     user_data = await state.get_data()
     new_user = TelegramUser(telegram_id=user_data['user_id'], username=user_data['user_name'], role=role)
     db_session.add(new_user)
-    db_session.commit()
+    await role_cache.notify_changed(db_session, user_data['user_id'])
+    await db_session.commit()
+    role_cache.invalidate(user_data['user_id'])
     await state.clear()
     logger.info(f"Админ {callback.from_user.id} добавил пользователя {user_data['user_id']} с ролью {role}")
     content = Text("✅ ", Bold("Успех!"), " Пользователь ", Bold(user_data['user_name']), " добавлен с ролью ", Italic(role), ".")
@@ -228,7 +232,7 @@ async def start_del_user(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(UserManagement.del_id)
-async def process_del_user_id(message: Message, state: FSMContext, db_session: Session):
+async def process_del_user_id(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         content = Text("❌ ID должен быть числом. Попробуйте еще раз.")
         await message.answer(**content.as_kwargs(), reply_markup=cancel_fsm_keyboard)
@@ -238,7 +242,7 @@ async def process_del_user_id(message: Message, state: FSMContext, db_session: S
         await message.answer("🤔 Вы не можете удалить самого себя. Действие отменено.")
         await state.clear()
         return
-    user_to_delete = db_session.query(TelegramUser).filter_by(telegram_id=user_id_to_delete).first()
+    user_to_delete = await db_session.scalar(select(TelegramUser).filter_by(telegram_id=user_id_to_delete))
     if not user_to_delete:
         content = Text("⚠️ Пользователь с ID ", Code(user_id_to_delete), " не найден. Действие отменено.")
         await message.answer(**content.as_kwargs())
@@ -246,8 +250,10 @@ async def process_del_user_id(message: Message, state: FSMContext, db_session: S
         return
     deleted_username = user_to_delete.username
     deleted_id = user_to_delete.telegram_id
-    db_session.delete(user_to_delete)
-    db_session.commit()
+    await db_session.delete(user_to_delete)
+    await role_cache.notify_changed(db_session, deleted_id)
+    await db_session.commit()
+    role_cache.invalidate(deleted_id)
     await state.clear()
     logger.info(f"Админ {message.from_user.id} удалил пользователя {deleted_id}")
     content = Text("✅ Пользователь ", Bold(deleted_username), " (ID: ", Code(deleted_id), ") был удален.")
@@ -257,8 +263,8 @@ async def process_del_user_id(message: Message, state: FSMContext, db_session: S
 
 # --- 3. УПРАВЛЕНИЕ РЕКРУТЕРАМИ ---
 @router.message(F.text == "👨‍💼 Управление рекрутерами")
-async def recruiter_management_menu(message: Message, db_session: Session):
-    recruiters = db_session.query(TrackedRecruiter).all()
+async def recruiter_management_menu(message: Message, db_session: AsyncSession):
+    recruiters = (await db_session.scalars(select(TrackedRecruiter))).all()
 
     content_parts = [Bold("👨‍💼 Отслеживаемые рекрутеры:"), "\n\n"]
     if not recruiters:
@@ -282,13 +288,13 @@ async def start_add_recruiter(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(RecruiterManagement.add_id)
-async def process_add_recruiter_id(message: Message, state: FSMContext, db_session: Session):
+async def process_add_recruiter_id(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         content = Text("❌ ID должен быть числом. Попробуйте еще раз.")
         await message.answer(**content.as_kwargs(), reply_markup=cancel_fsm_keyboard)
         return
     recruiter_id = message.text
-    if db_session.query(TrackedRecruiter).filter_by(recruiter_id=recruiter_id).first():
+    if await db_session.scalar(select(TrackedRecruiter).filter_by(recruiter_id=recruiter_id)):
         content = Text("⚠️ Рекрутер с ID ", Code(recruiter_id), " уже отслеживается. Действие отменено.")
         await message.answer(**content.as_kwargs())
         await state.clear()
@@ -383,7 +389,7 @@ async def process_add_topic_rejected(message: Message, state: FSMContext):
     await message.answer("Шаг 9/9: Введите ID темы (Topic ID) для 'Молчуны'.", reply_markup=cancel_fsm_keyboard)
 
 @router.message(RecruiterManagement.add_topic_timeout)
-async def process_add_topic_timeout(message: Message, state: FSMContext, db_session: Session):
+async def process_add_topic_timeout(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         await message.answer("❌ ID темы должен быть числом.", reply_markup=cancel_fsm_keyboard)
         return
@@ -403,7 +409,7 @@ async def process_add_topic_timeout(message: Message, state: FSMContext, db_sess
         topic_timeout_id=int(message.text)
     )
     db_session.add(new_recruiter)
-    db_session.commit()
+    await db_session.commit()
     await state.clear()
 
     logger.info(f"Админ {message.from_user.id} добавил рекрутера {data['name']} со всеми настройками.")
@@ -420,13 +426,13 @@ async def start_update_recruiter(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(RecruiterManagement.update_id)
-async def process_update_recruiter_id(message: Message, state: FSMContext, db_session: Session):
+async def process_update_recruiter_id(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         await message.answer("❌ ID должен быть числом. Попробуйте еще раз.", reply_markup=cancel_fsm_keyboard)
         return
 
     recruiter_id = message.text
-    recruiter = db_session.query(TrackedRecruiter).filter_by(recruiter_id=recruiter_id).first()
+    recruiter = await db_session.scalar(select(TrackedRecruiter).filter_by(recruiter_id=recruiter_id))
 
     if not recruiter:
         await message.answer(f"⚠️ Рекрутер с ID `{recruiter_id}` не найден. Действие отменено.")
@@ -512,13 +518,13 @@ async def process_update_topic_rejected(message: Message, state: FSMContext):
     await message.answer("Шаг 7/7: Введите новый ID темы 'Молчуны'.", reply_markup=cancel_fsm_keyboard)
 
 @router.message(RecruiterManagement.update_topic_timeout)
-async def process_update_topic_timeout(message: Message, state: FSMContext, db_session: Session):
+async def process_update_topic_timeout(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         await message.answer("❌ ID темы должен быть числом.", reply_markup=cancel_fsm_keyboard)
         return
 
     data = await state.get_data()
-    recruiter_to_update = db_session.query(TrackedRecruiter).filter_by(recruiter_id=data['recruiter_id']).first()
+    recruiter_to_update = await db_session.scalar(select(TrackedRecruiter).filter_by(recruiter_id=data['recruiter_id']))
 
     if not recruiter_to_update:
         await message.answer("❌ Ошибка: рекрутер не найден в базе. Действие отменено.")
@@ -535,7 +541,7 @@ async def process_update_topic_timeout(message: Message, state: FSMContext, db_s
     recruiter_to_update.topic_rejected_id = data['topic_rejected_id']
     recruiter_to_update.topic_timeout_id = int(message.text)
 
-    db_session.commit()
+    await db_session.commit()
     await state.clear()
 
     logger.info(f"Админ {message.from_user.id} полностью обновил рекрутера {recruiter_to_update.name}")
@@ -550,13 +556,13 @@ async def start_del_recruiter(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(RecruiterManagement.del_id)
-async def process_del_recruiter_id(message: Message, state: FSMContext, db_session: Session):
+async def process_del_recruiter_id(message: Message, state: FSMContext, db_session: AsyncSession):
     if not message.text or not message.text.isdigit():
         content = Text("❌ ID должен быть числом. Попробуйте еще раз.")
         await message.answer(**content.as_kwargs(), reply_markup=cancel_fsm_keyboard)
         return
     recruiter_id = message.text
-    recruiter_to_delete = db_session.query(TrackedRecruiter).filter_by(recruiter_id=recruiter_id).first()
+    recruiter_to_delete = await db_session.scalar(select(TrackedRecruiter).filter_by(recruiter_id=recruiter_id))
     if not recruiter_to_delete:
         content = Text("⚠️ Рекрутер с ID ", Code(recruiter_id), " не найден. Действие отменено.")
         await message.answer(**content.as_kwargs())
@@ -564,10 +570,44 @@ async def process_del_recruiter_id(message: Message, state: FSMContext, db_sessi
         return
 
     deleted_name = recruiter_to_delete.name
-    db_session.delete(recruiter_to_delete)
-    db_session.commit()
+    await db_session.delete(recruiter_to_delete)
+    await db_session.commit()
     await state.clear()
     logger.info(f"Админ {message.from_user.id} удалил рекрутера {recruiter_id}")
 
     content = Text("✅ Рекрутер ", Bold(deleted_name), " (ID: ", Code(recruiter_id), ") удален.")
-    await message.answer(**content.as_kwargs())
\ No newline at end of file
+    await message.answer(**content.as_kwargs())
+
+
+# --- ОТЧЕТ: ВАКАНСИИ БЕЗ ОПИСАНИЯ В БАЗЕ ЗНАНИЙ ---
+MISSING_VACANCIES_REPORT_LIMIT = 50
+
+@router.message(Command("missing_vacancies"))
+async def missing_vacancies_report(message: Message, db_session: AsyncSession):
+    """Вакансии HH, для которых в библиотеке промптов не нашлось описания (бывший missing_vacancies.txt)."""
+    dialogues_count = func.count(Dialogue.id).label("dialogues_count")
+    result = await db_session.execute(
+        select(Vacancy.title, Vacancy.city, Vacancy.kb_resolved_at, dialogues_count)
+        .outerjoin(Dialogue, Dialogue.vacancy_id == Vacancy.id)
+        .filter(Vacancy.kb_library_version.isnot(None), Vacancy.kb_description_key.is_(None))
+        .group_by(Vacancy.id)
+        .order_by(dialogues_count.desc(), Vacancy.title)
+        .limit(MISSING_VACANCIES_REPORT_LIMIT)
+    )
+    rows = result.all()
+
+    if not rows:
+        await message.answer("✅ Для всех вакансий найдено описание в базе знаний.")
+        return
+
+    content_parts = [Bold("🤡 Вакансии без описания в базе знаний:"), "\n\n"]
+    for title, city, resolved_at, count in rows:
+        checked = resolved_at.strftime('%d.%m %H:%M') if resolved_at else "—"
+        content_parts.extend([
+            "• ", Bold(title), " | ", city or "город не указан",
+            " — диалогов: ", Bold(str(count)), " (проверено ", Italic(checked), ")\n"
+        ])
+    if len(rows) == MISSING_VACANCIES_REPORT_LIMIT:
+        content_parts.append(Italic(f"\nПоказаны первые {MISSING_VACANCIES_REPORT_LIMIT} вакансий."))
+    content = Text(*content_parts)
+    await message.answer(**content.as_kwargs())
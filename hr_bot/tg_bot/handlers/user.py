@@ -1,6 +1,6 @@
 from aiogram import Router, F
 from aiogram.types import Message
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from aiogram.utils.formatting import Text, Bold
 
 from hr_bot.db.models import AppSettings
@@ -10,8 +10,8 @@ router = Router()
 router.message.filter(~AdminFilter()) # Только для обычных юзеров
 
 @router.message(F.text == "⚙️ Баланс") # Кнопка теперь называется так
-async def user_balance_status(message: Message, db_session: Session):
-    settings = db_session.query(AppSettings).filter_by(id=1).first()
+async def user_balance_status(message: Message, db_session: AsyncSession):
+    settings = await db_session.get(AppSettings, 1)
     if not settings:
         await message.answer("❌ Не удалось загрузить данные о балансе.")
         return
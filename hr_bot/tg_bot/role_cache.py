@@ -0,0 +1,116 @@
+# hr_bot/tg_bot/role_cache.py
+"""
+Кэш ролей пользователей Telegram (telegram_id -> role) для AdminFilter и хендлеров.
+
+Раньше каждое сообщение админа запрашивало TelegramUser из БД. Теперь роль
+(и отсутствие пользователя - тоже) хранится в памяти ROLE_CACHE_TTL_SECONDS.
+Сброс:
+  - явно, из сценариев добавления/удаления пользователя (invalidate + notify_changed);
+  - по истечении TTL;
+  - опционально - через Postgres LISTEN/NOTIFY на канале ROLE_CACHE_CHANNEL,
+    если бот запущен в нескольких процессах (ROLE_CACHE_NOTIFY_ENABLED=true).
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Optional
+
+import asyncpg
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from hr_bot.db.models import TelegramUser, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME
+
+logger = logging.getLogger(__name__)
+
+ROLE_CACHE_TTL_SECONDS = 300
+ROLE_CACHE_CHANNEL = "telegram_user_roles"
+ROLE_CACHE_NOTIFY_ENABLED = os.getenv("ROLE_CACHE_NOTIFY_ENABLED", "false").lower() in ("1", "true", "yes")
+# Пауза перед повторным подключением слушателя после обрыва
+ROLE_CACHE_LISTEN_RETRY_SECONDS = 30
+
+# telegram_id -> (роль или None, если пользователя нет; момент устаревания по time.monotonic)
+_roles = {}
+_listener_task = None
+
+
+async def get_role(db: AsyncSession, telegram_id) -> Optional[str]:
+    """Роль пользователя ('admin' / 'user') или None, если доступа нет."""
+    telegram_id = str(telegram_id)
+    cached = _roles.get(telegram_id)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    role = await db.scalar(select(TelegramUser.role).filter(TelegramUser.telegram_id == telegram_id))
+    _roles[telegram_id] = (role, time.monotonic() + ROLE_CACHE_TTL_SECONDS)
+    return role
+
+
+def invalidate(telegram_id=None):
+    """Сбрасывает кэш одного пользователя (или весь, если telegram_id не указан) в этом процессе."""
+    if telegram_id is None:
+        _roles.clear()
+    else:
+        _roles.pop(str(telegram_id), None)
+
+
+async def notify_changed(db: AsyncSession, telegram_id):
+    """
+    Ставит NOTIFY для остальных процессов в текущей транзакции.
+    Вызывать до commit: Postgres доставит уведомление только после фиксации.
+    Свой процесс сбрасывается отдельно - invalidate() после commit.
+    """
+    if ROLE_CACHE_NOTIFY_ENABLED:
+        await db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": ROLE_CACHE_CHANNEL, "payload": str(telegram_id)})
+
+
+def _on_notify(connection, pid, channel, payload):
+    invalidate(payload or None)
+    logger.debug(f"Кэш ролей: сброс по уведомлению ({payload or 'все'}).")
+
+
+async def _listen_loop():
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(
+                user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT, database=DB_NAME
+            )
+            await connection.add_listener(ROLE_CACHE_CHANNEL, _on_notify)
+            # Пока не слушали, могли пропустить уведомления
+            invalidate()
+            logger.info(f"Кэш ролей: подписка на канал {ROLE_CACHE_CHANNEL} активна.")
+            while not connection.is_closed():
+                await asyncio.sleep(ROLE_CACHE_LISTEN_RETRY_SECONDS)
+            logger.warning("Кэш ролей: соединение LISTEN закрыто, переподключаюсь...")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Кэш ролей: ошибка подписки на {ROLE_CACHE_CHANNEL}: {e}")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        # Без подписки работаем на TTL
+        await asyncio.sleep(ROLE_CACHE_LISTEN_RETRY_SECONDS)
+
+
+def start_role_cache_listener():
+    """Запускает подписку на сброс кэша (если ROLE_CACHE_NOTIFY_ENABLED)."""
+    global _listener_task
+    if not ROLE_CACHE_NOTIFY_ENABLED:
+        return None
+    if _listener_task is None or _listener_task.done():
+        _listener_task = asyncio.create_task(_listen_loop())
+    return _listener_task
+
+
+async def stop_role_cache_listener():
+    global _listener_task
+    if _listener_task is not None:
+        _listener_task.cancel()
+        try:
+            await _listener_task
+        except asyncio.CancelledError:
+            pass
+        _listener_task = None
@@ -0,0 +1,311 @@
+# hr_bot/utils/local_extractor.py
+"""
+Локальное (без LLM) извлечение анкетных данных кандидата:
+гражданство, возраст и телефон.
+
+Каждая функция возвращает пару (значение, уверенность 0..1).
+Воркер обращается к LLM только тогда, когда уверенность ниже порога.
+"""
+import re
+from typing import Tuple, Optional
+
+from hr_bot.utils.pii_masker import PHONE_PATTERN
+from hr_bot.utils.resh_in_code import EAEU_COUNTRIES
+
+# Порог, начиная с которого локальному результату можно доверять без LLM
+LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD = 0.8
+
+# --- СЛОВАРИ ГРАЖДАНСТВА ---
+# Ключ - нормализованное название страны, значение - корни слов.
+# Корни подобраны так, чтобы ловить "россия", "россиянин", "гражданин россии" и т.п.
+# Принадлежность к ЕАЭС определяется по списку EAEU_COUNTRIES из resh_in_code.
+COUNTRY_STEMS = {
+    'россия': [r'росси', r'рф\b', r'российск'],
+    'беларусь': [r'беларус', r'белорус', r'рб\b'],
+    'армения': [r'армени', r'армян'],
+    'киргизия': [r'киргиз', r'кыргыз'],
+    'казахстан': [r'казах', r'рк\b'],
+    'узбекистан': [r'узбек'],
+    'таджикистан': [r'таджик'],
+    'туркменистан': [r'туркмен'],
+    'азербайджан': [r'азербайджан', r'азер\b'],
+    'украина': [r'украин'],
+    'молдова': [r'молдов', r'молдав'],
+    'грузия': [r'грузи[яию]\b', r'грузин'],
+    'абхазия': [r'абхаз'],
+    'вьетнам': [r'вьетнам'],
+    'китай': [r'кита[йея]', r'кнр\b'],
+    'индия': [r'инди[яию]\b', r'индийск'],
+    'турция': [r'турци', r'турецк'],
+    'сирия': [r'сири[яию]\b', r'сирийск'],
+    'афганистан': [r'афган'],
+    'монголия': [r'монгол'],
+}
+
+# Формы проживания, которые дают право работать без гражданства ЕАЭС
+RESIDENCE_PATTERNS = {
+    'внж рф': [r'\bвнж\b', r'вид\w* на жительств'],
+    'рвп рф': [r'\bрвп\b', r'разрешени\w* на временное проживани'],
+}
+
+NEGATION_PATTERN = re.compile(r'\b(нет|не|без|отсутству\w*)\b')
+CITIZENSHIP_HINT_PATTERN = re.compile(r'(гражданств|гражданин|гражданка|паспорт|страна|подданн)')
+# Страна без явного указания на гражданство ("живу в России") - это место жительства, а не гражданство
+EXPLICIT_CITIZENSHIP_PATTERN = re.compile(r'(гражданств|гражданин|гражданка|паспорт|подданн)')
+# Место жительства/работы: "живу в России", "работаю в Казахстане" - такие ответы разбирает LLM
+LOCATION_PATTERN = re.compile(r'\b(живу|живем|проживаю|проживаем|работаю|работал\w*|нахожусь|находимся|переехал\w*)\b')
+# Слова, допустимые в "голом" ответе страной: "РФ", "Республика Казахстан"
+BARE_COUNTRY_FILLER_WORDS = {'республика', 'республики', 'рес'}
+
+# --- ПРИЗНАКИ ОТКАЗА ОТ ВАКАНСИИ ---
+# Дешевый классификатор: по нему заранее запускается LLM-проверка отказа.
+# Ошибка в сторону "отказ" стоит лишь лишнего короткого запроса, поэтому шаблоны широкие.
+REFUSAL_PATTERN = re.compile(
+    r'(не\s*интерес|не\s*актуальн|не\s*подходит|не\s*устраивает|отказ\w*|передумал\w*|'
+    r'уже\s+наш[её]л|уже\s+нашла|уже\s+работаю|нашл[аи]\s+работу|не\s+хочу|не\s+буду|'
+    r'не\s+пишите|больше\s+не\s+пиш|удалите|не\s+надо|не\s+нужно|нет,?\s+спасибо|спасибо,?\s+нет)'
+)
+
+# --- ЧИСЛИТЕЛЬНЫЕ ДЛЯ ВОЗРАСТА ---
+UNITS = {
+    'один': 1, 'одна': 1, 'два': 2, 'две': 2, 'три': 3, 'четыре': 4, 'пять': 5,
+    'шесть': 6, 'семь': 7, 'восемь': 8, 'девять': 9,
+}
+TEENS = {
+    'десять': 10, 'одиннадцать': 11, 'двенадцать': 12, 'тринадцать': 13,
+    'четырнадцать': 14, 'пятнадцать': 15, 'шестнадцать': 16, 'семнадцать': 17,
+    'восемнадцать': 18, 'девятнадцать': 19,
+}
+TENS = {
+    'двадцать': 20, 'тридцать': 30, 'сорок': 40, 'пятьдесят': 50,
+    'шестьдесят': 60, 'семьдесят': 70,
+}
+
+MIN_AGE = 14
+MAX_AGE = 70
+
+AGE_CONTEXT_PATTERN = re.compile(r'^\s*(лет|года?|годик\w*)\b')
+# Стаж, а не возраст: "стаж 20 лет", "работаю 20 лет", "20 лет опыта"
+EXPERIENCE_PATTERN = re.compile(r'^(стаж\w*|опыт\w*|работ\w*|проработал\w*|отработал\w*|трудов\w*)$')
+DATE_PATTERN = re.compile(r'\b\d{1,2}[./-]\d{1,2}(?:[./-]\d{2,4})?\b')
+TIME_PATTERN = re.compile(r'\b\d{1,2}:\d{2}\b')
+NUMBER_PATTERN = re.compile(r'\b\d{1,4}\b')
+
+
+def _normalize(text: str) -> str:
+    return (text or "").lower().replace("ё", "е")
+
+
+def _has_negation_before(text: str, position: int) -> bool:
+    """Проверяет, есть ли отрицание в двух словах перед найденным совпадением."""
+    preceding_words = text[:position].split()[-2:]
+    return any(NEGATION_PATTERN.fullmatch(word.strip('.,!?;:')) for word in preceding_words)
+
+
+def _is_bare_country(text: str) -> bool:
+    """Ответ состоит только из названия страны ("Россия", "Республика Беларусь")."""
+    words = re.findall(r'[a-zа-я]+', text)
+    all_stems = [stem for stems in COUNTRY_STEMS.values() for stem in stems]
+    return bool(words) and all(
+        word in BARE_COUNTRY_FILLER_WORDS or any(re.match(stem, word) for stem in all_stems)
+        for word in words
+    )
+
+
+def _find_stem(text: str, stems: list) -> Optional[re.Match]:
+    for stem in stems:
+        match = re.search(r'\b' + stem, text)
+        if match:
+            return match
+    return None
+
+
+def extract_citizenship(text: str) -> Tuple[Optional[str], float]:
+    """
+    Определяет гражданство по тексту кандидата.
+    Возвращает значение в тех же терминах, что и LLM-анализ
+    ('ЕАЭС', 'внж рф', 'рвп рф' или название страны) и уверенность.
+    Если в тексте ничего не найдено - (None, низкая уверенность), решение остается за LLM.
+    """
+    normalized = _normalize(text)
+    if not normalized.strip():
+        return None, 0.0
+
+    found = {}
+    negated = False
+
+    for value, patterns in RESIDENCE_PATTERNS.items():
+        for pattern in patterns:
+            match = re.search(pattern, normalized)
+            if match:
+                found[value] = match
+                negated = negated or _has_negation_before(normalized, match.start())
+                break
+
+    # ВНЖ/РВП важнее страны: "гражданин Узбекистана, есть ВНЖ" -> 'внж рф'
+    if len(found) == 1 and not negated:
+        return next(iter(found)), 0.9
+    if found:
+        return None, 0.3
+
+    eaeu_hits = set()
+    other_hits = set()
+    for country, stems in COUNTRY_STEMS.items():
+        match = _find_stem(normalized, stems)
+        if match:
+            (eaeu_hits if country in EAEU_COUNTRIES else other_hits).add(country)
+            negated = negated or _has_negation_before(normalized, match.start())
+
+    if negated:
+        # "не гражданин РФ" и подобное - пусть разбирается LLM
+        return None, 0.3
+
+    if (eaeu_hits or other_hits) and (
+        LOCATION_PATTERN.search(normalized)
+        or not (EXPLICIT_CITIZENSHIP_PATTERN.search(normalized) or _is_bare_country(normalized))
+    ):
+        # "живу в России", "работаю в Казахстане", "я из Таджикистана" - о гражданстве прямо не сказано
+        return None, 0.3
+
+    if eaeu_hits and not other_hits:
+        return 'ЕАЭС', 0.9
+    if len(other_hits) == 1 and not eaeu_hits:
+        return next(iter(other_hits)), 0.85
+    if eaeu_hits or other_hits:
+        # Несколько разных стран в одном ответе - неоднозначно
+        return None, 0.3
+
+    if CITIZENSHIP_HINT_PATTERN.search(normalized):
+        # Кандидат говорит о гражданстве, но страну мы не узнали
+        return None, 0.2
+    return None, 0.5
+
+
+def mentions_citizenship(text: str) -> bool:
+    """Есть ли в тексте хоть что-то про гражданство: страна, ВНЖ/РВП, "паспорт", "гражданство"."""
+    normalized = _normalize(text)
+    if CITIZENSHIP_HINT_PATTERN.search(normalized):
+        return True
+    if any(re.search(pattern, normalized) for patterns in RESIDENCE_PATTERNS.values() for pattern in patterns):
+        return True
+    return any(_find_stem(normalized, stems) for stems in COUNTRY_STEMS.values())
+
+
+def looks_like_refusal(text: str) -> bool:
+    """Быстрая эвристика: похоже ли сообщение кандидата на отказ от вакансии."""
+    return bool(REFUSAL_PATTERN.search(_normalize(text)))
+
+
+def _is_experience(text: str, start: int, end: int) -> bool:
+    """Число стоит в контексте стажа: слово о стаже в двух словах до него или сразу после "лет"."""
+    # Смотрим только в пределах своей части фразы: "20 лет опыта, 41 год"
+    words = re.split(r'[,.;!?]', text[:start])[-1].split()[-2:]
+    context = AGE_CONTEXT_PATTERN.match(text[end:])
+    if context:
+        words += text[end + context.end():].split()[:1]
+    return any(EXPERIENCE_PATTERN.match(word.strip('.,!?;:()')) for word in words)
+
+
+def parse_number_words(text: str) -> list:
+    """
+    Находит в тексте числительные прописью ("двадцать пять", "восемнадцать")
+    и возвращает список (число, позиция начала, позиция конца совпадения).
+    """
+    words = list(re.finditer(r'[а-я]+', _normalize(text)))
+    results = []
+    i = 0
+    while i < len(words):
+        word = words[i].group(0)
+        if word in TENS:
+            value = TENS[word]
+            start, end = words[i].start(), words[i].end()
+            if i + 1 < len(words) and words[i + 1].group(0) in UNITS:
+                value += UNITS[words[i + 1].group(0)]
+                end = words[i + 1].end()
+                i += 1
+            results.append((value, start, end))
+        elif word in TEENS:
+            results.append((TEENS[word], words[i].start(), words[i].end()))
+        i += 1
+    return results
+
+
+def extract_age(text: str) -> Tuple[Optional[int], float]:
+    """
+    Извлекает возраст кандидата из текста.
+    Число с контекстом "лет/год" считается надежным, одиночное число в коротком
+    ответе - достаточно надежным, несколько разных кандидатов - неоднозначно
+    (например, "дочке 16 лет, мне 35"). Числа в контексте стажа не учитываются.
+    """
+    normalized = _normalize(text)
+    if not normalized.strip():
+        return None, 0.0
+
+    # Убираем телефоны, даты и время, чтобы их цифры не путались с возрастом
+    cleaned = PHONE_PATTERN.sub(' ', normalized)
+    cleaned = DATE_PATTERN.sub(' ', cleaned)
+    cleaned = TIME_PATTERN.sub(' ', cleaned)
+
+    candidates = []
+    for match in NUMBER_PATTERN.finditer(cleaned):
+        value = int(match.group(0))
+        if MIN_AGE <= value <= MAX_AGE and not _is_experience(cleaned, match.start(), match.end()):
+            has_context = bool(AGE_CONTEXT_PATTERN.match(cleaned[match.end():]))
+            candidates.append((value, has_context))
+
+    for value, start, end in parse_number_words(cleaned):
+        if MIN_AGE <= value <= MAX_AGE and not _is_experience(cleaned, start, end):
+            has_context = bool(AGE_CONTEXT_PATTERN.match(cleaned[end:]))
+            candidates.append((value, has_context))
+
+    if not candidates:
+        return None, 0.0
+
+    distinct_values = {value for value, _ in candidates}
+    if len(distinct_values) > 1:
+        return None, 0.2
+
+    value = next(iter(distinct_values))
+    if any(has_context for _, has_context in candidates):
+        return value, 0.95
+    # Одно число без "лет": уверенность зависит от длины ответа
+    return value, 0.85 if len(cleaned.split()) <= 6 else 0.6
+
+    return None, 0.2
+
+
+def extract_phone(text: str) -> Tuple[Optional[str], float]:
+    """
+    Извлекает телефон в формате 7XXXXXXXXXX.
+    Российский мобильный номер (7 9XX ...) - максимальная уверенность.
+    """
+    match = PHONE_PATTERN.search(text or "")
+    if not match:
+        return None, 0.0
+
+    digits = "".join(filter(str.isdigit, match.group(0)))
+    if len(digits) == 11 and digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif len(digits) == 10:
+        digits = '7' + digits
+
+    if len(digits) == 11 and digits.startswith('79'):
+        return digits, 1.0
+    if len(digits) == 11 and digits.startswith('7'):
+        return digits, 0.8
+    return digits, 0.4
+
+
+# --- Проверка на примерах ---
+if __name__ == '__main__':
+    for sample in ["РФ", "Республика Беларусь", "гражданин Казахстана", "паспорт РФ", "Узбекистан, есть ВНЖ",
+                   "я из Таджикистана", "Я живу в России уже 5 лет", "работаю в Казахстане",
+                   "нахожусь в РФ", "гражданство есть, живу в России", "нет гражданства РФ", "а какая зарплата?"]:
+        print(f"{sample!r:40} -> {extract_citizenship(sample)}")
+    for sample in ["мне 25 лет", "двадцать два", "19", "тел 89219876543, мне 30", "родился 12.05.1999",
+                   "работаю 20 лет, мне 45", "дочке 16 лет, мне 35", "мне 45, стаж 20 лет", "20 лет опыта, 41 год"]:
+        print(f"{sample!r:40} -> {extract_age(sample)}")
+    for sample in ["+7 (999) 123-45-67", "8 812 123 45 67"]:
+        print(f"{sample!r:40} -> {extract_phone(sample)}")
+    for sample in ["Спасибо, уже не интересно", "нашла работу", "да, интересно", "Когда собеседование?"]:
+        print(f"{sample!r:40} -> {looks_like_refusal(sample)}")
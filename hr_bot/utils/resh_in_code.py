@@ -1,3 +1,7 @@
+# Страны ЕАЭС (включая РФ): граждане подходят без дополнительных документов
+EAEU_COUNTRIES = ['россия', 'беларусь', 'армения', 'киргизия', 'казахстан']
+
+
 def is_candidate_profile_complete(candidate) -> bool:
     """
     Проверяет, заполнены ли все обязательные поля анкеты в БД.
@@ -26,7 +30,7 @@ def check_candidate_eligibility(candidate) -> bool:
     
     # 2. Проверка гражданства
     # Список стран, граждане которых подходят без дополнительных условий
-    allowed_countries = ['рф', 'еаэс', "внж рф", "рвп рф", "россия", "рвп", "внж", "армения", "беларусь", "беларусия", "киргизия", "казахстан"]
+    allowed_countries = ['рф', 'еаэс', "внж рф", "рвп рф", "рвп", "внж", "беларусия"] + EAEU_COUNTRIES
     cand_citizen = (candidate.citizenship or "").lower().strip()
     
     # Если страна из списка найдена в строке гражданства - ОК
@@ -1,62 +1,196 @@
 import os
+import time
 import asyncio
 import logging
 from aiogram import Bot
-from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from hr_bot.db.models import SessionLocal, TelegramUser
 
 # Инициализируем логгер
 logger = logging.getLogger(__name__)
 
-async def send_system_alert(message_text: str, alert_type: str = "admin_only"):
+# --- ДИСПЕТЧЕР АЛЕРТОВ ---
+# send_system_alert больше ничего не отправляет сам: он кладет алерт в очередь и
+# сразу возвращает управление. Фоновая задача раз в ALERT_BATCH_WINDOW_SECONDS
+# собирает накопившиеся алерты в дайджест и рассылает его одним сообщением через
+# один долгоживущий Bot. Получатели кэшируются, повторы одного ключа в пределах
+# ALERT_DEDUP_WINDOW_SECONDS подавляются (в следующем сообщении указывается их число).
+ALERT_BATCH_WINDOW_SECONDS = 3
+ALERT_DEDUP_WINDOW_SECONDS = 600
+ALERT_RECIPIENTS_TTL_SECONDS = 300
+ALERT_QUEUE_MAX_SIZE = 500
+# Лимит Telegram на длину сообщения - 4096, оставляем запас
+ALERT_MESSAGE_MAX_LENGTH = 4000
+
+# Тип алерта -> аудитория. Всем - только явно разрешенные типы,
+# любой другой (включая опечатки) - только админам.
+_AUDIENCE_ALL_TYPES = ("balance", "all")
+
+# Очередь: (аудитория, ключ, текст)
+_pending_alerts = []
+_wakeup = asyncio.Event()
+_stop_event = asyncio.Event()
+_dispatcher_task = None
+_bot = None
+
+# ключ -> момент последней отправки (time.monotonic)
+_last_sent = {}
+# ключ -> сколько повторов подавлено с последней отправки
+_suppressed = {}
+# аудитория -> (список telegram_id, момент устаревания)
+_recipients_cache = {}
+
+
+def _audience(alert_type: str) -> str:
+    return "all" if alert_type in _AUDIENCE_ALL_TYPES else "admin"
+
+
+def send_system_alert(message_text: str, alert_type: str = "admin_only", alert_key: str = None):
     """
-    Отправляет системное уведомление пользователям Telegram-бота.
+    Ставит системное уведомление в очередь на отправку пользователям Telegram-бота.
+    Не ждет отправки и не бросает исключений - можно вызывать где угодно, в том числе под локами.
 
     Параметры:
     - message_text: Текст сообщения.
-    - alert_type: 
-        - "admin_only": (По умолчанию) Ошибки LLM, обновление токенов, сбои API. 
+    - alert_type:
+        - "admin_only": (По умолчанию) Ошибки LLM, обновление токенов, сбои API.
           Отправляется ТОЛЬКО пользователям с ролью 'admin'.
-        - "balance": Сообщения о критическом остатке средств (порог 500р). 
+        - "balance": Сообщения о критическом остатке средств (порог 500р).
           Отправляется ВСЕМ (админам и обычным юзерам).
-        - "all": Критические анонсы или техработы. 
+        - "all": Критические анонсы или техработы.
           Отправляется ВСЕМ.
+    - alert_key: Ключ дедупликации (например, "token_refreshed:<recruiter_id>").
+      По умолчанию - сам текст: одинаковые алерты чаще раза в ALERT_DEDUP_WINDOW_SECONDS не отправляются.
     """
-    
-    # Создаем объект бота внутри функции, чтобы всегда использовать актуальный токен
-    bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
-    
+    try:
+        audience = _audience(alert_type)
+        key = f"{audience}:{alert_key or message_text}"
+
+        last_sent = _last_sent.get(key)
+        if last_sent is not None and time.monotonic() - last_sent < ALERT_DEDUP_WINDOW_SECONDS:
+            _suppressed[key] = _suppressed.get(key, 0) + 1
+            logger.debug(f"Алерт '{key}' подавлен как повтор.")
+            return
+        # Резервируем окно сразу, чтобы повторы до отправки тоже подавлялись
+        _last_sent[key] = time.monotonic()
+
+        if len(_pending_alerts) >= ALERT_QUEUE_MAX_SIZE:
+            dropped = _pending_alerts.pop(0)
+            logger.warning(f"Очередь алертов переполнена, отброшен самый старый: {dropped[2][:100]}")
+        _pending_alerts.append((audience, key, message_text))
+
+        _ensure_dispatcher()
+        _wakeup.set()
+    except Exception as e:
+        logger.error(f"Не удалось поставить алерт в очередь: {e}", exc_info=True)
+
+
+def _ensure_dispatcher():
+    global _dispatcher_task
+    if _dispatcher_task is None or _dispatcher_task.done():
+        _stop_event.clear()
+        _dispatcher_task = asyncio.get_running_loop().create_task(_dispatcher_loop())
+
+
+def _get_bot() -> Bot:
+    global _bot
+    if _bot is None:
+        _bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
+    return _bot
+
+
+async def _get_recipients(audience: str) -> list:
+    cached = _recipients_cache.get(audience)
+    if cached is not None and cached[1] > time.monotonic():
+        return cached[0]
+
+    stmt = select(TelegramUser.telegram_id)
+    if audience != "all":
+        stmt = stmt.where(TelegramUser.role == 'admin')
     async with SessionLocal() as db:
+        recipients = (await db.scalars(stmt)).all()
+
+    _recipients_cache[audience] = (recipients, time.monotonic() + ALERT_RECIPIENTS_TTL_SECONDS)
+    return recipients
+
+
+def _build_digest(alerts: list) -> list:
+    """Склеивает алерты одной аудитории в сообщения не длиннее ALERT_MESSAGE_MAX_LENGTH."""
+    parts = []
+    for key, text in alerts:
+        suppressed = _suppressed.pop(key, 0)
+        if suppressed:
+            text = f"{text}\n(повторов за последние {ALERT_DEDUP_WINDOW_SECONDS // 60} мин.: {suppressed})"
+        parts.append(text[:ALERT_MESSAGE_MAX_LENGTH])
+
+    messages, current = [], ""
+    for part in parts:
+        candidate = f"{current}\n\n— — —\n\n{part}" if current else part
+        if len(candidate) > ALERT_MESSAGE_MAX_LENGTH:
+            messages.append(current)
+            candidate = part
+        current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def _dispatch_pending():
+    if not _pending_alerts:
+        return
+    alerts = _pending_alerts[:]
+    _pending_alerts.clear()
+
+    by_audience = {}
+    for audience, key, text in alerts:
+        by_audience.setdefault(audience, []).append((key, text))
+
+    bot = _get_bot()
+    for audience, audience_alerts in by_audience.items():
         try:
-            # СТРОГАЯ ЛОГИКА ФИЛЬТРАЦИИ:
-            # Только если тип сообщения явно разрешен для всех, выбираем всех.
-            # В любом другом случае (включая опечатки) — только админы.
-            if alert_type in ["balance", "all"]:
-                stmt = select(TelegramUser)
-                logger.debug(f"Рассылка алерта '{alert_type}' всем пользователям.")
-            else:
-                stmt = select(TelegramUser).where(TelegramUser.role == 'admin')
-                logger.debug(f"Рассылка алерта '{alert_type}' только администраторам.")
-                
-            result = await db.execute(stmt)
-            users_to_notify = result.scalars().all()
-            
-            if not users_to_notify:
-                logger.warning(f"Список получателей для алерта '{alert_type}' пуст.")
-                return
-
-            # Отправка сообщений
-            for user in users_to_notify:
+            recipients = await _get_recipients(audience)
+        except Exception as e:
+            logger.error(f"Не удалось получить получателей алертов '{audience}': {e}", exc_info=True)
+            continue
+        if not recipients:
+            logger.warning(f"Список получателей для алертов '{audience}' пуст.")
+            continue
+
+        for text in _build_digest(audience_alerts):
+            for telegram_id in recipients:
                 try:
-                    await bot.send_message(chat_id=user.telegram_id, text=message_text)
+                    await bot.send_message(chat_id=telegram_id, text=text)
                 except Exception as e:
-                    logger.warning(f"Не удалось доставить сообщение пользователю {user.telegram_id} ({user.username}): {e}")
-                    continue 
+                    logger.warning(f"Не удалось доставить алерт пользователю {telegram_id}: {e}")
+
 
+async def _dispatcher_loop():
+    while not _stop_event.is_set():
+        await _wakeup.wait()
+        _wakeup.clear()
+        # Даем соседним алертам (например, серии ошибок одного цикла) попасть в тот же дайджест
+        try:
+            await asyncio.wait_for(_stop_event.wait(), timeout=ALERT_BATCH_WINDOW_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        try:
+            await _dispatch_pending()
         except Exception as e:
-            logger.error(f"Критическая ошибка в функции send_system_alert: {e}", exc_info=True)
-        finally:
-            # Обязательно закрываем сессию бота, чтобы не было утечек памяти
-            if bot.session:
-                await bot.session.close()
\ No newline at end of file
+            logger.error(f"Ошибка рассылки алертов: {e}", exc_info=True)
+
+
+async def stop_alert_dispatcher():
+    """Отправляет оставшиеся в очереди алерты и закрывает сессию бота."""
+    global _dispatcher_task, _bot
+    _stop_event.set()
+    _wakeup.set()
+    if _dispatcher_task is not None:
+        await _dispatcher_task
+        _dispatcher_task = None
+    try:
+        await _dispatch_pending()
+    finally:
+        # Обязательно закрываем сессию бота, чтобы не было утечек
+        if _bot is not None:
+            await _bot.session.close()
+            _bot = None
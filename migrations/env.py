@@ -0,0 +1,49 @@
+# migrations/env.py
+"""
+Окружение alembic. Подключение - синхронный движок (psycopg2) с теми же
+параметрами из .env, что и у приложения; целевые метаданные - модели hr_bot.db.models.
+"""
+from logging.config import fileConfig
+
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from hr_bot.db.models import Base, SYNC_DATABASE_URL
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+
+def _database_url() -> str:
+    # sqlalchemy.url в alembic.ini (или -x url=...) имеет приоритет над .env - удобно для тестовой базы
+    return context.get_x_argument(as_dictionary=True).get("url") or config.get_main_option("sqlalchemy.url") or SYNC_DATABASE_URL
+
+
+def run_migrations_offline():
+    """Генерация SQL без подключения к базе (alembic upgrade head --sql)."""
+    context.configure(
+        url=_database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connectable = create_engine(_database_url(), poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
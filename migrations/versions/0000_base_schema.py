@@ -0,0 +1,175 @@
+"""Исходная схема (таблицы, созданные вручную до появления миграций)
+
+На рабочей базе все эти таблицы уже есть - ревизия ничего не делает. На пустой
+базе (например, отдельной базе для hr_bot.db.query_benchmark) создает их в том
+виде, в каком они были до ревизии 0001, чтобы `alembic upgrade head` работал с нуля.
+
+Revision ID: 0000
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision = '0000'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+UTC_NOW = sa.text("timezone('UTC', now())")
+
+
+def _id_column():
+    return sa.Column('id', sa.Integer(), primary_key=True)
+
+
+# (таблица, колонки, индексы [(имя, колонки)]) - в порядке зависимостей внешних ключей
+BASE_TABLES = [
+    ('tracked_recruiters', lambda: [
+        _id_column(),
+        sa.Column('recruiter_id', sa.String(50), unique=True, nullable=False),
+        sa.Column('name', sa.String(100)),
+        sa.Column('refresh_token', sa.Text(), nullable=True),
+        sa.Column('access_token', sa.Text(), nullable=True),
+        sa.Column('token_expires_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('vacancies_last_synced_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('telegram_chat_id', sa.BigInteger(), nullable=True),
+        sa.Column('topic_qualified_id', sa.Integer(), nullable=True),
+        sa.Column('topic_rejected_id', sa.Integer(), nullable=True),
+        sa.Column('topic_timeout_id', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+    ], []),
+    ('vacancies', lambda: [
+        _id_column(),
+        sa.Column('hh_vacancy_id', sa.String(50), unique=True),
+        sa.Column('title', sa.String(255), nullable=False),
+        sa.Column('city', sa.String(100)),
+        sa.Column('recruiter_id', sa.Integer(), sa.ForeignKey('tracked_recruiters.id'), nullable=True),
+    ], []),
+    ('candidates', lambda: [
+        _id_column(),
+        sa.Column('hh_resume_id', sa.String(50), unique=True),
+        sa.Column('full_name', sa.String(255)),
+        sa.Column('age', sa.Integer()),
+        sa.Column('citizenship', sa.String(100)),
+        sa.Column('phone_number', sa.String(50), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text("now()")),
+        sa.Column('city', sa.String(255), nullable=True),
+        sa.Column('readiness_to_start', sa.String(255), nullable=True),
+    ], []),
+    ('dialogues', lambda: [
+        _id_column(),
+        sa.Column('hh_response_id', sa.String(50), unique=True, nullable=False),
+        sa.Column('recruiter_id', sa.Integer(), sa.ForeignKey('tracked_recruiters.id')),
+        sa.Column('candidate_id', sa.Integer(), sa.ForeignKey('candidates.id')),
+        sa.Column('vacancy_id', sa.Integer(), sa.ForeignKey('vacancies.id')),
+        sa.Column('dialogue_state', sa.String(100)),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('reminder_level', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('history', JSONB()),
+        sa.Column('pending_messages', JSONB()),
+        sa.Column('last_updated', sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column('response_created_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('interview_datetime_utc', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('total_prompt_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_completion_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_cached_tokens', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('total_cost', sa.Numeric(12, 6), nullable=False, server_default='0.0'),
+    ], [('ix_dialogues_last_updated', ['last_updated'])]),
+    ('statistics', lambda: [
+        _id_column(),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('responses_count', sa.Integer()),
+        sa.Column('started_dialogs_count', sa.Integer()),
+        sa.Column('qualified_count', sa.Integer()),
+        sa.Column('vacancy_id', sa.Integer(), sa.ForeignKey('vacancies.id')),
+    ], []),
+    ('telegram_users', lambda: [
+        _id_column(),
+        sa.Column('telegram_id', sa.String(50), unique=True, nullable=False),
+        sa.Column('username', sa.String(100)),
+        sa.Column('role', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=UTC_NOW),
+    ], []),
+    ('notification_queue', lambda: [
+        _id_column(),
+        sa.Column('candidate_id', sa.Integer(), sa.ForeignKey('candidates.id'), nullable=False),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.Column('processed_at', sa.DateTime(timezone=True)),
+    ], []),
+    ('tracked_vacancies', lambda: [
+        _id_column(),
+        sa.Column('vacancy_id', sa.String(50), unique=True, nullable=False),
+        sa.Column('title', sa.String(255)),
+    ], []),
+    ('app_settings', lambda: [
+        _id_column(),
+        sa.Column('balance', sa.Numeric(12, 2), nullable=False, server_default='0.00'),
+        sa.Column('total_spent_on_dialogues', sa.Numeric(12, 2), nullable=False, server_default='0.00'),
+        sa.Column('total_spent_on_reminders', sa.Numeric(12, 2), nullable=False, server_default='0.00'),
+        sa.Column('cost_per_dialogue', sa.Numeric(10, 2), nullable=False, server_default='19.00'),
+        sa.Column('cost_per_long_reminder', sa.Numeric(10, 2), nullable=False, server_default='5.00'),
+        sa.Column('low_balance_threshold', sa.Numeric(10, 2), nullable=False, server_default='500.00'),
+        sa.Column('low_limit_notified', sa.Boolean(), nullable=False, server_default='false'),
+    ], []),
+    ('inactive_notification_queue', lambda: [
+        _id_column(),
+        sa.Column('dialogue_id', sa.Integer(), sa.ForeignKey('dialogues.id'), unique=True, nullable=False),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column('processed_at', sa.DateTime(timezone=True)),
+    ], []),
+    ('rejected_notification_queue', lambda: [
+        _id_column(),
+        sa.Column('dialogue_id', sa.Integer(), sa.ForeignKey('dialogues.id'), unique=True, nullable=False),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column('processed_at', sa.DateTime(timezone=True)),
+    ], []),
+    ('interview_reminders', lambda: [
+        _id_column(),
+        sa.Column('dialogue_id', sa.Integer(), sa.ForeignKey('dialogues.id'), nullable=False),
+        sa.Column('recruiter_id', sa.Integer(), sa.ForeignKey('tracked_recruiters.id'), nullable=False),
+        sa.Column('interview_datetime_utc', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('scheduled_send_time_utc', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('notification_type', sa.String(50), nullable=False),
+        sa.Column('status', sa.String(50), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=UTC_NOW),
+        sa.Column('processed_at', sa.DateTime(timezone=True)),
+    ], [
+        ('ix_interview_reminders_dialogue_id', ['dialogue_id']),
+        ('ix_interview_reminders_recruiter_id', ['recruiter_id']),
+        ('ix_interview_reminders_scheduled_send_time_utc', ['scheduled_send_time_utc']),
+    ]),
+    ('llm_usage_logs', lambda: [
+        _id_column(),
+        sa.Column('dialogue_id', sa.Integer(), sa.ForeignKey('dialogues.id'), nullable=False),
+        sa.Column('dialogue_state_at_call', sa.String(100)),
+        sa.Column('prompt_tokens', sa.Integer()),
+        sa.Column('completion_tokens', sa.Integer()),
+        sa.Column('cached_tokens', sa.Integer()),
+        sa.Column('total_tokens', sa.Integer()),
+        sa.Column('cost', sa.Numeric(10, 6), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=UTC_NOW),
+    ], [('ix_llm_usage_logs_dialogue_id', ['dialogue_id'])]),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, columns, indexes in BASE_TABLES:
+        if inspector.has_table(table):
+            continue
+        op.create_table(table, *columns())
+        # Как у моделей: index=True на первичном ключе
+        op.create_index(f'ix_{table}_id', table, ['id'])
+        for index_name, index_columns in indexes:
+            op.create_index(index_name, table, index_columns)
+
+
+def downgrade():
+    # Исходная схема миграциями не удаляется: на рабочей базе она создана вручную и хранит все данные
+    pass
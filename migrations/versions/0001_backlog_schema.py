@@ -0,0 +1,73 @@
+"""Колонки и таблицы, добавленные в модели после исходной схемы
+
+Исходная схема (vacancies, dialogues, очереди уведомлений и т.д.) создавалась
+вручную до появления миграций, на пустой базе ее создает ревизия 0000. Эта ревизия
+доводит ее до моделей: llm_usage_logs.hedged, vacancies.kb_*, таблица
+dialogue_messages. Все шаги пропускаются, если объект уже создан вручную,
+поэтому ревизию можно применять к базе, где часть изменений уже внесена.
+
+Revision ID: 0001
+Revises: 0000
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+
+revision = '0001'
+down_revision = '0000'
+branch_labels = None
+depends_on = None
+
+
+def _has_column(table: str, column: str) -> bool:
+    return column in {c['name'] for c in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def _has_table(table: str) -> bool:
+    return sa.inspect(op.get_bind()).has_table(table)
+
+
+def upgrade():
+    if not _has_column('llm_usage_logs', 'hedged'):
+        op.add_column('llm_usage_logs', sa.Column('hedged', sa.Boolean(), nullable=False, server_default='false'))
+
+    if not _has_column('vacancies', 'kb_description_key'):
+        op.add_column('vacancies', sa.Column('kb_description_key', sa.String(255), nullable=True))
+    if not _has_column('vacancies', 'kb_library_version'):
+        op.add_column('vacancies', sa.Column('kb_library_version', sa.String(64), nullable=True))
+    if not _has_column('vacancies', 'kb_resolved_at'):
+        op.add_column('vacancies', sa.Column('kb_resolved_at', sa.DateTime(timezone=True), nullable=True))
+
+    if not _has_table('dialogue_messages'):
+        op.create_table(
+            'dialogue_messages',
+            sa.Column('id', sa.BigInteger(), primary_key=True),
+            sa.Column('dialogue_id', sa.Integer(), sa.ForeignKey('dialogues.id', ondelete='CASCADE'), nullable=False),
+            sa.Column('hh_message_id', sa.String(100), nullable=True),
+            sa.Column('role', sa.String(20), nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('timestamp_msk', sa.String(50), nullable=True),
+            sa.Column('extracted_data', JSONB(), nullable=True),
+            sa.Column('state', sa.String(100), nullable=True),
+            sa.Column('is_processed', sa.Boolean(), nullable=False, server_default='false'),
+            sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text("timezone('UTC', now())")),
+            sa.Column('processed_at', sa.DateTime(timezone=True), nullable=True),
+        )
+        op.create_index('ix_dialogue_messages_dialogue_id_id', 'dialogue_messages', ['dialogue_id', 'id'])
+        op.create_index(
+            'ix_dialogue_messages_unprocessed', 'dialogue_messages', ['dialogue_id'],
+            postgresql_where=sa.text('is_processed = false'),
+        )
+        op.create_index(
+            'uq_dialogue_messages_hh_message_id', 'dialogue_messages', ['dialogue_id', 'hh_message_id'],
+            unique=True, postgresql_where=sa.text('hh_message_id IS NOT NULL'),
+        )
+
+
+def downgrade():
+    op.drop_table('dialogue_messages')
+    op.drop_column('vacancies', 'kb_resolved_at')
+    op.drop_column('vacancies', 'kb_library_version')
+    op.drop_column('vacancies', 'kb_description_key')
+    op.drop_column('llm_usage_logs', 'hedged')
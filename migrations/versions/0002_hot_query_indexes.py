@@ -0,0 +1,61 @@
+"""Составные и частичные индексы под горячие запросы воркера и бота
+
+  - process_reminders: (recruiter_id, reminder_level) INCLUDE (dialogue_state)
+    WHERE status = 'in_progress' - выборка id идет только по индексу;
+  - process_pending_dialogues: (recruiter_id, last_updated) + частичный индекс
+    ix_dialogue_messages_unprocessed из 0001 для EXISTS по очереди сообщений;
+  - очереди уведомлений: частичные индексы WHERE status = 'pending'
+    (отправленные записи в индекс не попадают, он остается крошечным);
+  - напоминания о собеседованиях: scheduled_send_time_utc WHERE status = 'pending';
+  - статистика/выгрузка: created_at (запросы переписаны на диапазон вместо
+    cast(created_at as date) - выражение с timestamptz::date нельзя проиндексировать).
+
+Индексы создаются CONCURRENTLY, чтобы не блокировать запись на рабочей базе.
+Планы проверяются скриптом python -m hr_bot.db.query_benchmark.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# (имя, таблица, колонки, доп. параметры create_index)
+HOT_QUERY_INDEXES = [
+    ('ix_dialogues_reminder_scan', 'dialogues', ['recruiter_id', 'reminder_level'], {
+        'postgresql_where': sa.text("status = 'in_progress'"),
+        'postgresql_include': ['dialogue_state'],
+    }),
+    ('ix_dialogues_recruiter_id_last_updated', 'dialogues', ['recruiter_id', 'last_updated'], {}),
+    ('ix_dialogues_created_at', 'dialogues', ['created_at'], {}),
+    ('ix_notification_queue_pending', 'notification_queue', ['id'], {
+        'postgresql_where': sa.text("status = 'pending'"),
+    }),
+    ('ix_inactive_notification_queue_pending', 'inactive_notification_queue', ['id'], {
+        'postgresql_where': sa.text("status = 'pending'"),
+    }),
+    ('ix_rejected_notification_queue_pending', 'rejected_notification_queue', ['id'], {
+        'postgresql_where': sa.text("status = 'pending'"),
+    }),
+    ('ix_interview_reminders_pending_send_time', 'interview_reminders', ['scheduled_send_time_utc'], {
+        'postgresql_where': sa.text("status = 'pending'"),
+    }),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+    with op.get_context().autocommit_block():
+        for name, table, columns, options in HOT_QUERY_INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **options)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(HOT_QUERY_INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
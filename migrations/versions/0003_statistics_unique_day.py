@@ -0,0 +1,48 @@
+"""Уникальная строка статистики на (vacancy_id, date)
+
+Старый update_stats (SELECT, затем INSERT) при гонке двух диалогов одной
+вакансии создавал дубли за день. Перед созданием ограничения дубли
+схлопываются: счетчики суммируются в строку с минимальным id, остальные удаляются.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("""
+        WITH totals AS (
+            SELECT min(id) AS keep_id, vacancy_id, date,
+                   sum(coalesce(responses_count, 0)) AS responses_count,
+                   sum(coalesce(started_dialogs_count, 0)) AS started_dialogs_count,
+                   sum(coalesce(qualified_count, 0)) AS qualified_count
+            FROM statistics
+            GROUP BY vacancy_id, date
+            HAVING count(*) > 1
+        )
+        UPDATE statistics s
+        SET responses_count = t.responses_count,
+            started_dialogs_count = t.started_dialogs_count,
+            qualified_count = t.qualified_count
+        FROM totals t
+        WHERE s.id = t.keep_id
+    """)
+    op.execute("""
+        DELETE FROM statistics s
+        USING statistics keep
+        WHERE s.vacancy_id IS NOT DISTINCT FROM keep.vacancy_id
+          AND s.date = keep.date
+          AND s.id > keep.id
+    """)
+    op.create_unique_constraint('uq_statistics_vacancy_id_date', 'statistics', ['vacancy_id', 'date'])
+
+
+def downgrade():
+    op.drop_constraint('uq_statistics_vacancy_id_date', 'statistics', type_='unique')
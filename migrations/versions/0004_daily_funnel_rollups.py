@@ -0,0 +1,35 @@
+"""Таблица дневной воронки daily_funnel_rollups
+
+Первичное заполнение после миграции: python -m hr_bot.db.funnel_rollups [дней, по умолчанию 365]
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+COUNTER_COLUMNS = (
+    'responses_count', 'started_count', 'qualified_count', 'rejected_count',
+    'declined_by_candidate_count', 'declined_by_us_count', 'silent_count', 'silent_started_count',
+)
+
+
+def upgrade():
+    op.create_table(
+        'daily_funnel_rollups',
+        sa.Column('date', sa.Date(), primary_key=True),
+        sa.Column('recruiter_id', sa.Integer(), primary_key=True),
+        sa.Column('vacancy_id', sa.Integer(), primary_key=True),
+        *[sa.Column(name, sa.Integer(), nullable=False, server_default='0') for name in COUNTER_COLUMNS],
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text("timezone('UTC', now())")),
+    )
+
+
+def downgrade():
+    op.drop_table('daily_funnel_rollups')
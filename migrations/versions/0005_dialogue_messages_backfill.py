@@ -0,0 +1,73 @@
+"""Перенос старых JSONB-массивов dialogues.history / pending_messages в dialogue_messages
+
+Без переноса воркер не видит ни истории старых диалогов, ни уже известных
+id сообщений HH - и заново ставит в очередь всю переписку кандидата.
+Перенос идет пачками по диалогам; перенесенные массивы обнуляются, поэтому
+повторный запуск (и запуск на базе без старых данных) ничего не делает.
+Порядок сообщений сохраняется, дубли message_id внутри массива пропускаются.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 500
+
+UNMIGRATED_IDS_SQL = sa.text("""
+    SELECT id FROM dialogues
+    WHERE jsonb_typeof(history) = 'array' OR jsonb_typeof(pending_messages) = 'array'
+    ORDER BY id
+    LIMIT :limit
+""")
+
+# Элемент-объект - сообщение в формате {'message_id', 'role', 'content', ...},
+# любой другой элемент переносится как текст сообщения кандидата
+COPY_MESSAGES_SQL = sa.text("""
+    INSERT INTO dialogue_messages (
+        dialogue_id, hh_message_id, role, content, timestamp_msk,
+        extracted_data, state, is_processed, processed_at
+    )
+    SELECT
+        d.id,
+        CASE WHEN is_object THEN e.entry ->> 'message_id' END,
+        CASE WHEN is_object THEN coalesce(e.entry ->> 'role', 'user') ELSE 'user' END,
+        CASE WHEN is_object THEN coalesce(e.entry ->> 'content', '') ELSE coalesce(e.entry #>> '{}', '') END,
+        CASE WHEN is_object THEN e.entry ->> 'timestamp_msk' END,
+        CASE WHEN is_object THEN nullif(e.entry -> 'extracted_data', 'null'::jsonb) END,
+        CASE WHEN is_object THEN e.entry ->> 'state' END,
+        src.is_processed,
+        CASE WHEN src.is_processed THEN timezone('UTC', now()) END
+    FROM dialogues d
+    CROSS JOIN LATERAL (VALUES (1, true, d.history), (2, false, d.pending_messages)) src(part, is_processed, entries)
+    CROSS JOIN LATERAL jsonb_array_elements(
+        CASE WHEN jsonb_typeof(src.entries) = 'array' THEN src.entries ELSE '[]'::jsonb END
+    ) WITH ORDINALITY e(entry, n)
+    CROSS JOIN LATERAL (SELECT jsonb_typeof(e.entry) = 'object' AS is_object) t
+    WHERE d.id = ANY(:ids)
+    ORDER BY d.id, src.part, e.n
+    ON CONFLICT DO NOTHING
+""")
+
+CLEAR_ARRAYS_SQL = sa.text("UPDATE dialogues SET history = NULL, pending_messages = NULL WHERE id = ANY(:ids)")
+
+
+def upgrade():
+    connection = op.get_bind()
+    while True:
+        ids = connection.execute(UNMIGRATED_IDS_SQL, {"limit": BATCH_SIZE}).scalars().all()
+        if not ids:
+            break
+        connection.execute(COPY_MESSAGES_SQL, {"ids": ids})
+        connection.execute(CLEAR_ARRAYS_SQL, {"ids": ids})
+
+
+def downgrade():
+    # Сообщения остаются в dialogue_messages - обратно в JSONB их никто не читает
+    pass
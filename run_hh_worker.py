@@ -11,19 +11,28 @@ import datetime
 from sqlalchemy.orm import selectinload
 from sqlalchemy.orm import selectinload
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-from decimal import Decimal
 import difflib
 import re
 
 from hr_bot.utils.logger_config import setup_logging
-from hr_bot.db.models import SessionLocal, Dialogue, Candidate, Vacancy, NotificationQueue, TrackedRecruiter, AppSettings, InactiveNotificationQueue, RejectedNotificationQueue, InterviewReminder, LlmUsageLog
+from hr_bot.db.models import SessionLocal, Dialogue, Candidate, Vacancy, NotificationQueue, TrackedRecruiter, AppSettings, InactiveNotificationQueue, RejectedNotificationQueue, InterviewReminder
 from hr_bot.services import hh_api_real as hh_api
 from hr_bot.services import knowledge_base
-from hr_bot.services import llm_handler
+from hr_bot.services import llm_profiles
+from hr_bot.services import llm_reply_cache
+from hr_bot.services import usage_accounting
+from hr_bot.services import turn_executor
+from hr_bot.services import vacancy_matcher
+from hr_bot.services import prompt_compiler
 from hr_bot.db import statistics_manager
+from hr_bot.db import dialogue_messages
+from hr_bot.db import funnel_rollups
+# Импорт регистрирует NOTIFY боту при постановке записей в очереди уведомлений
+from hr_bot.db import notification_queues  # noqa: F401
 
 from hr_bot.utils.pii_masker import extract_and_mask_pii
-from hr_bot.utils.system_notifier import send_system_alert
+from hr_bot.utils import local_extractor
+from hr_bot.utils.system_notifier import send_system_alert, stop_alert_dispatcher
 from hr_bot.utils.resh_in_code import check_candidate_eligibility, is_candidate_profile_complete
 import signal
 import sys
@@ -31,7 +40,7 @@ from hr_bot.services.llm_handler import cleanup
 from hr_bot.utils.system_notifier import send_system_alert
 from sqlalchemy import func, select, delete, update  
 from hr_bot.services import interview_reminder_manager
-from sqlalchemy import func, select, delete, and_, case, literal # <--- Добавьте case и literal
+from sqlalchemy import func, select, delete, and_, literal
 # ... остальные импорты
 
 logger = logging.getLogger(__name__)
@@ -48,9 +57,11 @@ VACANCY_CACHE_DURATION_MINUTES = 2 # Время кэширования спис
 # Новые константы для окна доставки напоминаний (местное время сервера)
 REMINDER_START_HOUR_LOCAL = 9  # Например, 9:00 утра
 REMINDER_END_HOUR_LOCAL = 20 # Например, 20:00 вечера (напоминания отправляются до 19:59 включительно)
+VACANCY_DESCRIPTION_NOT_FOUND = (
+    "ОПИСАНИЕ ВАКАНСИИ НЕ НАЙДЕНО. "
+    "Отвечай на вопросы кандидата на основе общей информации из FAQ."
+)
 
-PRICE_PER_MILLION_INPUT_TOKENS = 0.150  # $0.150 за 1M входных токенов (gpt-4o-mini)
-PRICE_PER_MILLION_OUTPUT_TOKENS = 0.600 # $0.600 за 1M выходных токенов (gpt-4o-mini)
 
 
 def _format_timestamp_to_msk(timestamp_str: str) -> str:
@@ -80,6 +91,11 @@ def _validate_age_in_text(text: str, suggested_age: any) -> bool:
     except (ValueError, TypeError):
         return False
 
+    # 0. Локальный экстрактор только подтверждает совпадение; расхождение решают проверки ниже
+    local_age, local_confidence = local_extractor.extract_age(text)
+    if local_age == age_to_check and local_confidence >= local_extractor.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD:
+        return True
+
     # 1. Простая проверка на вхождение числа как отдельного слова (чтобы не путать с 170см)
     # Ищем число age_to_check окруженное границами слов
     if re.search(r'\b' + str(age_to_check) + r'\b', text):
@@ -127,46 +143,6 @@ shutdown_requested = False
 
 
 
-async def _record_citizenship_usage(db: AsyncSession, dialogue: Dialogue, llm_data: dict):
-    """Специальная функция для учета токенов побочного запроса (гражданство)"""
-    usage_stats = llm_data.get("usage_stats")
-    if not usage_stats:
-        return
-
-    try:
-        p_tokens = usage_stats.get('prompt_tokens', 0)
-        c_tokens = usage_stats.get('completion_tokens', 0)
-        cached_tokens = usage_stats.get('cached_tokens', 0)
-        total_tokens = usage_stats.get('total_tokens', 0)
-
-        # Расчет стоимости
-        cost_input_regular = (max(0, p_tokens - cached_tokens) / 1_000_000) * PRICE_PER_MILLION_INPUT_TOKENS
-        cost_input_cached = (cached_tokens / 1_000_000) * (PRICE_PER_MILLION_INPUT_TOKENS / 2)
-        cost_output = (c_tokens / 1_000_000) * PRICE_PER_MILLION_OUTPUT_TOKENS
-        total_call_cost = Decimal(str(cost_input_regular + cost_input_cached + cost_output))
-
-        # Запись в лог
-        usage_log = LlmUsageLog(
-            dialogue_id=dialogue.id,
-            dialogue_state_at_call="Citizenship_Analysis",
-            prompt_tokens=p_tokens,
-            completion_tokens=c_tokens,
-            cached_tokens=cached_tokens,
-            total_tokens=total_tokens,
-            cost=total_call_cost
-        )
-        db.add(usage_log)
-
-        # Обновление счетчиков диалога
-        dialogue.total_prompt_tokens += p_tokens
-        dialogue.total_completion_tokens += c_tokens
-        dialogue.total_cached_tokens += cached_tokens
-        dialogue.total_cost += total_call_cost
-        
-        await db.flush()
-    except Exception as e:
-        logger.error(f"Ошибка логирования токенов гражданства: {e}")
-
 def signal_handler(sig, frame):
     """Обработчик сигналов для graceful shutdown"""
     global shutdown_requested
@@ -463,10 +439,11 @@ async def process_new_responses(recruiter_id: int, vacancy_ids: list):
                             'timestamp_msk': _format_timestamp_to_msk(resp.get('created_at', now_msk)) # <-- ДОБАВЛЕНО
                         }]
 
-                    dialogue.pending_messages = messages
+                    await db.flush() # Нужен dialogue.id для сообщений
+                    dialogue_messages.add_pending(db, dialogue.id, messages)
                     dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
 
-                    await statistics_manager.update_stats(db, vacancy_in_db.id, responses=1, started_dialogs=1)
+                    statistics_manager.record_stats(db, vacancy_in_db.id, responses=1, started_dialogs=1)
 
                     # --- ВАЖНО: КОММИТИМ СРАЗУ ДЛЯ КАЖДОГО КАНДИДАТА ---
                     # Это гарантирует, что если мы перенесли его в consider, он сохранится в БД
@@ -476,10 +453,10 @@ async def process_new_responses(recruiter_id: int, vacancy_ids: list):
                     # Проверка лимита для уведомления
                     # УВЕДОМЛЕНИЕ О НИЗКОМ БАЛАНСЕ
                     if settings.balance < settings.low_balance_threshold and not settings.low_limit_notified:
-                        asyncio.create_task(send_system_alert(
+                        send_system_alert(
                             f"⚠️ Внимание! Баланс ниже {settings.low_balance_threshold} руб. "
                             f"Текущий остаток: {settings.balance} руб.", alert_type="balance"
-                        ))
+                        )
                         settings.low_limit_notified = True
 
                     # Если баланс пополнили выше порога, сбрасываем флаг (опционально, но удобно)
@@ -581,13 +558,8 @@ async def process_ongoing_responses(recruiter_id: int, vacancy_ids: list):
                     f"API get_messages took: {time.monotonic() - api_get_messages_start:.2f} sec."
                 )
 
-                saved_message_ids = {str(h.get('message_id')) for h in (dialogue.history or [])}
-                pending_message_ids = {
-                    str(p.get('message_id'))
-                    for p in (dialogue.pending_messages or [])
-                    if isinstance(p, dict)
-                }
-                seen_ids = saved_message_ids.union(pending_message_ids)
+                # id уже сохраненных сообщений (история + очередь)
+                seen_ids = await dialogue_messages.get_known_message_ids(db, dialogue.id)
 
                 new_messages_for_pending = [
                     {
@@ -606,7 +578,7 @@ async def process_ongoing_responses(recruiter_id: int, vacancy_ids: list):
                     if dialogue.reminder_level > 0:
                         dialogue.reminder_level = 0
 
-                    dialogue.pending_messages = (dialogue.pending_messages or []) + new_messages_for_pending
+                    dialogue_messages.add_pending(db, dialogue.id, new_messages_for_pending)
                     dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
 
                     logger.info(f"Добавлено {len(new_messages_for_pending)} новых сообщений в диалог {response_id}.")
@@ -624,128 +596,35 @@ async def process_ongoing_responses(recruiter_id: int, vacancy_ids: list):
                 f"process_ongoing_responses finished in {time.monotonic() - function_start_time:.2f}s"
             )
 
-def _log_missing_vacancy(title: str, city: str):
-    """
-    Записывает ненайденную вакансию в файл missing_vacancies.txt.
-    Проверяет файл на наличие дубликатов перед записью.
-    """
-    file_path = "missing_vacancies.txt"
-    # Формируем строку для записи
-    entry = f"{title} | {city}"
-    
-    try:
-        # Читаем существующие записи, чтобы избежать дублей
-        existing_lines = set()
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                # Собираем set очищенных строк
-                existing_lines = {line.strip() for line in f}
-        except FileNotFoundError:
-            # Если файла нет, просто создадим его при записи
-            pass
-
-        # Если такой записи еще нет, добавляем
-        if entry not in existing_lines:
-            with open(file_path, "a", encoding="utf-8") as f:
-                f.write(f"{entry}\n")
-                
-    except Exception as e:
-        # Логируем ошибку, но не ломаем работу бота
-        logger.error(f"Ошибка при записи в missing_vacancies.txt: {e}")
-
-
-def _find_relevant_vacancy(prompt_library: dict, vacancy_title: str, vacancy_city: str) -> str:
+def _find_relevant_vacancy(prompt_library: dict, vacancy: Vacancy) -> tuple:
     """
-    Поиск вакансии по принципу BEST MATCH с логикой исключения по критическим словам.
+    Возвращает (ключ описания или None, описание вакансии) из библиотеки промптов.
+    Результат подбора хранится в Vacancy (kb_description_key + kb_library_version):
+    пока версия библиотеки не изменилась, это просто чтение колонки.
+    Ненайденные вакансии видны в отчете /missing_vacancies (kb_description_key IS NULL).
     """
+    vacancy_title = vacancy.title
+    vacancy_city = vacancy.city or "город не указан"
+    library_version = prompt_library.get("version")
+
+    if library_version and vacancy.kb_library_version == library_version:
+        best_match_vacancy = vacancy_matcher.get_vacancy_by_key(prompt_library, vacancy.kb_description_key)
+        if best_match_vacancy:
+            return vacancy.kb_description_key, best_match_vacancy.get("description", "")
+        if not vacancy.kb_description_key:
+            return None, VACANCY_DESCRIPTION_NOT_FOUND
+
+    # Версия библиотеки сменилась (или подбора еще не было) - подбираем заново
+    best_match_vacancy, matched_city_name, best_match_score = vacancy_matcher.find_vacancy(
+        prompt_library, vacancy_title, vacancy_city
+    )
 
-    def normalize_text(text: str) -> str:
-        if not text: 
-            return ""
-        text = text.lower().replace("ё", "е")
-        text = re.sub(r"[^\w\s]", " ", text)
-        return " ".join(text.split())
-
-    def get_title_similarity(input_str: str, db_str: str) -> float:
-        input_words = set(normalize_text(input_str).split())
-        db_words = set(normalize_text(db_str).split())
-
-        intersection = input_words.intersection(db_words)
-        if not intersection:
-            return 0.0
-
-        critical_words = {
-            'старший', 'младший', 'ночной', 'неполный', 'мобильный', 
-            'администратор', 'директор', 'товаровед', 'универсал', 
-            'пекарь', 'повар', 'кафе', 'бариста', 'кухни', 'сборщик', 'кассир'
-        }
-
-        extra_in_db = db_words - input_words
-        for word in extra_in_db:
-            if word in critical_words:
-                return 0.0
-
-        extra_in_input = input_words - db_words
-        for word in extra_in_input:
-             if word in critical_words:
-                return 0.0
-
-        recall = len(intersection) / len(db_words)
-        precision = len(intersection) / len(input_words)
-        
-        return (recall * 0.4) + (precision * 0.6)
-
-    # Логика обработки городов
-    norm_input_city = normalize_text(vacancy_city)
-    city_synonyms = {
-        "спб": "санкт петербург",
-        "питер": "санкт петербург",
-        "ленобласть": "ленинградская область"
-    }
-    for short, full in city_synonyms.items():
-        if short in norm_input_city:
-            norm_input_city = norm_input_city.replace(short, full)
-
-    best_match_vacancy = None
-    best_match_score = 0.0
-    matched_city_name = "не определен" # Переменная для хранения города из БД
-
-    # Перебираем вакансии из библиотеки
-    for vacancy in prompt_library.get("vacancies", []):
-        
-        # --- ПРОВЕРКА ГОРОДА ---
-        city_match = False
-        current_vacancy_matched_city = None
-        
-        db_cities_raw = vacancy.get("cities", [])
-        # Создаем список нормализованных городов для сравнения
-        db_cities_norm = [normalize_text(c) for c in db_cities_raw]
-        
-        for i, db_city_norm in enumerate(db_cities_norm):
-            if norm_input_city in db_city_norm or db_city_norm in norm_input_city:
-                city_match = True
-                # Запоминаем оригинальное название города из БД (например, "Бугры (СПб)")
-                current_vacancy_matched_city = db_cities_raw[i]
-                break
-        
-        if not city_match:
-            continue
-
-        # --- ПРОВЕРКА НАЗВАНИЯ ---
-        max_title_score = 0.0
-        for db_title in vacancy.get("titles", []):
-            score = get_title_similarity(vacancy_title, db_title)
-            if score > max_title_score:
-                max_title_score = score
-
-        if max_title_score < 0.4:
-            continue
-
-        # Запоминаем лучший результат
-        if max_title_score > best_match_score:
-            best_match_score = max_title_score
-            best_match_vacancy = vacancy
-            matched_city_name = current_vacancy_matched_city
+    # Аварийную библиотеку не запоминаем - в ней нет вакансий, все оказались бы "не найдены"
+    description_key = vacancy_matcher.vacancy_key(best_match_vacancy) if best_match_vacancy else None
+    if library_version and library_version != "emergency":
+        vacancy.kb_description_key = description_key
+        vacancy.kb_library_version = library_version
+        vacancy.kb_resolved_at = datetime.datetime.now(datetime.timezone.utc)
 
     # --- РЕЗУЛЬТАТ С РАСШИРЕННЫМ ЛОГОМ ---
     if best_match_vacancy:
@@ -757,7 +636,7 @@ def _find_relevant_vacancy(prompt_library: dict, vacancy_title: str, vacancy_cit
             matched_city_name,
             best_match_score
         )
-        return best_match_vacancy.get("description", "")
+        return description_key, best_match_vacancy.get("description", "")
 
     # Если ничего не нашли
     logger.warning(
@@ -765,170 +644,125 @@ def _find_relevant_vacancy(prompt_library: dict, vacancy_title: str, vacancy_cit
         vacancy_title,
         vacancy_city,
     )
-    _log_missing_vacancy(vacancy_title, vacancy_city)
+    return None, VACANCY_DESCRIPTION_NOT_FOUND
+
+async def _await_citizenship_call(citizenship_call, dialogue_id: int, db_pending_messages: list):
+    """Дожидается LLM-анализа гражданства и кэширует его. Возвращает parsed_response."""
+    citizenship_llm_data = await citizenship_call.wait()
+    # Результат не зависит от отправки в HH: сохраняем, чтобы не платить за него при ретрае диалога
+    llm_reply_cache.store_reply(dialogue_id, "citizenship", db_pending_messages, citizenship_llm_data)
+    return citizenship_llm_data.get('parsed_response')
 
-    return (
-        "ОПИСАНИЕ ВАКАНСИИ НЕ НАЙДЕНО. "
-        "Отвечай на вопросы кандидата на основе общей информации из FAQ."
-    )
 
-def _generate_calendar_context() -> str:
+def _apply_citizenship_result(dialogue: Dialogue, pending_messages: list, citizenship_result: dict) -> list:
     """
-    Генерирует текстовый блок с календарем и правилами работы с датами.
+    Применяет результат анализа гражданства (локального или LLM) к ходу диалога.
+    Возвращает новый список pending-сообщений (с системной командой) или исходный,
+    если информации о гражданстве нет. Коммит не делает - все сохраняется одной транзакцией.
     """
-    moscow_tz = ZoneInfo("Europe/Moscow")
-    current_datetime_utc = datetime.datetime.now(moscow_tz)
-    weekdays_ru = ["понедельник", "вторник", "среда", "четверг", "пятница", "суббота", "воскресенье"]
-    
-    # Словарь для склонения в "следующий/следующая/следующее"
-    weekday_next_form = {
-        "понедельник": "Следующий понедельник",
-        "вторник": "Следующий вторник",
-        "среда": "Следующая среда",
-        "четверг": "Следующий четверг",
-        "пятница": "Следующая пятница",
-        "суббота": "Следующая суббота",
-        "воскресенье": "Следующее воскресенье"
+    if not (citizenship_result and citizenship_result.get("is") == "yes"):
+        logger.info(f"[{dialogue.hh_response_id}] Информация о гражданстве не найдена в текущем сообщении.")
+        return pending_messages
+
+    citizenship = citizenship_result.get("citizenship")
+    logger.info(f"[{dialogue.hh_response_id}] Распарсили гражданство: {citizenship}")
+
+    if citizenship == "ЕАЭС":
+        system_command_content = "[SYSTEM COMMAND] Кандидат сообщил что у него гражданство одной из стран ЕАЭС. Установи extracted_data.citizenship='ЕАЭС'. Переходи к следующему этапу (возрасту) и ОБЯЗАТЕЛЬНО задай кандидату вопрос про его возраст."
+    elif citizenship == "внж рф" or  citizenship == "рвп рф":
+        system_command_content = "[SYSTEM COMMAND] Кандидат сообщил что у него РВП РФ или ВНЖ РФ, поставь в поле citizenship строго значение строго значение 'внж рф' или 'рвп рф' соответственно и переходи к следующему этапу анкеты (возрасту) и ОБЯЗАТЕЛЬНО задай кандидату вопрос про его возраст."
+    else:
+        system_command_content = f"[SYSTEM COMMAND] Кандидат сообщил что у него гражданство {citizenship}, уточни есть ли у него РВП или ВНЖ в России."
+        dialogue.dialogue_state = "clarifying_citizenship"
+
+    system_command = {
+        'message_id': f'sys_cmd_citizenship_{time.time()}',
+        'role': 'user',
+        'content': system_command_content
     }
+    dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
+    # Добавляем системную команду в очередь
+    return (pending_messages or []) + [system_command]
 
-    current_weekday = weekdays_ru[current_datetime_utc.weekday()]
-    current_date_str = current_datetime_utc.strftime("%Y-%m-%d")
-    current_time_str = current_datetime_utc.strftime("%H:%M")
-
-    # Собираем информацию о днях недели для отслеживания повторений
-    weekday_occurrences = {}
-    
-    calendar_context_lines = []
-    for i in range(14):
-        date_cursor = current_datetime_utc + datetime.timedelta(days=i)
-        wd_name = weekdays_ru[date_cursor.weekday()]
-        date_str = date_cursor.strftime("%Y-%m-%d")
-        
-        # Отслеживаем, сколько раз встречался этот день недели
-        if wd_name not in weekday_occurrences:
-            weekday_occurrences[wd_name] = 0
-        weekday_occurrences[wd_name] += 1
-        
-        # Формируем префикс и суффикс
-        prefix = ""
-        suffix = ""
-        
-        if i == 0:
-            prefix = "(СЕГОДНЯ) "
-            suffix = " ← ТЫ ЗДЕСЬ"
-            day_label = wd_name.capitalize()
-        elif i == 1:
-            prefix = "(ЗАВТРА) "
-            day_label = wd_name.capitalize()
-        elif i == 2:
-            prefix = "(ПОСЛЕЗАВТРА) "
-            day_label = wd_name.capitalize()
-        else:
-            # Для остальных дней
-            if weekday_occurrences[wd_name] == 2:
-                # Второе упоминание дня недели - добавляем "Следующий"
-                day_label = weekday_next_form[wd_name]
-            else:
-                # Первое упоминание или третье+ - просто название с заглавной
-                day_label = wd_name.capitalize()
-        
-        calendar_context_lines.append(f"{prefix}{date_str} {day_label}{suffix}")
-
-    calendar_string = "\n".join(calendar_context_lines)
-
-    calendar_context = (
-        f"\n\n[CRITICAL CALENDAR CONTEXT]\n"
-        f"ТЕКУЩАЯ ДАТА И ВРЕМЯ (МСК): {current_datetime_utc.strftime('%Y-%m-%d %H:%M')}\n"
-        f"СЕГОДНЯ: {current_weekday}, {current_date_str}\n\n"
-        f"СЕЙЧАС: {current_time_str} (МСК)\n"
-        f"⚠️ ВАЖНО: Ты ОЧЕНЬ ПЛОХО считаешь даты в уме. НИКОГДА НЕ ВЫЧИСЛЯЙ ДАТЫ САМОСТОЯТЕЛЬНО!\n"
-        f"Используй ТОЛЬКО эту таблицу (таблица начинается с СЕГОДНЯ и идет на 14 дней вперед):\n\n"
-        f"{calendar_string}\n\n"
-        f"ПРАВИЛА РАБОТЫ С ДАТАМИ:\n"
-        f"1. Кандидат говорит просто день недели ('понедельник', 'вторник'):\n"
-        f"   → Найди ПЕРВУЮ строку с этим днем (без слова 'Следующий')\n"
-        f"   → Скопируй дату из этой строки\n\n"
-        f"2. Если кандидат говорит 'СЛЕДУЮЩИЙ [день недели]' (например, 'следующий понедельник'):\n"
-        f"   → Бери такой день из списка выше, где написано 'СЛЕДУЮЩИЙ [день недели]' (например, 'следующий понедельник')\n\n"
-        f"   → Скопируй дату из этой строки\n\n"
-        f"3. Если кандидат называет день недели, который совпадает с СЕГОДНЯ:\n"
-        f"   → ОБЯЗАТЕЛЬНО уточни: 'Вы имеете в виду сегодня или через неделю?'\n\n"
-        f"4. Если кандидат говорит 'сегодня', 'завтра', 'послезавтра':\n"
-        f"   → Ищи в списке пометку 'СЕГОДНЯ', 'ЗАВТРА' или 'ПОСЛЕЗАВТРА'\n\n"
-        f"5. ВСЕГДА копируй дату ТОЧНО из таблицы в формате YYYY-MM-DD\n"
-        f"6. НИКОГДА не изобретай даты сам - только из этой таблицы!\n"
-        f"═══════════════════════════════════════════════════════════\n"
-        f"ПРИМЕРЫ:\n"
-        f"═══════════════════════════════════════════════════════════\n"
-        f"Кандидат: 'понедельник' → Ты ищешь 'Понедельник'\n"
-        f"Кандидат: 'следующий понедельник' → Ты ищешь строчку 'Следующий понедельник'\n"
-        f"Кандидат: 'завтра' → Ты ищешь строчку с пометкой '(ЗАВТРА)'\n"
-    )
-    return calendar_context
-
-def _assemble_dynamic_prompt(prompt_library: dict, dialogue_state: str, user_message: str, vacancy_description: str) -> str:
-    """Собирает динамический системный промпт из блоков библиотеки (упрощенная версия с единым FAQ)."""
-
-    required_blocks = ['#ROLE_AND_STYLE#']
-
-    state_specific_blocks = {
-        'initial_processing': ['#QUALIFICATION_RULES#'],
-        'awaiting_questions': ['#QUALIFICATION_RULES#'],
-        'awaiting_phone': ['#QUALIFICATION_RULES#'],
-        'awaiting_city': ['#QUALIFICATION_RULES#'],
-        'awaiting_readiness': ['#QUALIFICATION_RULES#'],
-        'awaiting_citizenship': ['#QUALIFICATION_RULES#'],
-        'clarifying_citizenship': ['#QUALIFICATION_RULES#','#CLARI#'],
-        'awaiting_age': ['#QUALIFICATION_RULES#'],
-        'clarifying_anything': ['#QUALIFICATION_RULES#'],
-        'clarifying_declined_vacancy': ['#QUALIFICATION_RULES#'],
-
-        'qualification_complete': ['#QUALIFICATION_RULES#'],
-        'call_later': ['#QUALIFICATION_RULES#'],
-
-        'init_scheduling_spb': ['#SCHEDULING_ALGORITHM#'],
-        'post_qualification_chat': ['#SCHEDULING_ALGORITHM#'],
-        'scheduling_spb_day': ['#SCHEDULING_ALGORITHM#'],
-        'scheduling_spb_time': ['#SCHEDULING_ALGORITHM#'],
-        'interview_scheduled_spb': ['#SCHEDULING_ALGORITHM#']
-    }
-    required_blocks.extend(state_specific_blocks.get(dialogue_state, []))
 
-    if dialogue_state in ['forwarded_to_researcher','interview_scheduled_spb', 'post_qualification_chat', 'awaiting_questions', 'initial_processing', 'call_later']:
-        required_blocks.append('#FAQ#')
+def _prepare_turn(prompt_library: dict, dialogue: Dialogue, pending_messages: list) -> tuple:
+    """
+    Маскирует PII во входящих сообщениях и собирает системный промпт для основного запроса.
+    Возвращает (user_entries_to_history, all_masked_content, combined_masked_message, final_system_prompt).
+    """
+    user_entries_to_history = []
+    all_masked_content = []
 
-    final_block_keys = list(dict.fromkeys(required_blocks))
+    for pm in pending_messages:
+        original_content = pm.get('content', '') if isinstance(pm, dict) else str(pm)
+        masked_content, extracted_fio, extracted_phone = extract_and_mask_pii(original_content)
 
-    prompt_pieces = [prompt_library.get(key, '') for key in final_block_keys]
-    
-    
+        # Обновляем candidate (объект уже в сессии после refresh)
+        # if extracted_fio:
+        #     dialogue.candidate.full_name = extracted_fio
 
-    # +++ КЛЮЧЕВОЕ ИЗМЕНЕНИЕ +++
-    # Определяем состояния, для которых нужен календарь
-    SCHEDULING_STATES = ['init_scheduling_spb', 'scheduling_spb_day', 'scheduling_spb_time', 'post_qualification_chat', 'interview_scheduled_spb']
+        if extracted_phone:
+            # Сомнительный номер (не 7XXXXXXXXXX) не перетирает уже сохраненный телефон
+            _, phone_confidence = local_extractor.extract_phone(original_content)
+            if phone_confidence >= local_extractor.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD or not dialogue.candidate.phone_number:
+                dialogue.candidate.phone_number = extracted_phone
 
-    # Если текущее состояние требует календаря, генерируем и добавляем его
-    if dialogue_state in SCHEDULING_STATES:
-        calendar_block = _generate_calendar_context()
-        prompt_pieces.append(calendar_block)
-    # +++ КОНЕЦ ИЗМЕНЕНИЯ +++
+        message_id = pm.get('message_id') if isinstance(pm, dict) else f'legacy_{int(time.time())}'
+        user_entries_to_history.append({
+            'message_id': message_id,
+            'role': 'user',
+            'content': masked_content,
+            'timestamp_msk': pm.get('timestamp_msk', 'время не определено') if isinstance(pm, dict) else 'время не определено' # <-- ДОБАВЛЕНО
+        })
+        all_masked_content.append(masked_content)
+
+    combined_masked_message = "\n".join(all_masked_content)
+
+    # Получаем данные вакансии (объект уже в сессии)
+    vacancy_title = dialogue.vacancy.title
+    vacancy_city = dialogue.vacancy.city or "город не указан"
+
+    vacancy_description_key, relevant_vacancy_desc = _find_relevant_vacancy(prompt_library, dialogue.vacancy)
+
+    # Статическая часть промпта берется из кэша компилятора, календарь - на текущую минуту
+    system_prompt = prompt_compiler.build_system_prompt(
+        prompt_library,
+        dialogue.dialogue_state,
+        vacancy_description_key,
+        relevant_vacancy_desc,
+        combined_masked_message
+    )
 
-    POST_QUALIFICATION_STATES = ['forwarded_to_researcher', 'interview_scheduled_spb', 'post_qualification_chat']
-    
-    if dialogue_state in POST_QUALIFICATION_STATES:
-        post_qual_block = prompt_library.get('#POSTCVAL#', '')
-        if post_qual_block:
-            prompt_pieces.append(post_qual_block)
-
-    vacancy_context = (
-        "[CRITICAL CONTEXT] Ниже представлено описание ТОЛЬКО ТОЙ вакансии, на которую откликнулся кандидат. "
-        "Используй ИСКЛЮЧИТЕЛЬНО эту информацию при ответах на вопросы о вакансии.\n" +
-        vacancy_description
+    context_postfix = (
+        f"[CURRENT TASK] Ты общаешься с кандидатом по вакансии '{vacancy_title}' "
+        f"в городе '{vacancy_city}'. Текущее состояние: '{dialogue.dialogue_state}'."
     )
-    prompt_pieces.insert(1, vacancy_context)
-    
+    final_system_prompt = system_prompt + "\n\n" + context_postfix
+    return user_entries_to_history, all_masked_content, combined_masked_message, final_system_prompt
 
-    return "\n\n".join(prompt_pieces)
+
+def _start_main_llm_call(dialogue: Dialogue, dialogue_history: list, db_pending_messages: list, final_system_prompt: str, combined_masked_message: str):
+    """
+    Запускает основной запрос хода в фоне.
+    Возвращает (llm_data, None), если ответ уже есть в кэше (повторная отправка), иначе (None, TrackedLlmCall).
+    """
+    state_at_call = dialogue.dialogue_state
+    # Если прошлая попытка отправить ответ в HH провалилась, берем уже оплаченный ответ из кэша
+    cached_llm_data = llm_reply_cache.get_reply(dialogue.id, "dialogue", db_pending_messages, state_at_call)
+    if cached_llm_data is not None:
+        logger.info(f"[{dialogue.hh_response_id}] Используется сохраненный ответ LLM (повторная отправка), новый запрос не выполняется.")
+        return cached_llm_data, None
+
+    main_call = turn_executor.TrackedLlmCall(
+        dialogue.id,
+        state_at_call,
+        log_prefix=f"[{dialogue.hh_response_id}]",
+        system_prompt=final_system_prompt,
+        dialogue_history=dialogue_history,
+        user_message=combined_masked_message,
+        purpose=llm_profiles.PURPOSE_DIALOGUE,
+    )
+    return None, main_call
 
 
 async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_library: dict, db: AsyncSession):
@@ -937,6 +771,7 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
 
     dialogue = None
     recruiter = None
+    decline_call = None # Спекулятивная проверка отказа (turn_executor)
     # --- ЗАГРУЗКА ЗДЕСЬ (значение по умолчанию) ---
     log_dialogue_hh_response_id = f"ID {dialogue_id}"
     # --- КОНЕЦ ЗАГРУЗКИ ---
@@ -978,294 +813,107 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
 
         logger.debug(f"Processing dialogue {dialogue.hh_response_id}...")
 
-        pending_messages = dialogue.pending_messages or []
-        if not pending_messages:
+        pending_rows = await dialogue_messages.get_pending(db, dialogue.id)
+        if not pending_rows:
             logger.debug(f"Dialogue {dialogue.id}: no pending messages")
             return
+        pending_messages = [dialogue_messages.to_entry(row) for row in pending_rows]
+        history = await dialogue_messages.get_history(db, dialogue.id)
+        # Сообщения из БД (без системных команд этого цикла) - ключ для кэша ответов LLM
+        db_pending_messages = list(pending_messages)
 
         # *************************************************************************************************************************************
-        # СПЕЦИАЛЬНАЯ ОБРАБОТКА ДЛЯ AWAITING_CITIZENSHIP
+        # ПОБОЧНЫЕ АНАЛИЗЫ ХОДА: гражданство и проверка отказа запускаются параллельно с основным запросом
         # *************************************************************************************************************************************
+        log_prefix = f"[{dialogue.hh_response_id}]"
+        citizenship_call = None
+
         if dialogue.dialogue_state == "awaiting_citizenship" and pending_messages:
             all_pending_content = "\n".join([pm.get('content', '') if isinstance(pm, dict) else str(pm) for pm in pending_messages])
-            citizenship_analysis_prompt = (
-                '''Проанализируй сообщения кандидата и верни ответ\n
-                [CRITICAL RULE] Твой ответ ВСЕГДА должен быть в формате JSON.
-                Структура JSON должна быть следующей:
-                {
-                "is": "yes" или "no",
-                "citizenship": "ЕАЭС" или "внж рф" или "рвп рф" или название страны или Null,
-                }\n
-
-                Если в сообщениях содержится гражданство или название страны то в поле `is` верни `yes`\n
-                Если в сообщениях нет инфы о гражданстве (стране) то в поле `is` верни `no`\n
-                Если в сообщениях содержится информация, что человек гражданин (или просто указана страна) Россия (РФ) или Беларусь или Армения или Киргизия или Казахстан то `ЕАЭС`.\n"
-                Если в сообщениях содержится информация, что человек имеет ВНЖ России (РФ) или РВП России (РФ), то верни в "citizenship" строго значение "внж рф" или "рвп рф"
-                Если другое то верни в `citizenship` название страны.\n'''
-            )
-            
-            citizenship_attempts = [] 
-            llm_citizenship_response = None
-            
-            try:
-                # Вызов LLM с трекером попыток для tenacity
-                llm_citizenship_response = await llm_handler.get_bot_response(
-                    system_prompt=citizenship_analysis_prompt,
-                    dialogue_history=[],
-                    user_message=all_pending_content,
-                    current_datetime_utc=datetime.datetime.now(datetime.timezone.utc),
-                    attempt_tracker=citizenship_attempts, 
-                    skip_instructions=True
-                )
-
-                if llm_citizenship_response:
-                    # 1. Логируем успешный расход (токены и деньги)
-                    await _record_citizenship_usage(db, dialogue, llm_citizenship_response)
-                    
-                    # 2. Логируем "пустышки" для всех предыдущих неудачных попыток (ретраев), если они были
-                    total_attempts = len(citizenship_attempts)
-                    if total_attempts > 1:
-                        logger.warning(f"[{dialogue.hh_response_id}] Анализ гражданства: выполнено успешно после {total_attempts-1} ретраев.")
-                        for i in range(total_attempts - 1):
-                            retry_log = LlmUsageLog(
-                                dialogue_id=dialogue.id,
-                                dialogue_state_at_call=f"Citizenship_Analysis (RETRY #{i+1})",
-                                prompt_tokens=0, completion_tokens=0, cached_tokens=0, total_tokens=0, cost=0.0
-                            )
-                            db.add(retry_log)
-                    
-                    await db.commit()
-                    await db.refresh(dialogue)
-
-                    # 3. Обработка полученного результата
-                    try:
-                        parsed_response = llm_citizenship_response.get('parsed_response')
-                        if parsed_response and parsed_response.get("is") == "yes":
-                            logger.info(f"[{dialogue.hh_response_id}] Распарсили гражданство: {parsed_response.get('citizenship')}")
-                            citizenship = parsed_response.get("citizenship")
-                            system_command_content = None
-
-                            if citizenship == "ЕАЭС":
-                                system_command_content = "[SYSTEM COMMAND] Кандидат сообщил что у него гражданство одной из стран ЕАЭС. Установи extracted_data.citizenship='ЕАЭС'. Переходи к следующему этапу (возрасту) и ОБЯЗАТЕЛЬНО задай кандидату вопрос про его возраст."
-                                
-                            elif citizenship == "внж рф" or  citizenship == "рвп рф":
-                                system_command_content = "[SYSTEM COMMAND] Кандидат сообщил что у него РВП РФ или ВНЖ РФ, поставь в поле citizenship строго значение строго значение 'внж рф' или 'рвп рф' соответственно и переходи к следующему этапу анкеты (возрасту) и ОБЯЗАТЕЛЬНО задай кандидату вопрос про его возраст."
-                            else:
-                                system_command_content = f"[SYSTEM COMMAND] Кандидат сообщил что у него гражданство {citizenship}, уточни есть ли у него РВП или ВНЖ в России."
-                                dialogue.dialogue_state = "clarifying_citizenship"
-
-                            if system_command_content:
-                                system_command = {
-                                    'message_id': f'sys_cmd_citizenship_{time.time()}',
-                                    'role': 'user',
-                                    'content': system_command_content
-                                }
-                                # Добавляем системную команду в очередь
-                                pending_messages = (pending_messages or []) + [system_command]
-                                dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
-                                await db.commit()
-                                
-                                
-                        else:
-                            logger.info(f"[{dialogue.hh_response_id}] Информация о гражданстве не найдена в текущем сообщении.")
-
-                    except Exception as parse_err:
-                        logger.error(f"[{dialogue.hh_response_id}] Ошибка разбора JSON гражданства: {parse_err}")
-
-            except Exception as citizenship_err:
-                # --- ЛОГИРОВАНИЕ ПОЛНОГО ПРОВАЛА ---
-                # Если tenacity исчерпала попытки, записываем в БД все неудачные заходы
-                logger.error(f"[{dialogue.hh_response_id}] Анализ гражданства ПРОВАЛЕН после {len(citizenship_attempts)} попыток: {citizenship_err}")
-                for i in range(len(citizenship_attempts)):
-                    failure_log = LlmUsageLog(
-                        dialogue_id=dialogue.id,
-                        dialogue_state_at_call=f"Citizenship_Analysis (FAILED #{i+1}: {type(citizenship_err).__name__})",
-                        prompt_tokens=0, completion_tokens=0, cached_tokens=0, total_tokens=0, cost=0.0
-                    )
-                    db.add(failure_log)
-                await db.commit()
-                # Пробрасываем ошибку дальше, чтобы воркер мог её обработать (или просто логируем и идем дальше)
-                raise citizenship_err
+            citizenship_result = None
 
-        # *************************************************************************************************************************************
-        # КОНЕЦ СПЕЦИАЛЬНОЙ ОБРАБОТКИ ДЛЯ AWAITING_CITIZENSHIP
-        # *************************************************************************************************************************************
-        # Обработка сообщений
-        user_entries_to_history = []
-        all_masked_content = []
-
-        for pm in pending_messages:
-            original_content = pm.get('content', '') if isinstance(pm, dict) else str(pm)
-            masked_content, extracted_fio, extracted_phone = extract_and_mask_pii(original_content)
-
-            # Обновляем candidate (объект уже в сессии после refresh)
-            # if extracted_fio:
-            #     dialogue.candidate.full_name = extracted_fio
-
-            if extracted_phone:
-                dialogue.candidate.phone_number = extracted_phone
-
-            message_id = pm.get('message_id') if isinstance(pm, dict) else f'legacy_{int(time.time())}'
-            user_entries_to_history.append({
-                'message_id': message_id,
-                'role': 'user',
-                'content': masked_content,
-                'timestamp_msk': pm.get('timestamp_msk', 'время не определено') if isinstance(pm, dict) else 'время не определено' # <-- ДОБАВЛЕНО
-            })
-            all_masked_content.append(masked_content)
-
-        combined_masked_message = "\n".join(all_masked_content)
-
-        # Получаем данные вакансии (объект уже в сессии)
-        vacancy_title = dialogue.vacancy.title
-        vacancy_city = dialogue.vacancy.city or "город не указан"
-
-        relevant_vacancy_desc = _find_relevant_vacancy(prompt_library, vacancy_title, vacancy_city)
-
-        system_prompt = _assemble_dynamic_prompt(
-            prompt_library,
-            dialogue.dialogue_state,
-            combined_masked_message.lower(),
-            relevant_vacancy_desc
-        )
-
-        context_postfix = (
-            f"[CURRENT TASK] Ты общаешься с кандидатом по вакансии '{vacancy_title}' "
-            f"в городе '{vacancy_city}'. Текущее состояние: '{dialogue.dialogue_state}'."
+            # 1. Сначала пробуем определить гражданство локально, без обращения к LLM
+            local_citizenship, local_confidence = local_extractor.extract_citizenship(all_pending_content)
+            if local_citizenship and local_confidence >= local_extractor.LOCAL_EXTRACTION_CONFIDENCE_THRESHOLD:
+                logger.info(f"{log_prefix} Гражданство определено локально: {local_citizenship} (уверенность {local_confidence:.2f}), LLM не вызывается.")
+                citizenship_result = {"is": "yes", "citizenship": local_citizenship}
+            else:
+                cached_citizenship = llm_reply_cache.get_reply(dialogue.id, "citizenship", db_pending_messages)
+                if cached_citizenship is not None:
+                    logger.info(f"{log_prefix} Анализ гражданства взят из кэша, LLM не вызывается.")
+                    citizenship_result = cached_citizenship.get('parsed_response')
+                else:
+                    citizenship_call = turn_executor.start_citizenship_analysis(dialogue.id, all_pending_content, log_prefix)
+                    if local_extractor.mentions_citizenship(all_pending_content):
+                        # 2. Кандидат пишет о гражданстве - ответ LLM почти наверняка "yes" и поменяет промпт:
+                        # основной запрос ждет его, а не запускается впустую
+                        citizenship_result = await _await_citizenship_call(citizenship_call, dialogue.id, db_pending_messages)
+                        citizenship_call = None
+                    # 3. Иначе ответ, скорее всего, "no" - анализ идет параллельно с основным запросом (сверяем ниже)
+
+            if citizenship_call is None:
+                pending_messages = _apply_citizenship_result(dialogue, pending_messages, citizenship_result)
+
+        # Спекулятивная проверка отказа: запускаем заранее, если сообщения похожи на отказ
+        db_pending_text = "\n".join([pm.get('content', '') if isinstance(pm, dict) else str(pm) for pm in db_pending_messages])
+        if local_extractor.looks_like_refusal(db_pending_text):
+            logger.debug(f"{log_prefix} Сообщение похоже на отказ - заранее запускаю проверку DeclineClarification.")
+            decline_call = turn_executor.start_decline_clarification(dialogue.id, history, db_pending_messages, log_prefix)
+
+        # Обработка сообщений и основной LLM запрос
+        user_entries_to_history, all_masked_content, combined_masked_message, final_system_prompt = _prepare_turn(
+            prompt_library, dialogue, pending_messages
         )
-        final_system_prompt = system_prompt + "\n\n" + context_postfix
-
-        # LLM запрос
         llm_call_start = time.monotonic()
-        llm_data = None
-        attempt_tracker = [] # <--- Создаем "ловушку" для попыток
+        state_at_call = dialogue.dialogue_state
+        llm_data, main_call = _start_main_llm_call(dialogue, history, db_pending_messages, final_system_prompt, combined_masked_message)
 
         try:
-            # Передаем attempt_tracker в функцию
-            llm_data = await llm_handler.get_bot_response(
-                system_prompt=final_system_prompt,
-                dialogue_history=dialogue.history or [],
-                user_message=combined_masked_message,
-                current_datetime_utc=datetime.datetime.now(datetime.timezone.utc),
-                attempt_tracker=attempt_tracker # <--- Передаем список
-            )
-            
-            # --- УСПЕШНЫЙ СЦЕНАРИЙ ---
-            # Если мы здесь, значит последняя попытка была успешной.
-            # Если в attempt_tracker больше 1 элемента, значит были скрытые ретраи.
-            
-            total_attempts = len(attempt_tracker)
-            failed_attempts = total_attempts - 1 # Все кроме последней (успешной)
-            
-            if failed_attempts > 0:
-                logger.warning(f"[{dialogue.hh_response_id}] Было {failed_attempts} скрытых ретраев tenacity.")
-                for i in range(failed_attempts):
-                    # Записываем "пустышки" для ретраев
-                    retry_log = LlmUsageLog(
-                        dialogue_id=dialogue.id,
-                        dialogue_state_at_call=f"{dialogue.dialogue_state} (RETRY #{i+1})",
-                        prompt_tokens=0,
-                        completion_tokens=0,
-                        cached_tokens=0,
-                        total_tokens=0,
-                        cost=0.0
-                    )
-                    db.add(retry_log)
-                await db.commit() # Сохраняем логи ретраев сразу
-
-        except Exception as llm_error:
-            # --- СЦЕНАРИЙ ПОЛНОГО ПРОВАЛА ---
-            # Если упало здесь, значит tenacity исчерпал все попытки и выкинул ошибку.
-            # В attempt_tracker лежат метки ВСЕХ попыток (например, 3 штуки).
-            # Все они считаются провальными.
-            
-            logger.error(f"[{dialogue.hh_response_id}] LLM Request FAILED completely after {len(attempt_tracker)} attempts: {llm_error}")
-            
-            try:
-                for i in range(len(attempt_tracker)):
-                    # Пишем лог для КАЖДОЙ попытки
-                    failure_log = LlmUsageLog(
-                        dialogue_id=dialogue.id,
-                        dialogue_state_at_call=f"{dialogue.dialogue_state} (FAILED #{i+1}: {type(llm_error).__name__})",
-                        prompt_tokens=0,
-                        completion_tokens=0,
-                        cached_tokens=0,
-                        total_tokens=0,
-                        cost=0.0
+            if citizenship_call is not None:
+                updated_pending_messages = _apply_citizenship_result(
+                    dialogue, pending_messages,
+                    await _await_citizenship_call(citizenship_call, dialogue.id, db_pending_messages)
+                )
+                if updated_pending_messages is not pending_messages:
+                    # Спекулятивный основной ответ устарел: в запрос должна попасть системная команда
+                    logger.info(f"{log_prefix} Гражданство распознано - перезапускаю основной запрос с системной командой.")
+                    if main_call is not None:
+                        main_call.cancel()
+                    pending_messages = updated_pending_messages
+                    user_entries_to_history, all_masked_content, combined_masked_message, final_system_prompt = _prepare_turn(
+                        prompt_library, dialogue, pending_messages
                     )
-                    db.add(failure_log)
-                await db.commit()
-            except Exception as log_ex:
-                logger.error(f"Failed to log LLM errors to DB: {log_ex}")
-
-            raise llm_error # Пробрасываем ошибку дальше
+                    state_at_call = dialogue.dialogue_state
+                    llm_data, main_call = _start_main_llm_call(dialogue, history, db_pending_messages, final_system_prompt, combined_masked_message)
+
+            if main_call is not None:
+                llm_data = await main_call.wait()
+        except Exception:
+            # Провал любого из запросов хода - остальные больше не нужны
+            for call in (citizenship_call, main_call):
+                if call is not None:
+                    call.cancel()
+            raise
 
-        logger.debug(f"[{dialogue.hh_response_id}] LLM call: {time.monotonic() - llm_call_start:.2f} sec.")
+        logger.debug(f"{log_prefix} LLM call: {time.monotonic() - llm_call_start:.2f} sec.")
 
         if llm_data is None:
             alert_message = "⚠️ LLM service unavailable!"
-            await send_system_alert(alert_message, alert_type="admin_only")
+            send_system_alert(alert_message, alert_type="admin_only")
             return
 
-        # Распаковка ответа
+        # Распаковка ответа (расход токенов уже учтен в TrackedLlmCall)
         llm_response = llm_data.get("parsed_response")
-        usage_stats = llm_data.get("usage_stats")
-
-        # === ЛОГИРОВАНИЕ ТОКЕНОВ ===
-        if usage_stats:
-            try:
-                p_tokens = usage_stats.get('prompt_tokens', 0)
-                c_tokens = usage_stats.get('completion_tokens', 0)
-                cached_tokens = usage_stats.get('cached_tokens', 0)
-                total_tokens = usage_stats.get('total_tokens', 0)
-
-                # 1. Обычные входные токены (которые НЕ попали в кеш)
-                non_cached_input = max(0, p_tokens - cached_tokens)
-                cost_input_regular = (non_cached_input / 1_000_000) * PRICE_PER_MILLION_INPUT_TOKENS
-
-                # 2. Кешированные входные токены (стоят в 2 раза дешевле)
-                cost_input_cached = (cached_tokens / 1_000_000) * (PRICE_PER_MILLION_INPUT_TOKENS / 2)
-
-                # 3. Выходные токены (ответ бота)
-                cost_output = (c_tokens / 1_000_000) * PRICE_PER_MILLION_OUTPUT_TOKENS
-
-                # Итоговая цена за этот запрос
-                total_call_cost = cost_input_regular + cost_input_cached + cost_output
-
-                # 1. Запись в лог
-                usage_log = LlmUsageLog(
-                    dialogue_id=dialogue.id,
-                    dialogue_state_at_call=dialogue.dialogue_state,
-                    prompt_tokens=p_tokens,
-                    completion_tokens=c_tokens,
-                    cached_tokens=cached_tokens,
-                    total_tokens=total_tokens,
-                    cost=total_call_cost
-                )
-                db.add(usage_log)
-
-                # 2. Обновление счетчиков диалога
-                dialogue.total_prompt_tokens += p_tokens
-                dialogue.total_completion_tokens += c_tokens
-                dialogue.total_cached_tokens += cached_tokens
-                # Преобразуем float в Decimal перед сложением
-                dialogue.total_cost += Decimal(str(total_call_cost))
-                
-                await db.commit() 
-                
-                # После коммита объекты могут "отцепиться" (expire), поэтому рефрешим dialogue
-                # чтобы дальше с ним работать в этой сессии
-                await db.refresh(dialogue) 
-                # (Если usage_log дальше не нужен, его можно не рефрешить)
-
-            except Exception as e:
-                logger.error(f"Error logging tokens for dialogue {dialogue.id}: {e}")
-        # ===========================
 
         bot_response_text = llm_response.get("response_text")
         new_state = llm_response.get("new_state", "error_state")
         extracted_data = llm_response.get("extracted_data")
 
+        # Спекулятивная проверка отказа не понадобилась - отменяем
+        if decline_call is not None and new_state != 'declined_vacancy':
+            decline_call.cancel()
+            decline_call = None
+
         # Обновляем статус
         if dialogue.status == 'new':
             dialogue.status = 'in_progress'
@@ -1338,6 +986,7 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
 
                 else:
 
+                    vacancy_title = dialogue.vacancy.title
                     current_title_lower = (vacancy_title or "").lower()
 
                     # Список фраз, которые ищем в названии
@@ -1357,9 +1006,8 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                         # 2. ВАЖНО: Нам нужно сохранить текущие ответы пользователя в историю прямо сейчас.
                         # Так как мы прерываем цикл (return), стандартное сохранение истории в конце функции не сработает.
                         # Если этого не сделать, бот "забудет", что кандидат только что ответил про возраст/гражданство.
-                        current_history = list(dialogue.history) if dialogue.history else []
                         # user_entries_to_history мы сформировали в начале функции
-                        dialogue.history = (current_history + user_entries_to_history)[-150:]
+                        dialogue_messages.mark_processed(db, dialogue.id, pending_rows, user_entries_to_history)
 
                         # 3. Формируем скрытую команду для LLM
                         # Используем role='system' или 'user' с пометкой, чтобы направить LLM.
@@ -1369,10 +1017,9 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                             'content': '[SYSTEM COMMAND] Кандидат прошел квалификацию. Начни запись на собеседование в Санкт-Петербурге (предложи выбрать день).'
                         }
 
-                        # 4. Кладем команду в pending_messages
-                        # Мы перезаписываем очередь, убирая оттуда сообщения пользователя (они уже в истории)
-                        # и оставляя только нашу команду.
-                        dialogue.pending_messages = [system_command]
+                        # 4. Кладем команду в очередь
+                        # Сообщения пользователя уже перенесены в историю, в очереди остается только наша команда.
+                        dialogue_messages.add_pending(db, dialogue.id, [system_command])
                         dialogue.dialogue_state = 'init_scheduling_spb'
                         # 5. Обновляем время (last_updated), чтобы воркер подхватил диалог в следующем цикле мгновенно
                         dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
@@ -1399,7 +1046,7 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                 'content': command_content
             }
 
-            dialogue.pending_messages = (dialogue.pending_messages or []) + [system_command]
+            dialogue_messages.add_pending(db, dialogue.id, [system_command])
             dialogue.dialogue_state = 'clarifying_anything'
             # важно обновить last_updated, чтобы воркер как можно скорее обработал это изменение
             dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
@@ -1436,7 +1083,7 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
         if new_state in ['forwarded_to_researcher', 'interview_scheduled_spb'] and dialogue.status != 'qualified':
             dialogue.status = 'qualified'
 
-            await statistics_manager.update_stats(db, dialogue.vacancy_id, qualified=1)
+            statistics_manager.record_stats(db, dialogue.vacancy_id, qualified=1)
 
             # Проверка существования уведомления (оптимизированная)
             exists_query = select(func.count()).select_from(NotificationQueue).filter_by(
@@ -1481,99 +1128,20 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
         elif (new_state == 'qualification_failed' or new_state == 'declined_vacancy' or new_state == 'declined_interview'):
 
             if new_state == 'declined_vacancy':
-                # --- ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ОТКАЗА ---
-                # Собираем всю историю диалога + pending_messages для анализа
                 # --- ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ОТКАЗА с ПОЛНЫМ УЧЁТОМ ---
-                full_dialogue_text = "\n".join(
-                    [entry.get('content', '') for entry in (dialogue.history or [])]
-                )
-                pending_text = "\n".join(
-                    [pm.get('content', '') for pm in (dialogue.pending_messages or []) if isinstance(pm, dict)]
-                )
-                full_context_for_llm = (full_dialogue_text + "\n" + pending_text).strip()
-
-                clarification_prompt = (
-                    'Проанализируй диалог и определи: действительно ли кандидат чётко отказался от вакансии? '
-                    'Верни ответ строго в формате JSON: {"answer": "yes" или "no"} '
-                    'Ответ "yes" — только если кандидат прямо сказал, что вакансия его не интересует. '
-                    'Если есть хоть малейшее сомнение — верни "no".'
-                )
+                # Анализируем всю историю диалога + pending_messages. Если локальный классификатор
+                # заметил отказ, запрос уже запущен параллельно с основным - просто ждем результат.
+                if decline_call is None:
+                    decline_call = turn_executor.start_decline_clarification(
+                        dialogue.id, history, db_pending_messages, log_prefix
+                    )
 
-                clarification_attempts = []
                 clarification_result = None
                 try:
-                    clarification_result = await llm_handler.get_bot_response(
-                        system_prompt=clarification_prompt,
-                        dialogue_history=[],
-                        user_message=full_context_for_llm,
-                        current_datetime_utc=datetime.datetime.now(datetime.timezone.utc),
-                        attempt_tracker=clarification_attempts,
-                        skip_instructions=True
-                    )
-
-                    # === УСПЕШНЫЙ ВЫЗОВ ===
-                    total_attempts = len(clarification_attempts)
-                    failed_attempts = total_attempts - 1
-                    if failed_attempts > 0:
-                        logger.warning(f"[{dialogue.hh_response_id}] Уточнение declined_vacancy: {failed_attempts} скрытых ретраев.")
-                        for i in range(failed_attempts):
-                            retry_log = LlmUsageLog(
-                                dialogue_id=dialogue.id,
-                                dialogue_state_at_call=f"DeclineClarification (RETRY #{i+1})",
-                                prompt_tokens=0,
-                                completion_tokens=0,
-                                cached_tokens=0,
-                                total_tokens=0,
-                                cost=Decimal('0.0')
-                            )
-                            db.add(retry_log)
-                        await db.commit()
-
-                    # === ЛОГИРОВАНИЕ ТОКЕНОВ ===
-                    if clarification_result and 'usage_stats' in clarification_result:
-                        usage = clarification_result['usage_stats']
-                        p_tokens = usage.get('prompt_tokens', 0)
-                        c_tokens = usage.get('completion_tokens', 0)
-                        cached_tokens = usage.get('cached_tokens', 0)
-                        non_cached = max(0, p_tokens - cached_tokens)
-                        cost = (
-                            (non_cached / 1_000_000) * PRICE_PER_MILLION_INPUT_TOKENS +
-                            (cached_tokens / 1_000_000) * (PRICE_PER_MILLION_INPUT_TOKENS / 2) +
-                            (c_tokens / 1_000_000) * PRICE_PER_MILLION_OUTPUT_TOKENS
-                        )
-                        usage_log = LlmUsageLog(
-                            dialogue_id=dialogue.id,
-                            dialogue_state_at_call="DeclineClarification",
-                            prompt_tokens=p_tokens,
-                            completion_tokens=c_tokens,
-                            cached_tokens=cached_tokens,
-                            total_tokens=p_tokens + c_tokens,
-                            cost=Decimal(str(cost))
-                        )
-                        db.add(usage_log)
-                        dialogue.total_prompt_tokens += p_tokens
-                        dialogue.total_completion_tokens += c_tokens
-                        dialogue.total_cached_tokens += cached_tokens
-                        dialogue.total_cost += Decimal(str(cost))
-                        await db.commit()
-                        await db.refresh(dialogue)
-
+                    clarification_result = await decline_call.wait()
                 except Exception as e:
-                    # === ПОЛНЫЙ ПРОВАЛ ===
+                    # === ПОЛНЫЙ ПРОВАЛ === (попытки уже учтены в TrackedLlmCall)
                     logger.warning(f"[{dialogue.hh_response_id}] Ошибка при уточнении 'declined_vacancy': {e}. Считаем отказом по умолчанию.")
-                    total_fails = len(clarification_attempts)
-                    for i in range(total_fails):
-                        fail_log = LlmUsageLog(
-                            dialogue_id=dialogue.id,
-                            dialogue_state_at_call=f"DeclineClarification (FAILED #{i+1}: {type(e).__name__})",
-                            prompt_tokens=0,
-                            completion_tokens=0,
-                            cached_tokens=0,
-                            total_tokens=0,
-                            cost=Decimal('0.0')
-                        )
-                        db.add(fail_log)
-                    await db.commit()
                     clarification_result = None
 
                 is_real_decline = False
@@ -1592,7 +1160,7 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                         'content': '[SYSTEM COMMAND] Сейчас кандидат не отказывается от вакансии и анкетирования, продолжай дальше.'
                     }
                     
-                    dialogue.pending_messages = (dialogue.pending_messages or []) + [system_command]
+                    dialogue_messages.add_pending(db, dialogue.id, [system_command])
                     dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
                     await db.commit()
                     logger.info(f"[{dialogue.hh_response_id}] Отказ от вакансии НЕ подтверждён. Отложен системный запрос для повторной обработки.")
@@ -1678,10 +1246,8 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                 logger.info(f"[{dialogue.hh_response_id}] LLM вернула пустой ответ для 'qualification_complete'. Это соответствует правилам.")
                 
                 # Сохраняем историю и стейт, но не отправляем сообщение
-                new_history = (dialogue.history or []) + user_entries_to_history
-                dialogue.history = new_history[-150:]
+                dialogue_messages.mark_processed(db, dialogue.id, pending_rows, user_entries_to_history)
                 dialogue.dialogue_state = new_state
-                dialogue.pending_messages = None
                 dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
 
                 await db.commit()
@@ -1710,27 +1276,28 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
                 'state': new_state
             }
 
-            # Ограничиваем размер истории
-            MAX_HISTORY_LENGTH = 150
-            new_history = (dialogue.history or []) + user_entries_to_history + [bot_message_entry]
-            dialogue.history = new_history[-MAX_HISTORY_LENGTH:]
+            # Входящие - в историю, ответ бота - новой строкой (массив истории больше не перезаписывается)
+            dialogue_messages.mark_processed(db, dialogue.id, pending_rows, user_entries_to_history + [bot_message_entry])
 
             dialogue.dialogue_state = new_state
-            dialogue.pending_messages = None
             dialogue.last_updated = datetime.datetime.now(datetime.timezone.utc)
 
             # Flush для проверки constraint violations перед commit
             await db.flush()
             await db.commit()
+            llm_reply_cache.invalidate_dialogue(dialogue.id)
 
             logger.info(f"Dialogue {dialogue.hh_response_id} processed successfully")
         elif message_sent == 403:
             logger.warning(f"Failed to send message for dialogue {dialogue.hh_response_id}. Clearing pending messages to avoid loop.")
-            dialogue.pending_messages = None
+            await dialogue_messages.drop_pending(db, pending_rows)
             await db.commit() # Сохраняем сброс очереди сообщений
+            llm_reply_cache.invalidate_dialogue(dialogue.id)
             return
         else:
             logger.error(f"Failed to send message for dialogue {dialogue.hh_response_id}")
+            # Ответ уже оплачен: в следующем цикле отправим его же, не обращаясь к LLM
+            llm_reply_cache.store_reply(dialogue.id, "dialogue", db_pending_messages, llm_data, state_at_call)
             await db.rollback()
             return
 
@@ -1741,6 +1308,9 @@ async def _process_single_dialogue(dialogue_id: int, recruiter_id: int, prompt_l
         raise  # Важно: пробрасываем исключение дальше
 
     finally:
+        # Не оставляем висящих спекулятивных запросов (например, при раннем выходе или ошибке)
+        if decline_call is not None:
+            decline_call.cancel()
         logger.debug(f"[{log_dialogue_hh_response_id}] Processing finished in: {time.monotonic() - dialogue_processing_start_time:.2f} sec.")
 
 
@@ -1770,16 +1340,9 @@ async def process_pending_dialogues(recruiter_id: int, prompt_library: dict, db:
                     Vacancy.recruiter_id == recruiter_id,
 
                     Dialogue.last_updated <= debounce_time,
-                    Dialogue.pending_messages.is_not(None),
-
-                    # Проверка массива сообщений (как было у вас)
-                    case(
-                        (
-                            func.jsonb_typeof(Dialogue.pending_messages) == 'array',
-                            func.jsonb_array_length(Dialogue.pending_messages) > 0
-                        ),
-                        else_=False
-                    )
+
+                    # Есть необработанные входящие сообщения (частичный индекс по dialogue_messages)
+                    dialogue_messages.has_pending_clause()
                 )
             )
             # -------------------------
@@ -1972,8 +1535,7 @@ async def _process_single_reminder_task(dialogue_id: int, recruiter_id: int, sem
                                 'content': msg,
                                 'timestamp_msk': datetime.datetime.now(SPB_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S MSK')
                             }
-                            current_history = list(dialogue.history) if dialogue.history else []
-                            current_history.append(new_history_entry)
+                            new_history_entries = [new_history_entry]
 
                             # Добавляем системную команду (для всех уровней 4, 5, 6)
                             if is_long_reminder:
@@ -1985,9 +1547,9 @@ async def _process_single_reminder_task(dialogue_id: int, recruiter_id: int, sem
                                         "и не забывай перед переходом к анкете спросить про вопросы и ответить на них!"
                                     )
                                 }
-                                current_history.append(system_instruction)
+                                new_history_entries.append(system_instruction)
                             
-                            dialogue.history = current_history[-150:]
+                            dialogue_messages.add_history(db, dialogue.id, new_history_entries)
 
                             # 3. СПИСЫВАЕМ ДЕНЬГИ (только если это уровень 4)
                             # 3. СПИСЫВАЕМ ДЕНЬГИ + СТАТИСТИКА
@@ -2051,7 +1613,8 @@ async def process_reminders(recruiter_id: int, db: AsyncSession):
                 Dialogue.recruiter_id == recruiter_id,
                 # ИЗМЕНЕНИЕ: Разрешаем обработку и для тех, кто уже в статусе timed_out,
                 # но еще не достиг финального уровня напоминаний
-                Dialogue.status.in_(['in_progress']), 
+                # Равенство (а не IN) - совпадает с условием частичного индекса ix_dialogues_reminder_scan
+                Dialogue.status == 'in_progress',
 
                 Dialogue.dialogue_state.notin_(EXCLUDED_REMINDER_STATUSES),
                 Dialogue.reminder_level < 6 # 6 — это будет последнее напоминание (21 день)
@@ -2332,7 +1895,8 @@ async def run_worker_cycle():
     cycle_start_time = time.monotonic()
     try:
         logger.info("Начало нового цикла воркера.")
-        prompt_library = knowledge_base.get_prompt_library()
+        # Мгновенно: библиотеку обновляет фоновая задача, Google не блокирует event loop
+        prompt_library = knowledge_base.get_current_prompt_library()
 
         all_recruiters_ids = []
         async with SessionLocal() as db: # Эта сессия только для получения списка ID рекрутеров
@@ -2362,6 +1926,11 @@ async def run_worker_cycle():
     finally:
         cycle_end_time = time.monotonic()
         logger.info(f"Цикл воркера завершен. Общее время: {cycle_end_time - cycle_start_time:.2f} сек.")
+        prompt_stats = prompt_compiler.get_cache_stats()
+        logger.debug(
+            f"Кэш промптов: {prompt_stats['entries']} шаблонов, hit rate {prompt_stats['hit_rate']:.1%} "
+            f"({prompt_stats['hits']} попаданий / {prompt_stats['misses']} промахов)"
+        )
         logger.debug("Цикл воркера завершен.")
 
 async def main():
@@ -2374,6 +1943,14 @@ async def main():
     # --- ДОБАВИТЬ ЭТУ СТРОКУ ---
     interview_reminders_task = asyncio.create_task(check_and_send_interview_reminders())
     # --- КОНЕЦ ДОБАВЛЕНИЯ ---
+    # Фоновая пакетная запись расхода токенов
+    usage_accounting.start_usage_flusher()
+    # Фоновая пакетная запись дневной статистики вакансий
+    statistics_manager.start_stats_flusher()
+    # Фоновый пересчет дневной воронки по измененным диалогам
+    funnel_rollups.start_funnel_refresher()
+    # Фоновое обновление библиотеки промптов (первая загрузка - здесь, дальше по таймеру)
+    await knowledge_base.start_prompt_library_refresher()
     try:
         while not shutdown_requested:
             try:
@@ -2392,6 +1969,25 @@ async def main():
                     await asyncio.sleep(120)
     finally:
         logger.info("Закрываем соединения...")
+        # Дописываем в БД накопленный учет токенов до закрытия соединений
+        try:
+            await usage_accounting.stop_usage_flusher()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить учет токенов при остановке: {e}")
+        try:
+            await statistics_manager.stop_stats_flusher()
+        except Exception as e:
+            logger.error(f"Не удалось сохранить статистику при остановке: {e}")
+        try:
+            await funnel_rollups.stop_funnel_refresher()
+        except Exception as e:
+            logger.error(f"Не удалось пересчитать воронку при остановке: {e}")
+        # Досылаем накопленные алерты и закрываем сессию бота алертов
+        try:
+            await stop_alert_dispatcher()
+        except Exception as e:
+            logger.error(f"Не удалось отправить оставшиеся алерты при остановке: {e}")
+        await knowledge_base.stop_prompt_library_refresher()
         await cleanup() # Очистка LLM ресурсов
         # --- ДОБАВИТЬ ЭТУ СТРОКУ ---
         await hh_api_real.close_api_client()
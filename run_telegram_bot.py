@@ -2,23 +2,26 @@ import asyncio
 import logging
 import os
 import re
+import time
 import datetime
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
-from sqlalchemy.orm import selectinload
-from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, update
 from zoneinfo import ZoneInfo
 # --- ДОБАВЛЕН НОВЫЙ ИМПОРТ ДЛЯ РАБОТЫ С ФАЙЛАМИ В ПАМЯТИ ---
 from aiogram.types import BufferedInputFile
 # --- КОНЕЦ НОВОГО ИМПОРТА ---
 
 from hr_bot.utils.logger_config import setup_logging
-from hr_bot.db.models import SessionLocal, SyncSessionLocal, Candidate, NotificationQueue, Dialogue, Vacancy, InactiveNotificationQueue, RejectedNotificationQueue
+from hr_bot.db.models import SessionLocal, NotificationQueue, InactiveNotificationQueue, RejectedNotificationQueue
+from hr_bot.db import dialogue_messages
+from hr_bot.db import funnel_rollups
+from hr_bot.db import notification_queues
 
 from hr_bot.tg_bot.middlewares import DbSessionMiddleware
+from hr_bot.tg_bot import role_cache
+from hr_bot.tg_bot import delivery_scheduler
 from hr_bot.tg_bot.handlers import main_router
 from hr_bot.utils.formatters import mask_fio
 
@@ -31,7 +34,7 @@ except Exception:
 logger = logging.getLogger(__name__)
 
 # --- КОНСТАНТЫ ДЛЯ ОЧИСТКИ ИСТОРИИ ---
-HISTORY_RETENTION_DAYS = 30
+# Срок хранения истории - dialogue_messages.HISTORY_RETENTION_DAYS
 CLEANUP_RUN_HOUR_UTC = 3
 CLEANUP_CHECK_INTERVAL_SECONDS = 6000
 # --- КОНЕЦ КОНСТАНТ ---
@@ -92,199 +95,263 @@ def escape_markdown(text: str) -> str:
     escape_chars = r'_*`['
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
-async def check_and_send_notifications(bot: Bot, health_monitor: TaskHealthMonitor):
+async def _complete_when_delivered(name: str, model, results: dict, deliveries: dict, in_flight_ids: set):
+    """Дожидается доставки пачки и одним UPDATE на статус записывает итоги в очередь."""
+    try:
+        statuses = await asyncio.gather(*deliveries.values(), return_exceptions=True)
+        for task_id, status in zip(deliveries, statuses):
+            results[task_id] = status if isinstance(status, str) else 'error'
+        async with SessionLocal() as db_session:
+            await asyncio.wait_for(notification_queues.complete_batch(db_session, model, results), timeout=30.0)
+            await db_session.commit()
+    except Exception as e:
+        # Записи останутся в 'processing' и вернутся в очередь резервным проходом
+        logger.error(f"[{name}] Не удалось записать итоги пачки: {e}", exc_info=True)
+    finally:
+        in_flight_ids.difference_update(results)
+        in_flight_ids.difference_update(deliveries)
+
+
+async def _run_queue_consumer(name: str, model, handler, bot: Bot, health_monitor: TaskHealthMonitor):
     """
-    Фоновая задача, которая проверяет очередь и рассылает уведомления
-    в определенный групповой чат, включая прикрепленную историю диалога.
+    Общий цикл обработчика очереди уведомлений: забирает пачку (SKIP LOCKED),
+    одним запросом грузит контекст и одним - истории диалогов всей пачки,
+    готовит уведомления и передает их в delivery_scheduler (чаты отправляются
+    параллельно), итоги пачки пишутся после доставки, одним UPDATE на статус.
+    Новые записи приходят через LISTEN/NOTIFY, раз в QUEUE_FALLBACK_SWEEP_SECONDS - резервный проход:
+    он продлевает захват записей, которые еще ждут доставки, и возвращает в очередь брошенные.
     """
-    
-    logger.info(f"Фоновый обработчик уведомлений запущен.")
-    iteration_count = 0  # Счетчик итераций для отладки
+    logger.info(f"[{name}] Обработчик очереди {model.__tablename__} запущен.")
+    last_sweep_at = None
+    pending_batches = set()
+    # Захваченные записи, итоги которых еще не записаны
+    in_flight_ids = set()
     while True:
-        health_monitor.heartbeat('qualified') # Добавили пульс
-        iteration_count += 1
-        logger.info(f"[Qualified] Итерация #{iteration_count}: начало цикла проверки очереди.")
-        
-        async with SessionLocal() as db_session:
-            logger.info(f"[Qualified] Итерация #{iteration_count}: открыта сессия БД.")
-            try:
-                result = await asyncio.wait_for(
-                    db_session.execute(
-                        select(NotificationQueue).filter_by(status='pending').limit(10)
-                    ),
-                    timeout=30.0  # Таймаут 30 секунд на запрос
-                )
-                tasks = result.scalars().all()
-
-                if not tasks:
-                    await asyncio.sleep(10)
-                    continue
-
-                logger.info(f"[Notification Sender] Найдено {len(tasks)} новых уведомлений для отправки.")
-
-                for task in tasks:
-                    health_monitor.heartbeat('qualified')
-                    dialogue = None
-                    candidate = None
-                    vacancy = None
-
-                    # --- ИЗМЕНЁННЫЙ БЛОК КОДА: Теперь берем кандидата и его ПОСЛЕДНИЙ ОБНОВЛЕННЫЙ ДИАЛОГ ---
-                    candidate_result = await db_session.execute(
-                        select(Candidate)
-                        .options(
-                            selectinload(Candidate.dialogues).selectinload(Dialogue.vacancy),
-                            selectinload(Candidate.dialogues).selectinload(Dialogue.recruiter)    # И их вакансии
-                        )
-                        .filter_by(id=task.candidate_id) # Фильтруем по candidate_id из задачи NotificationQueue
-                    )
-                    candidate = candidate_result.scalar_one_or_none()
-
-                    if not candidate or not candidate.dialogues:
-                        task.status = 'error'
-                        logger.error(f"Не найден кандидат или у него нет диалогов для задачи NotificationQueue {task.id}. Candidate ID: {task.candidate_id}")
-                        await db_session.commit()
-                        continue
-
-                    # Сортируем все диалоги кандидата по last_updated в порядке убывания (самые свежие первыми)
-                    # Если last_updated отсутствует, используем минимальное время, чтобы оно оказалось в конце.
-                    sorted_dialogues = sorted(
-                        candidate.dialogues,
-                        key=lambda d: d.last_updated if d.last_updated else datetime.datetime.min.replace(tzinfo=datetime.timezone.utc),
-                        reverse=True
+        health_monitor.heartbeat(name)
+        try:
+            if last_sweep_at is None or time.monotonic() - last_sweep_at >= notification_queues.QUEUE_FALLBACK_SWEEP_SECONDS:
+                async with SessionLocal() as db_session:
+                    await asyncio.wait_for(notification_queues.requeue_stale(db_session, model, in_flight_ids), timeout=30.0)
+                    await db_session.commit()
+                last_sweep_at = time.monotonic()
+
+            # Не берем новые записи, пока предыдущие пачки не разошлись по чатам
+            if len(pending_batches) >= notification_queues.QUEUE_MAX_PENDING_BATCHES:
+                await asyncio.wait(pending_batches, timeout=notification_queues.QUEUE_FALLBACK_SWEEP_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            async with SessionLocal() as db_session:
+                tasks = await asyncio.wait_for(notification_queues.claim_batch(db_session, model), timeout=30.0)
+                await db_session.commit()
+
+                if tasks:
+                    contexts = await asyncio.wait_for(notification_queues.load_task_contexts(db_session, model, tasks), timeout=30.0)
+                    transcripts = await asyncio.wait_for(
+                        dialogue_messages.get_transcripts(db_session, {c.dialogue_id for c in contexts.values() if c is not None}),
+                        timeout=60.0
                     )
 
-                    dialogue = sorted_dialogues[0] # Берем самый свежий диалог
-                    vacancy = dialogue.vacancy     # Вакансия, связанная с этим диалогом
-                    # --- КОНЕЦ ИЗМЕНЁННОГО БЛОКА КОДА ---
-                    recruiter = dialogue.recruiter
-
-
-                    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
-                    if not recruiter or not recruiter.telegram_chat_id or not recruiter.topic_qualified_id:
-                        logger.warning(
-                            f"Для рекрутера {recruiter.name if recruiter else 'Unknown'} не настроен чат или топик 'qualified'. "
-                            f"Уведомление {task.id} не может быть отправлено."
-                        )
-                        task.status = 'skipped_no_chat' # Или error, как удобнее
-                        await db_session.commit()
-                        continue
-                    
-                    target_chat_id = recruiter.telegram_chat_id
-                    target_thread_id = recruiter.topic_qualified_id
-
-
-                    resume_link = f"https://hh.ru/resume/{candidate.hh_resume_id}"
-
-                    safe_vacancy_title = escape_markdown(vacancy.title)
-                    safe_masked_name = escape_markdown(mask_fio(candidate.full_name))
-                    safe_age = escape_markdown(candidate.age or 'Не указан')
-                    safe_citizenship = escape_markdown(candidate.citizenship or 'Не указано')
-                    
-                    safe_city = escape_markdown(vacancy.city or 'Не указан')
-                    
-                    safe_phone_number = escape_markdown(candidate.phone_number or "—")
-
-                    message_text = (
-                        f"📌 Новый кандидат по вакансии: ✨*{safe_vacancy_title}*✨\n"
-                        f"Город вакансии: 📍*{safe_city}*📍\n\n"
-                        f"ФИО: {safe_masked_name}\n"
-                        f"Резюме кандидата: [Открыть на HH.ru]({resume_link})\n\n"
-                        f"URL: {resume_link}\n\n"
-                        f"Возраст: {safe_age}\n"
-                        f"Гражданство: {safe_citizenship}\n"
-                        
-                        
-                        f"Номер телефона: {safe_phone_number}\n\n"
-                        f"Статус: ✅ Прошёл квалификацию"
-                    )
+            if not tasks:
+                # Ждем NOTIFY от воркера; таймаут - резервный опрос
+                await notification_queues.wait_for_enqueue(model)
+                continue
+
+            logger.info(f"[{name}] Взято в работу {len(tasks)} уведомлений.")
+            results, deliveries = {}, {}
+            for task in tasks:
+                context = contexts.get(task.id)
+                try:
+                    outcome = handler(bot, task, context, transcripts.get(context.dialogue_id, []) if context else [])
+                except Exception as e:
+                    outcome = 'error'
+                    logger.error(f"[{name}] Ошибка обработки записи {task.id}: {e}", exc_info=True)
+                if isinstance(outcome, str):
+                    results[task.id] = outcome
+                else:
+                    deliveries[task.id] = outcome
+
+            in_flight_ids.update(results)
+            in_flight_ids.update(deliveries)
+            batch = asyncio.create_task(_complete_when_delivered(name, model, results, deliveries, in_flight_ids))
+            pending_batches.add(batch)
+            batch.add_done_callback(pending_batches.discard)
+
+        except Exception as e:
+            # Незавершенные записи останутся в 'processing' и вернутся в очередь резервным проходом
+            logger.critical(f"[{name}] Критическая ошибка в обработчике очереди: {e}", exc_info=True)
+            await asyncio.sleep(30)
+
+
+def _build_transcript_file(context, transcript: list, file_prefix: str, safe_masked_name: str, safe_vacancy_title: str, safe_city: str):
+    """Файл с историей диалога для уведомления или None, если история пуста."""
+    if not transcript:
+        logger.debug(f"История диалога для {context.hh_response_id} пуста или отсутствует, файл не будет прикреплен.")
+        return None
+
+    formatted_history_lines = []
+    formatted_history_lines.append(f"=== ИСТОРИЯ ДИАЛОГА ===")
+    formatted_history_lines.append(f"ID отклика: {context.hh_response_id}")
+    if context.response_created_at:
+        # Конвертируем UTC время из БД в МСК
+        response_time_msk = context.response_created_at.astimezone(SPB_TIMEZONE)
+        formatted_time_str = response_time_msk.strftime('%d.%m.%Y в %H:%M:%S')
+        formatted_history_lines.append(f"Время отклика (МСК): {formatted_time_str}")
+    formatted_history_lines.append(f"Кандидат: {safe_masked_name}")
+    formatted_history_lines.append(f"Вакансия: {safe_vacancy_title}, {safe_city}")
+    formatted_history_lines.append("--------------------------------------------------")
+    formatted_history_lines.append("") # Пустая строка после шапки для лучшего отделения
+
+    for message in transcript:
+        content = message.content
+        if not content:  # Пропускаем пустые сообщения
+            continue
+
+        if is_system_command(content):
+            logger.debug(f"Пропущена системная команда в истории: {content}")
+            continue
+
+        # Убираем секунды и часовой пояс для краткости
+        timestamp_raw = message.timestamp_msk or ''
+        timestamp_clean = timestamp_raw.split('.')[0][:-7] if timestamp_raw else ''
+        timestamp_prefix = f"[{timestamp_clean}]" if timestamp_clean else ''
+
+        formatted_history_lines.append("")  # Пустая строка перед каждым сообщением
+        if message.role == 'user':
+            formatted_history_lines.append(f"{timestamp_prefix} 👤 Кандидат: {content}")
+        elif message.role == 'assistant':
+            formatted_history_lines.append(f"{timestamp_prefix} 🤖 Бот: {content}")
+
+    file_name = f"{file_prefix}transcription_{context.hh_response_id}.txt"
+    logger.debug(f"Сформирован файл транскрипции '{file_name}' для диалога {context.hh_response_id}")
+    return BufferedInputFile("\n".join(formatted_history_lines).encode('utf-8'), filename=file_name)
+
+
+def _submit_delivery(bot: Bot, task_label: str, target_chat_id, target_thread_id, message_text: str, chat_transcript_file) -> asyncio.Future:
+    """Ставит уведомление (документ с историей или просто текст) в очередь чата рекрутера."""
+    async def send():
+        if chat_transcript_file:
+            await bot.send_document(
+                chat_id=target_chat_id,
+                document=chat_transcript_file,
+                caption=message_text,
+                parse_mode=ParseMode.MARKDOWN,
+                message_thread_id=target_thread_id
+            )
+            logger.info(f"Уведомление {task_label} (документ с историей) отправлено.")
+        else:
+            await bot.send_message(
+                chat_id=target_chat_id,
+                text=message_text,
+                message_thread_id=target_thread_id
+            )
+            logger.warning(f"Для {task_label} нет истории диалога. Отправлено только текстовое уведомление.")
+
+    return delivery_scheduler.submit(target_chat_id, send, label=task_label)
+
+
+def _send_qualified_notification(bot: Bot, task, context, transcript: list) -> str | asyncio.Future:
+    """
+    Уведомление по записи NotificationQueue (по самому свежему диалогу кандидата,
+    с историей). Возвращает итоговый статус записи или future доставки из delivery_scheduler.
+    """
+    if context is None or context.vacancy_title is None:
+        logger.error(f"Не найден кандидат, диалог или вакансия для задачи NotificationQueue {task.id}. Candidate ID: {task.candidate_id}")
+        return 'error'
+
+    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
+    if not context.telegram_chat_id or not context.topic_qualified_id:
+        logger.warning(
+            f"Для рекрутера {context.recruiter_name or 'Unknown'} не настроен чат или топик 'qualified'. "
+            f"Уведомление {task.id} не может быть отправлено."
+        )
+        return 'skipped_no_chat'
+
+    resume_link = f"https://hh.ru/resume/{context.hh_resume_id}"
+
+    safe_vacancy_title = escape_markdown(context.vacancy_title)
+    safe_masked_name = escape_markdown(mask_fio(context.full_name))
+    safe_age = escape_markdown(context.age or 'Не указан')
+    safe_citizenship = escape_markdown(context.citizenship or 'Не указано')
+    safe_city = escape_markdown(context.vacancy_city or 'Не указан')
+    safe_phone_number = escape_markdown(context.phone_number or "—")
+
+    message_text = (
+        f"📌 Новый кандидат по вакансии: ✨*{safe_vacancy_title}*✨\n"
+        f"Город вакансии: 📍*{safe_city}*📍\n\n"
+        f"ФИО: {safe_masked_name}\n"
+        f"Резюме кандидата: [Открыть на HH.ru]({resume_link})\n\n"
+        f"URL: {resume_link}\n\n"
+        f"Возраст: {safe_age}\n"
+        f"Гражданство: {safe_citizenship}\n"
+        f"Номер телефона: {safe_phone_number}\n\n"
+        f"Статус: ✅ Прошёл квалификацию"
+    )
 
-                    chat_transcript_file = None
-                    if dialogue.history:
-                        formatted_history_lines = []
-                        # Улучшенная шапка
-                        formatted_history_lines.append(f"=== ИСТОРИЯ ДИАЛОГА ===")
-                        formatted_history_lines.append(f"ID отклика: {dialogue.hh_response_id}")
-                        # <<< НАЧАЛО НОВОГО БЛОКА >>>
-                        if dialogue.response_created_at:
-                            # Конвертируем UTC время из БД в МСК
-                            response_time_msk = dialogue.response_created_at.astimezone(SPB_TIMEZONE)
-                            # Форматируем в красивую строку
-                            formatted_time_str = response_time_msk.strftime('%d.%m.%Y в %H:%M:%S')
-                            formatted_history_lines.append(f"Время отклика (МСК): {formatted_time_str}")
-                        # <<< КОНЕЦ НОВОГО БЛОКА >>>
-                        formatted_history_lines.append(f"Кандидат: {safe_masked_name}")
-                        formatted_history_lines.append(f"Вакансия: {safe_vacancy_title}, {safe_city}")
-                        formatted_history_lines.append("--------------------------------------------------")
-                        formatted_history_lines.append("") # Пустая строка после шапки для лучшего отделения
-
-                        for entry in dialogue.history:
-                            role = entry.get('role')
-                            content = entry.get('content')
-                            if not content:  # Пропускаем пустые сообщения
-                                continue
-
-                            if is_system_command(content):
-                                logger.debug(f"Пропущена системная команда в истории: {content}")
-                                continue
-
-                            # Извлекаем и форматируем время
-                            timestamp_raw = entry.get('timestamp_msk', '')
-                            # Убираем секунды и часовой пояс для краткости
-                            timestamp_clean = timestamp_raw.split('.')[0][:-7] if timestamp_raw else ''
-                            timestamp_prefix = f"[{timestamp_clean}]" if timestamp_clean else ''
-
-                            formatted_history_lines.append("")  # Пустая строка перед каждым сообщением
-                            if role == 'user':
-                                formatted_history_lines.append(f"{timestamp_prefix} 👤 Кандидат: {content}")
-                            elif role == 'assistant':
-                                formatted_history_lines.append(f"{timestamp_prefix} 🤖 Бот: {content}")
-
-                        formatted_history_string = "\n".join(formatted_history_lines)
-
-                        file_name = f"transcription_{dialogue.hh_response_id}.txt"
-                        chat_transcript_file = BufferedInputFile(formatted_history_string.encode('utf-8'), filename=file_name)
-                        logger.debug(f"Сформирован файл транскрипции '{file_name}' для диалога {dialogue.hh_response_id}")
-                    else:
-                        logger.debug(f"История диалога для {dialogue.hh_response_id} пуста или отсутствует, файл не будет прикреплен.")
-
-                    try:
-                        async with asyncio.timeout(120.0):
-                            if chat_transcript_file:
-                                await bot.send_document(
-                                    chat_id=target_chat_id,          # ИСПОЛЬЗУЕМ ID ИЗ РЕКРУТЕРА
-                                    document=chat_transcript_file,
-                                    caption=message_text,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    message_thread_id=target_thread_id # ИСПОЛЬЗУЕМ ТОПИК ИЗ РЕКРУТЕРА
-                                )
-                                logger.info(f"Уведомление по кандидату {candidate.id} (документ с текстом) успешно отправлено.")
-                            else:
-                                # Если по какой-то причине файл транскрибации не был сформирован,
-                                # отправляем только текстовое сообщение.
-                                await bot.send_message(
-                                    chat_id=target_chat_id,
-                                    text=message_text,
-                                    message_thread_id=target_thread_id
-                                )
-                                logger.warning(f"Файл транскрипции для кандидата {candidate.id} отсутствовал. Отправлено только текстовое уведомление.")
-                                await asyncio.sleep(5)
-
-                            task.status = 'sent'
-                            logger.info(f"Уведомление по кандидату {candidate.id} полностью обработано.")
-
-                    except Exception as e:
-                        task.status = 'error'
-                        logger.error(f"Не удалось отправить уведомление по задаче {task.id}: {e}", exc_info=True)
-
-                    finally:
-                        await db_session.commit()
-
-                await asyncio.sleep(5)
+    chat_transcript_file = _build_transcript_file(context, transcript, "", safe_masked_name, safe_vacancy_title, safe_city)
+    return _submit_delivery(
+        bot, f"NotificationQueue {task.id}", context.telegram_chat_id, context.topic_qualified_id,
+        message_text, chat_transcript_file
+    )
 
-            except Exception as e:
-                logger.critical(f"Критическая ошибка в фоновом обработчике: {e}", exc_info=True)
-                await db_session.rollback()
-                await asyncio.sleep(30)
+
+def _send_dialogue_alert(bot: Bot, task_label: str, context, transcript: list, headline: str, target_thread_id, file_prefix: str) -> str | asyncio.Future:
+    """Общая часть уведомлений по очередям молчунов и отказов (по диалогу записи)."""
+    resume_link = f"https://hh.ru/resume/{context.hh_resume_id}"
+
+    # Используем escape_markdown и mask_fio
+    safe_vacancy_title = escape_markdown(context.vacancy_title)
+    safe_city = escape_markdown(context.vacancy_city or 'Не указан')
+    safe_masked_name = escape_markdown(mask_fio(context.full_name)) # С маскировкой только отчества
+
+    message_text = (
+        f"{headline}\n\n"
+        f"Вакансия: ✨*{safe_vacancy_title}*✨\n"
+        f"Город: 📍*{safe_city}*📍\n"
+        f"Имя: {safe_masked_name}\n"
+        f"Ссылка на резюме: [Открыть на HH.ru]({resume_link})\n\n"
+        f"URL: {resume_link}" # Добавляем URL отдельно, т.к. disable_web_page_preview не для документов
+    )
+
+    chat_transcript_file = _build_transcript_file(context, transcript, file_prefix, safe_masked_name, safe_vacancy_title, safe_city)
+    return _submit_delivery(bot, task_label, context.telegram_chat_id, target_thread_id, message_text, chat_transcript_file)
+
+
+def _send_inactive_alert(bot: Bot, task, context, transcript: list) -> str | asyncio.Future:
+    """Уведомление по записи InactiveNotificationQueue. Возвращает итоговый статус записи или future доставки."""
+    if context is None or context.vacancy_title is None or context.tracked_recruiter_id is None:
+        logger.error(f"Не найден диалог, кандидат или вакансия для задачи InactiveNotificationQueue {task.id}.")
+        return 'error'
+    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
+    if not context.telegram_chat_id or not context.topic_timeout_id:
+        # Если не настроен канал для молчунов
+        return 'skipped_no_chat'
+    return _send_dialogue_alert(
+        bot, f"InactiveNotificationQueue {task.id}", context, transcript,
+        "⚠️ Соискатель не отвечает более 2 часов", context.topic_timeout_id, "inactive_"
+    )
+
+
+def _send_rejected_alert(bot: Bot, task, context, transcript: list) -> str | asyncio.Future:
+    """Уведомление по записи RejectedNotificationQueue. Возвращает итоговый статус записи или future доставки."""
+    if context is None or context.vacancy_title is None or context.tracked_recruiter_id is None:
+        logger.error(f"Не найден диалог, кандидат или вакансия для задачи RejectedNotificationQueue {task.id}.")
+        return 'error'
+    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
+    if not context.telegram_chat_id or not context.topic_rejected_id:
+        # Если не настроен канал для отказников
+        return 'skipped_no_chat'
+    return _send_dialogue_alert(
+        bot, f"RejectedNotificationQueue {task.id}", context, transcript,
+        "❌ Кандидату отказано в квалификации", context.topic_rejected_id, "rejected_"
+    )
+
+
+async def check_and_send_notifications(bot: Bot, health_monitor: TaskHealthMonitor):
+    """
+    Фоновая задача, которая проверяет очередь и рассылает уведомления
+    в определенный групповой чат, включая прикрепленную историю диалога.
+    """
+    await _run_queue_consumer('qualified', NotificationQueue, _send_qualified_notification, bot, health_monitor)
 
 
 async def check_and_send_inactive_alerts(bot: Bot, health_monitor: TaskHealthMonitor):
@@ -292,347 +359,15 @@ async def check_and_send_inactive_alerts(bot: Bot, health_monitor: TaskHealthMon
     Фоновая задача, которая проверяет очередь InactiveNotificationQueue
     и рассылает уведомления о неактивных кандидатах в групповой чат.
     """
-    
-
-    logger.info(f"Фоновый обработчик уведомлений о неактивных кандидатах запущен.")
-    iteration_count = 0
-    while True:
-        health_monitor.heartbeat('inactive')
-        iteration_count += 1
-        logger.info(f"[Inactive] Итерация #{iteration_count}: начало цикла.")
-        
-        async with SessionLocal() as db_session:
-            logger.info(f"[Inactive] Итерация #{iteration_count}: сессия открыта.")
-            
-            try:
-                # Ищем записи в очереди со статусом 'pending'
-                result = await asyncio.wait_for(
-                    db_session.execute(
-                        select(InactiveNotificationQueue)
-                        .filter_by(status='pending')
-                        .limit(10)
-                    ),
-                    timeout=30.0
-                )
-                tasks = result.scalars().all()
-
-                if not tasks:
-                    await asyncio.sleep(15) # Пауза побольше, если нет задач
-                    continue
-
-                logger.info(f"[Inactive Alert Sender] Найдено {len(tasks)} новых уведомлений о неактивных кандидатах для отправки.")
-
-                for task in tasks:
-                    health_monitor.heartbeat('inactive')
-                    # Загружаем диалог, кандидата и вакансию с предзагрузкой связей
-                    dialogue_result = await db_session.execute(
-                        select(Dialogue)
-                        .options(
-                            selectinload(Dialogue.candidate),
-                            selectinload(Dialogue.vacancy),
-                            selectinload(Dialogue.recruiter)
-                        )
-                        .filter_by(id=task.dialogue_id)
-                    )
-                    dialogue = dialogue_result.scalar_one_or_none()
-
-                    if not dialogue or not dialogue.candidate or not dialogue.vacancy or not dialogue.recruiter:
-                        task.status = 'error'
-                        logger.error(f"Не найден диалог, кандидат или вакансия для задачи InactiveNotificationQueue {task.id}.")
-                        await db_session.commit()
-                        continue
-                    recruiter = dialogue.recruiter
-
-                    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
-                    if not recruiter.telegram_chat_id or not recruiter.topic_timeout_id:
-                        # Если не настроен канал для молчунов
-                        task.status = 'skipped_no_chat'
-                        await db_session.commit()
-                        continue
-                    
-                    target_chat_id = recruiter.telegram_chat_id
-                    target_thread_id = recruiter.topic_timeout_id
-
-                    candidate = dialogue.candidate
-                    vacancy = dialogue.vacancy
-
-                    resume_link = f"https://hh.ru/resume/{candidate.hh_resume_id}"
-
-                    # Используем escape_markdown и mask_fio
-                    safe_vacancy_title = escape_markdown(vacancy.title)
-                    safe_city = escape_markdown(vacancy.city or 'Не указан')
-                    safe_masked_name = escape_markdown(mask_fio(candidate.full_name)) # С маскировкой только отчества
-
-                    message_text = (
-                        f"⚠️ Соискатель не отвечает более 2 часов\n\n"
-                        f"Вакансия: ✨*{safe_vacancy_title}*✨\n"
-                        f"Город: 📍*{safe_city}*📍\n"
-                        f"Имя: {safe_masked_name}\n" # Теперь с маскировкой только отчества
-                        f"Ссылка на резюме: [Открыть на HH.ru]({resume_link})\n\n"
-                        f"URL: {resume_link}" # Добавляем URL отдельно, т.к. disable_web_page_preview не для документов
-                    )
+    await _run_queue_consumer('inactive', InactiveNotificationQueue, _send_inactive_alert, bot, health_monitor)
 
-                    # Формирование истории чата (повторно используем логику)
-                    chat_transcript_file = None
-                    if dialogue.history:
-                        formatted_history_lines = []
-                        formatted_history_lines.append(f"=== ИСТОРИЯ ДИАЛОГА ===")
-                        formatted_history_lines.append(f"ID отклика: {dialogue.hh_response_id}")
-                        # <<< НАЧАЛО НОВОГО БЛОКА >>>
-                        if dialogue.response_created_at:
-                            # Конвертируем UTC время из БД в МСК
-                            response_time_msk = dialogue.response_created_at.astimezone(SPB_TIMEZONE)
-                            # Форматируем в красивую строку
-                            formatted_time_str = response_time_msk.strftime('%d.%m.%Y в %H:%M:%S')
-                            formatted_history_lines.append(f"Время отклика (МСК): {formatted_time_str}")
-                        # <<< КОНЕЦ НОВОГО БЛОКА >>>
-                        formatted_history_lines.append(f"Кандидат: {safe_masked_name}")
-                        formatted_history_lines.append(f"Вакансия: {safe_vacancy_title}, {safe_city}")
-                        formatted_history_lines.append("--------------------------------------------------")
-                        formatted_history_lines.append("")
-
-                        for entry in dialogue.history:
-                            role = entry.get('role')
-                            content = entry.get('content')
-                            if not content:  # Пропускаем пустые сообщения
-                                continue
-
-                            if is_system_command(content):
-                                logger.debug(f"Пропущена системная команда в истории: {content}")
-                                continue
-
-                            # Извлекаем и форматируем время
-                            timestamp_raw = entry.get('timestamp_msk', '')
-                            # Убираем секунды и часовой пояс для краткости
-                            timestamp_clean = timestamp_raw.split('.')[0][:-7] if timestamp_raw else ''
-                            timestamp_prefix = f"[{timestamp_clean}]" if timestamp_clean else ''
-
-                            formatted_history_lines.append("")  # Пустая строка перед каждым сообщением
-                            if role == 'user':
-                                formatted_history_lines.append(f"{timestamp_prefix} 👤 Кандидат: {content}")
-                            elif role == 'assistant':
-                                formatted_history_lines.append(f"{timestamp_prefix} 🤖 Бот: {content}")
-
-                        formatted_history_string = "\n".join(formatted_history_lines)
-
-                        file_name = f"inactive_transcription_{dialogue.hh_response_id}.txt"
-                        chat_transcript_file = BufferedInputFile(formatted_history_string.encode('utf-8'), filename=file_name)
-                        logger.debug(f"Сформирован файл транскрипции '{file_name}' для неактивного диалога {dialogue.hh_response_id}")
-                    else:
-                        logger.debug(f"История диалога для неактивного кандидата {dialogue.hh_response_id} пуста или отсутствует, файл не будет прикреплен.")
-
-                    try:
-                        async with asyncio.timeout(120.0):
-                            if chat_transcript_file:
-                                await bot.send_document(
-                                    chat_id=target_chat_id,
-                                    document=chat_transcript_file,
-                                    caption=message_text,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    message_thread_id=target_thread_id
-                                )
-                                logger.info(f"Уведомление о неактивном кандидате (диалог {dialogue.id}) отправлено.")
-                                await asyncio.sleep(5)
-                            else:
-                                await bot.send_message(
-                                    chat_id=target_chat_id,
-                                    text=message_text,
-                                    message_thread_id=target_thread_id
-                                )
-                                logger.warning(f"Файл транскрипции для неактивного кандидата {dialogue.hh_response_id} отсутствовал. Отправлено только текстовое уведомление.")
-
-                            task.status = 'sent'
-                            task.processed_at = datetime.datetime.now(datetime.timezone.utc)
-
-
-                    except Exception as e:
-                        task.status = 'error'
-                        task.processed_at = datetime.datetime.now(datetime.timezone.utc)
-                        logger.error(f"Не удалось отправить уведомление о неактивном кандидате для задачи InactiveNotificationQueue {task.id}: {e}", exc_info=True)
-
-                    finally:
-                        await db_session.commit()
-
-                await asyncio.sleep(5) # Короткая пауза между партиями задач
-
-            except Exception as e:
-                logger.critical(f"Критическая ошибка в фоновом обработчике неактивных кандидатов: {e}", exc_info=True)
-                await db_session.rollback()
-                await asyncio.sleep(30) # Более длительная пауза при критической ошибке
 
 async def check_and_send_rejected_alerts(bot: Bot, health_monitor: TaskHealthMonitor):
     """
     Фоновая задача, которая проверяет очередь RejectedNotificationQueue
     и рассылает уведомления об отклоненных кандидатах в групповой чат.
     """
-
-
-    logger.info(f"Фоновый обработчик уведомлений об отклоненных кандидатах запущен.")
-    iteration_count = 0
-    while True:
-        health_monitor.heartbeat('rejected')
-        iteration_count += 1
-        logger.info(f"[Rejected] Итерация #{iteration_count}: начало цикла.")
-        
-        async with SessionLocal() as db_session:
-            try:
-                # Ищем записи в очереди со статусом 'pending'
-                logger.info(f"[Rejected] Итерация #{iteration_count}: сессия открыта.")
-                
-                result = await asyncio.wait_for(
-                    db_session.execute(
-                        select(RejectedNotificationQueue)
-                        .filter_by(status='pending')
-                        .limit(10)
-                    ),
-                    timeout=30.0
-                )
-                tasks = result.scalars().all()
-
-                if not tasks:
-                    await asyncio.sleep(15) # Пауза побольше, если нет задач
-                    continue
-
-                logger.info(f"[Rejected Alert Sender] Найдено {len(tasks)} новых уведомлений об отклоненных кандидатах для отправки.")
-
-                for task in tasks:
-                    health_monitor.heartbeat('rejected')
-                    # Загружаем диалог, кандидата и вакансию с предзагрузкой связей
-                    dialogue_result = await db_session.execute(
-                        select(Dialogue)
-                        .options(
-                            selectinload(Dialogue.candidate),
-                            selectinload(Dialogue.vacancy),
-                            selectinload(Dialogue.recruiter)
-                        )
-                        .filter_by(id=task.dialogue_id)
-                    )
-                    dialogue = dialogue_result.scalar_one_or_none()
-
-                    if not dialogue or not dialogue.candidate or not dialogue.vacancy or not dialogue.recruiter:
-                        task.status = 'error'
-                        logger.error(f"Не найден диалог, кандидат или вакансия для задачи RejectedNotificationQueue {task.id}.")
-                        await db_session.commit()
-                        continue
-                    
-                    recruiter = dialogue.recruiter
-
-                    # --- ПРОВЕРКА НАСТРОЕК РЕКРУТЕРА ---
-                    if not recruiter.telegram_chat_id or not recruiter.topic_rejected_id:
-                        # Если не настроен канал для молчунов
-                        task.status = 'skipped_no_chat'
-                        await db_session.commit()
-                        continue
-                    
-                    target_chat_id = recruiter.telegram_chat_id
-                    target_thread_id = recruiter.topic_rejected_id
-                    # -----------------------------------
-
-                    candidate = dialogue.candidate
-                    vacancy = dialogue.vacancy
-
-                    resume_link = f"https://hh.ru/resume/{candidate.hh_resume_id}"
-
-                    # Используем escape_markdown и mask_fio
-                    safe_vacancy_title = escape_markdown(vacancy.title)
-                    safe_city = escape_markdown(vacancy.city or 'Не указан')
-                    safe_masked_name = escape_markdown(mask_fio(candidate.full_name)) # С маскировкой только отчества
-
-                    message_text = (
-                        f"❌ Кандидату отказано в квалификации\n\n"
-                        f"Вакансия: ✨*{safe_vacancy_title}*✨\n"
-                        f"Город: 📍*{safe_city}*📍\n"
-                        f"Имя: {safe_masked_name}\n" # Теперь с маскировкой только отчества
-                        f"Ссылка на резюме: [Открыть на HH.ru]({resume_link})\n\n"
-                        f"URL: {resume_link}"
-                    )
-
-                    # Формирование истории чата (повторно используем логику)
-                    chat_transcript_file = None
-                    if dialogue.history:
-                        formatted_history_lines = []
-                        formatted_history_lines.append(f"=== ИСТОРИЯ ДИАЛОГА ===")
-                        formatted_history_lines.append(f"ID отклика: {dialogue.hh_response_id}")
-                        # <<< НАЧАЛО НОВОГО БЛОКА >>>
-                        if dialogue.response_created_at:
-                            # Конвертируем UTC время из БД в МСК
-                            response_time_msk = dialogue.response_created_at.astimezone(SPB_TIMEZONE)
-                            # Форматируем в красивую строку
-                            formatted_time_str = response_time_msk.strftime('%d.%m.%Y в %H:%M:%S')
-                            formatted_history_lines.append(f"Время отклика (МСК): {formatted_time_str}")
-                        # <<< КОНЕЦ НОВОГО БЛОКА >>>
-                        formatted_history_lines.append(f"Кандидат: {safe_masked_name}")
-                        formatted_history_lines.append(f"Вакансия: {safe_vacancy_title}, {safe_city}")
-                        formatted_history_lines.append("--------------------------------------------------")
-                        formatted_history_lines.append("")
-
-                        for entry in dialogue.history:
-                            role = entry.get('role')
-                            content = entry.get('content')
-                            if not content:  # Пропускаем пустые сообщения
-                                continue
-
-                            if is_system_command(content):
-                                logger.debug(f"Пропущена системная команда в истории: {content}")
-                                continue
-
-                            # Извлекаем и форматируем время
-                            timestamp_raw = entry.get('timestamp_msk', '')
-                            # Убираем секунды и часовой пояс для краткости
-                            timestamp_clean = timestamp_raw.split('.')[0][:-7] if timestamp_raw else ''
-                            timestamp_prefix = f"[{timestamp_clean}]" if timestamp_clean else ''
-
-                            formatted_history_lines.append("")  # Пустая строка перед каждым сообщением
-                            if role == 'user':
-                                formatted_history_lines.append(f"{timestamp_prefix} 👤 Кандидат: {content}")
-                            elif role == 'assistant':
-                                formatted_history_lines.append(f"{timestamp_prefix} 🤖 Бот: {content}")
-
-                        formatted_history_string = "\n".join(formatted_history_lines)
-
-                        file_name = f"rejected_transcription_{dialogue.hh_response_id}.txt"
-                        chat_transcript_file = BufferedInputFile(formatted_history_string.encode('utf-8'), filename=file_name)
-                        logger.debug(f"Сформирован файл транскрипции '{file_name}' для отклоненного диалога {dialogue.hh_response_id}")
-                    else:
-                        logger.debug(f"История диалога для отклоненного кандидата {dialogue.hh_response_id} пуста или отсутствует, файл не будет прикреплен.")
-
-                    try:
-                        async with asyncio.timeout(120.0):
-                            if chat_transcript_file:
-                                await bot.send_document(
-                                    chat_id=target_chat_id,
-                                    document=chat_transcript_file,
-                                    caption=message_text,
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    message_thread_id=target_thread_id
-                                )
-                                logger.info(f"Уведомление об отклоненном кандидате (диалог {dialogue.id}) отправлено.")
-                                await asyncio.sleep(5)
-                            else:
-                                await bot.send_message(
-                                    chat_id=target_chat_id,
-                                    text=message_text,
-                                    message_thread_id=target_thread_id
-                                )
-                                logger.warning(f"Файл транскрипции для отклоненного кандидата {dialogue.hh_response_id} отсутствовал. Отправлено только текстовое уведомление.")
-
-                            task.status = 'sent'
-                            task.processed_at = datetime.datetime.now(datetime.timezone.utc)
-
-                    except Exception as e:
-                        task.status = 'error'
-                        task.processed_at = datetime.datetime.now(datetime.timezone.utc)
-                        logger.error(f"Не удалось отправить уведомление об отклоненном кандидате для задачи RejectedNotificationQueue {task.id}: {e}", exc_info=True)
-
-                    finally:
-                        await db_session.commit()
-
-                await asyncio.sleep(5) # Короткая пауза между партиями задач
-
-            except Exception as e:
-                logger.critical(f"Критическая ошибка в фоновом обработчике отклоненных кандидатов: {e}", exc_info=True)
-                await db_session.rollback()
-                await asyncio.sleep(30) # Более длительная пауза при критической ошибке
+    await _run_queue_consumer('rejected', RejectedNotificationQueue, _send_rejected_alert, bot, health_monitor)
 
 async def run_history_cleanup_task(health_monitor: TaskHealthMonitor):
     logger.info(f"Задача очистки истории запущена.")
@@ -649,14 +384,13 @@ async def run_history_cleanup_task(health_monitor: TaskHealthMonitor):
             logger.info(f"Запуск очистки истории диалогов (UTC: {now_utc}).")
             try:
                 async with SessionLocal() as db_session:
-                    cutoff_date = now_utc - datetime.timedelta(days=HISTORY_RETENTION_DAYS)
-                    stmt = (
-                        update(Dialogue)
-                        .where(Dialogue.last_updated < cutoff_date)
-                        .where(Dialogue.history.is_not(None))
-                        .values(history=None)
-                    )
-                    await asyncio.wait_for(db_session.execute(stmt), timeout=300.0)
+                    # Сверка дневной воронки - до удаления истории, пока признак "начал диалог" еще виден
+                    await asyncio.wait_for(funnel_rollups.reconcile(db_session), timeout=300.0)
+                    await asyncio.wait_for(db_session.commit(), timeout=60.0)
+
+                    cutoff_date = now_utc - datetime.timedelta(days=dialogue_messages.HISTORY_RETENTION_DAYS)
+                    # История хранится в dialogue_messages: удаляем обработанные сообщения старых диалогов
+                    await asyncio.wait_for(dialogue_messages.delete_old_history(db_session, cutoff_date), timeout=300.0)
                     await asyncio.wait_for(db_session.commit(), timeout=60.0)
                     logger.info("Очистка успешно завершена.")
                     last_run_date = now_utc
@@ -680,7 +414,7 @@ async def main():
     )
     dp = Dispatcher()
 
-    dp.update.middleware(DbSessionMiddleware(session_pool=SyncSessionLocal))
+    dp.update.middleware(DbSessionMiddleware(session_pool=SessionLocal))
 
     dp.include_router(main_router)
 
@@ -698,6 +432,12 @@ async def main():
     # Запуск самого монитора
     monitor_task = asyncio.create_task(health_monitor.check_and_restart())
 
+    # Мгновенный разбор очередей уведомлений по NOTIFY от воркера
+    notification_queues.start_queue_listener()
+    delivery_scheduler.start_delivery_scheduler()
+    # Сброс кэша ролей из других процессов бота (LISTEN/NOTIFY, если включено)
+    role_cache.start_role_cache_listener()
+
     await bot.delete_webhook(drop_pending_updates=True)
     
     try:
@@ -706,6 +446,9 @@ async def main():
         health_monitor.shutdown = True
         for t in health_monitor.tasks.values(): t.cancel()
         monitor_task.cancel()
+        await role_cache.stop_role_cache_listener()
+        await notification_queues.stop_queue_listener()
+        await delivery_scheduler.stop_delivery_scheduler()
         logger.info("Бот остановлен.")
 
 if __name__ == '__main__':